@@ -0,0 +1,89 @@
+"""Benchmark pushing DTOs one by one against pushing them in batches.
+
+Sends synthetic DTOs for a handful of real estates through BasSink, with a
+batch size of 1 (a POST per DTO, as push_response_to_bas() does) and with
+batching, to a local server standing in for Bas. The NDJSON sink is timed
+too, as the floor for building and handing over the DTOs.
+
+Run with:
+    PYTHONPATH=src python benchmarks/bench_bas_sink.py [dtos]
+"""
+import gzip
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from crawler.net import client
+from crawler.sink.bas import BasSink
+from crawler.sink.ndjson import NdjsonSink
+
+REAL_ESTATES = ['kjorbo', 'dyrvik', 'sandvika', 'fornebu']
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        json.loads(body)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_dtos(total: int) -> list:
+    """ DTOs shaped like the Bas ones, with a base64 response of a typical size. """
+    return [(REAL_ESTATES[idx % len(REAL_ESTATES)],
+             json.dumps({"id": f"3C30ACE2-9AD2-4C14-BB3E-{idx:012d}",
+                         "realEstate": REAL_ESTATES[idx % 4], "type": "Powerthingy",
+                         "name": f"Bench.{idx}", "response": "eyJpdGVtIjog" * 150}))
+            for idx in range(total)]
+
+
+def run(name: str, sink, dtos: list) -> None:
+    start = time.perf_counter()
+    with sink:
+        for real_estate, body in dtos:
+            sink.put(real_estate, body)
+    elapsed = time.perf_counter() - start
+    requests_sent = getattr(sink, 'requests', 0)
+    print(f"{name:10s} {len(dtos) / elapsed:10.0f} DTOs/s   {requests_sent:6d} requests")
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_address[1]}/metadata/bas/realestate'
+    session = client.upstream('bas')
+
+    def post(real_estate, data, headers):
+        return session.post(f'{base_url}/{real_estate}', data=data, headers=headers)
+
+    dtos = make_dtos(total)
+    print(f"Pushing {total} DTOs for {len(REAL_ESTATES)} real estates, 4 requests in flight")
+    run('single', BasSink(post, batch_size=1, concurrency=4), dtos)
+    run('batch', BasSink(post, batch_size=100, concurrency=4), dtos)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        run('ndjson', NdjsonSink(os.path.join(tmpdir, 'dtos.ndjson')), dtos)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
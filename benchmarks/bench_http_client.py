@@ -0,0 +1,107 @@
+"""Benchmark per request latency with and without the shared HTTP client.
+
+Compares module level requests.get() (a new connection per request) with the
+keep-alive session from net.client against a local server, over plain HTTP
+and, if openssl is around to make a throwaway certificate, over TLS where
+the handshake saved is the bigger part.
+
+Run with:
+    PYTHONPATH=src python benchmarks/bench_http_client.py [requests]
+"""
+import os
+import shutil
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import requests
+
+from crawler.net import client
+
+BODY = b'{"item": {"id": "3C30ACE2-9AD2-4C14-BB3E-480B99A3E9EE", "name": "Energi_kWh"}}'
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(tls_dir: str = None) -> (Server, str):
+    server = Server(('127.0.0.1', 0), Handler)
+    scheme = 'http'
+    if tls_dir:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(os.path.join(tls_dir, 'cert.pem'), os.path.join(tls_dir, 'key.pem'))
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = 'https'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'{scheme}://127.0.0.1:{server.server_address[1]}/objects/foo'
+
+
+def make_certificate(tls_dir: str) -> bool:
+    if not shutil.which('openssl'):
+        return False
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-subj', '/CN=127.0.0.1', '-keyout', os.path.join(tls_dir, 'key.pem'),
+                    '-out', os.path.join(tls_dir, 'cert.pem')], check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return True
+
+
+def measure(get, url: str, total: int) -> list:
+    latencies = []
+    for _ in range(total):
+        start = time.perf_counter()
+        get(url, verify=False).content  # pylint: disable=expression-not-assigned
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def run(name: str, url: str, total: int) -> None:
+    client.configure()  # Fresh session, no warm connection to start with.
+    for label, get in (('requests.get', requests.get),
+                       ('shared client', client.upstream('bench').get)):
+        latencies = measure(get, url, total)
+        print(f"{name:5s} {label:14s} mean {statistics.mean(latencies) * 1000:7.2f} ms   "
+              f"p50 {statistics.median(latencies) * 1000:7.2f} ms")
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    warnings.filterwarnings('ignore')  # Unverified certificate.
+    print(f"{total} sequential GETs of a small object")
+    server, url = serve()
+    run('http', url, total)
+    server.shutdown()
+    with tempfile.TemporaryDirectory() as tls_dir:
+        if make_certificate(tls_dir):
+            server, url = serve(tls_dir)
+            run('https', url, total)
+            server.shutdown()
+        else:
+            print("No openssl around. Skipping https.")
+
+
+if __name__ == '__main__':
+    main()
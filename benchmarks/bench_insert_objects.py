@@ -0,0 +1,80 @@
+"""Benchmark page ingest during discovery (crawler objects).
+
+Compares the old row-by-row insert (one SELECT and one commit per item) with
+insert_objects() (one lookup, one bulk insert and one commit per page) against
+a file backed Sqlite database, so the fsync cost is part of the measurement.
+
+Run with:
+    PYTHONPATH=src python benchmarks/bench_insert_objects.py [total_objects]
+"""
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+
+import crawler.crawler as crawler
+
+PAGE_SIZE = 1000
+
+
+def make_pages(total: int) -> list:
+    """ Synthetic /objects pages shaped like the Metasys response items. """
+    items = [{"id": str(uuid.uuid4()).upper(),
+              "itemReference": f"GP-SXD9E-113:SOKP22-NAE4/Bench.{idx}",
+              "name": f"Bench.{idx}",
+              "parentUrl": f"https://metasys/api/v2/objects/{uuid.uuid4()}"}
+             for idx in range(total)]
+    return [items[i:i + PAGE_SIZE] for i in range(0, total, PAGE_SIZE)]
+
+
+def legacy_insert_object(session, item, object_type):
+    """ The per item insert as it was before page level ingest. """
+    existing_item = session.query(crawler.MetasysObject).filter_by(id=item["id"]).first()
+    if existing_item and existing_item.discovered:
+        return
+    row = crawler._object_row(item, object_type,  # pylint: disable=protected-access
+                              datetime.now(timezone.utc))
+    session.add(crawler.MetasysObject(**row))
+    session.commit()
+
+
+def legacy_ingest(session, pages):
+    for page in pages:
+        for item in page:
+            legacy_insert_object(session, item, 165)
+
+
+def bulk_ingest(session, pages):
+    for page in pages:
+        crawler.insert_objects(session, page, 165)
+
+
+def run(name: str, ingest, pages, total: int) -> None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        engine = crawler.create_engine('sqlite:///' + os.path.join(tmpdir, 'bench.db'))
+        crawler.Base.metadata.create_all(engine)
+        session = crawler.db_session(engine)
+        start = time.perf_counter()
+        ingest(session, pages)
+        first_pass = time.perf_counter() - start
+        # Second pass is the rerun case where everything is already discovered.
+        start = time.perf_counter()
+        ingest(session, pages)
+        second_pass = time.perf_counter() - start
+        session.close()
+    print(f"{name:8s} new: {total / first_pass:10.0f} rows/s   "
+          f"known: {total / second_pass:10.0f} rows/s")
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    pages = make_pages(total)
+    print(f"Ingesting {total} objects in pages of {PAGE_SIZE}")
+    run('legacy', legacy_ingest, pages, total)
+    run('bulk', bulk_ingest, pages, total)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+"""Add enumSetTotals to tell whether the stored enumsets are up to date.
+
+Revision ID: 2f6d9a4c8e15
+Revises: 5c8a2e7b3d91
+Create Date: 2026-10-17 21:47:33.115620
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2f6d9a4c8e15'
+down_revision = '5c8a2e7b3d91'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('enumSetTotals',
+    sa.Column('enumset', sa.Integer(), nullable=False),
+    sa.Column('total', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('enumset')
+    )
+
+
+def downgrade():
+    op.drop_table('enumSetTotals')
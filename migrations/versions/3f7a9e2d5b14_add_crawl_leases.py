@@ -0,0 +1,31 @@
+"""Add leaseOwner and leaseExpires so crawl workers can share the work.
+
+Revision ID: 3f7a9e2d5b14
+Revises: e61c4b9d0a58
+Create Date: 2026-10-17 14:51:33.067314
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f7a9e2d5b14'
+down_revision = 'e61c4b9d0a58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('metasysCrawl', sa.Column('leaseOwner', sa.String(), nullable=True))
+    op.add_column('metasysCrawl', sa.Column('leaseExpires', sa.DateTime(), nullable=True))
+    op.create_index(op.f('ix_metasysCrawl_leaseExpires'), 'metasysCrawl', ['leaseExpires'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_metasysCrawl_leaseExpires'), table_name='metasysCrawl')
+    # Sqlite can't drop columns in place.
+    with op.batch_alter_table('metasysCrawl') as batch_op:
+        batch_op.drop_column('leaseExpires')
+        batch_op.drop_column('leaseOwner')
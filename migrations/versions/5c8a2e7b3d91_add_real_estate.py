@@ -0,0 +1,26 @@
+"""Add realEstate so objects mapped to another real estate are pushed again.
+
+Revision ID: 5c8a2e7b3d91
+Revises: 9b4e1c7d2f58
+Create Date: 2026-10-17 21:08:14.602917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c8a2e7b3d91'
+down_revision = '9b4e1c7d2f58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('metasysCrawl', sa.Column('realEstate', sa.String(), nullable=True))
+
+
+def downgrade():
+    # Sqlite can't drop columns in place.
+    with op.batch_alter_table('metasysCrawl') as batch_op:
+        batch_op.drop_column('realEstate')
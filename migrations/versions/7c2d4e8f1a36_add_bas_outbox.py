@@ -0,0 +1,38 @@
+"""Add the basOutbox table for pushing to Bas apart from the crawl.
+
+Revision ID: 7c2d4e8f1a36
+Revises: 3f7a9e2d5b14
+Create Date: 2026-10-17 16:20:08.415926
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c2d4e8f1a36'
+down_revision = '3f7a9e2d5b14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('basOutbox',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('objectId', sa.String(), nullable=False),
+    sa.Column('realEstate', sa.String(), nullable=False),
+    sa.Column('body', sa.Text(), nullable=False),
+    sa.Column('created', sa.DateTime(), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('nextAttempt', sa.DateTime(), nullable=True),
+    sa.Column('lastError', sa.Text(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_basOutbox_objectId'), 'basOutbox', ['objectId'], unique=False)
+    op.create_index(op.f('ix_basOutbox_nextAttempt'), 'basOutbox', ['nextAttempt'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_basOutbox_nextAttempt'), table_name='basOutbox')
+    op.drop_index(op.f('ix_basOutbox_objectId'), table_name='basOutbox')
+    op.drop_table('basOutbox')
@@ -0,0 +1,31 @@
+"""Add nextAttempt for the crawl scheduler and index it along with lastSync.
+
+Revision ID: 8e3b1f6a2c47
+Revises: cfc76f549d72
+Create Date: 2026-10-17 11:02:17.503226
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e3b1f6a2c47'
+down_revision = 'cfc76f549d72'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('metasysCrawl', sa.Column('nextAttempt', sa.DateTime(), nullable=True))
+    op.create_index(op.f('ix_metasysCrawl_nextAttempt'), 'metasysCrawl', ['nextAttempt'],
+                    unique=False)
+    op.create_index(op.f('ix_metasysCrawl_lastSync'), 'metasysCrawl', ['lastSync'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_metasysCrawl_lastSync'), table_name='metasysCrawl')
+    op.drop_index(op.f('ix_metasysCrawl_nextAttempt'), table_name='metasysCrawl')
+    # Sqlite can't drop columns in place.
+    with op.batch_alter_table('metasysCrawl') as batch_op:
+        batch_op.drop_column('nextAttempt')
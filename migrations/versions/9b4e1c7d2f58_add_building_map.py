@@ -0,0 +1,28 @@
+"""Add the buildingMap table overriding the static building map.
+
+Revision ID: 9b4e1c7d2f58
+Revises: 7c2d4e8f1a36
+Create Date: 2026-10-17 19:42:51.208334
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b4e1c7d2f58'
+down_revision = '7c2d4e8f1a36'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('buildingMap',
+    sa.Column('building', sa.String(), nullable=False),
+    sa.Column('realEstate', sa.String(), nullable=False),
+    sa.PrimaryKeyConstraint('building')
+    )
+
+
+def downgrade():
+    op.drop_table('buildingMap')
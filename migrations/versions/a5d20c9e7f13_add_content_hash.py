@@ -0,0 +1,26 @@
+"""Add contentHash so unchanged objects aren't pushed to Bas again.
+
+Revision ID: a5d20c9e7f13
+Revises: 8e3b1f6a2c47
+Create Date: 2026-10-17 12:24:51.330982
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a5d20c9e7f13'
+down_revision = '8e3b1f6a2c47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('metasysCrawl', sa.Column('contentHash', sa.String(length=32), nullable=True))
+
+
+def downgrade():
+    # Sqlite can't drop columns in place.
+    with op.batch_alter_table('metasysCrawl') as batch_op:
+        batch_op.drop_column('contentHash')
@@ -0,0 +1,31 @@
+"""Add discovery checkpoints so crawler objects can resume.
+
+Revision ID: cfc76f549d72
+Revises: 04d56b17edad
+Create Date: 2026-10-17 09:12:41.118211
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'cfc76f549d72'
+down_revision = '04d56b17edad'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('discoveryCheckpoint',
+    sa.Column('objectType', sa.Integer(), nullable=False),
+    sa.Column('page', sa.Integer(), nullable=False),
+    sa.Column('completedAt', sa.DateTime(), nullable=False),
+    sa.Column('itemCount', sa.Integer(), nullable=False),
+    sa.Column('lastPage', sa.Boolean(), nullable=False),
+    sa.PrimaryKeyConstraint('objectType', 'page')
+    )
+
+
+def downgrade():
+    op.drop_table('discoveryCheckpoint')
@@ -0,0 +1,28 @@
+"""Add etag and lastModified so refresh crawls can do conditional GETs.
+
+Revision ID: e61c4b9d0a58
+Revises: a5d20c9e7f13
+Create Date: 2026-10-17 13:40:08.912457
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e61c4b9d0a58'
+down_revision = 'a5d20c9e7f13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('metasysCrawl', sa.Column('etag', sa.String(), nullable=True))
+    op.add_column('metasysCrawl', sa.Column('lastModified', sa.String(), nullable=True))
+
+
+def downgrade():
+    # Sqlite can't drop columns in place.
+    with op.batch_alter_table('metasysCrawl') as batch_op:
+        batch_op.drop_column('lastModified')
+        batch_op.drop_column('etag')
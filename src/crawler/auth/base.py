@@ -0,0 +1,149 @@
+"""Common ground for the auth drivers: keeping a token valid when many
+threads use the same driver at once.
+
+The token is renewed by one caller at a time while the others wait for it,
+so a crawl with N workers sends one login or refresh rather than N. A
+background thread can renew the token a while before the requests would
+have to, so they don't wait for it at all.
+
+With a TokenCache the token is saved once it is got and picked up again
+by the next driver for the same upstream and user, ie the next crawler run."""
+
+import logging
+import threading
+import time
+
+import requests
+
+from .cache import TokenCache
+
+RETRY_INTERVAL = 30.0  # Seconds the background renewal waits after failing.
+
+
+class RenewingToken(requests.auth.AuthBase):
+    """ Base class for the auth drivers. Subclasses implement login(),
+    remaining() and renew(), and call _logged_in() and _refreshed() to keep count.
+    To be cached they also implement cache_key() and _set_expires(). """
+    token: str = None
+    margin: float = 120.0      # Renew on the request path with less than this many seconds left...
+    lead: float = 300.0        # ...and in the background with less than this left.
+
+    def __init__(self, cache: TokenCache = None):
+        self.cache = cache
+        self.logins = 0
+        self.refreshes = 0
+        self.cached = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._renewer = None
+
+    def login(self) -> None:
+        raise NotImplementedError
+
+    def renew(self) -> None:
+        """ Get a fresh token in place of one about to expire. """
+        raise NotImplementedError
+
+    def remaining(self) -> float:
+        """ Seconds until the token expires. """
+        raise NotImplementedError
+
+    def cache_key(self) -> str:
+        """ What the token is cached under: the upstream and the user. """
+        raise NotImplementedError
+
+    def _set_expires(self, expires: float) -> None:
+        """ Set the expiry of a cached token, given in seconds since the epoch. """
+        raise NotImplementedError
+
+    def _logged_in(self) -> None:
+        self.logins += 1
+        self._save()
+
+    def _refreshed(self) -> None:
+        self.refreshes += 1
+        self._save()
+
+    def _save(self) -> None:
+        if self.cache is None:
+            return
+        try:
+            self.cache.put(self.cache_key(), self.token, time.time() + self.remaining())
+        except OSError as exception:
+            logging.warning(f"Could not cache the {type(self).__name__} token: {exception}")
+
+    def _load(self) -> bool:
+        """ Pick up a cached token with more than the margin left. """
+        if self.cache is None:
+            return False
+        cached = self.cache.get(self.cache_key())
+        if cached is None or cached[1] - time.time() < self.margin:
+            return False
+        token, expires = cached
+        self._set_expires(expires)
+        self.token = token
+        self.cached += 1
+        logging.info(f"Using the cached {type(self).__name__} token, "
+                     f"good for another {self.remaining():.0f}s")
+        return True
+
+    def _needs_renewal(self, ahead: float) -> bool:
+        return not self.token or self.remaining() < ahead
+
+    def _ensure(self, ahead: float) -> None:
+        """ Log in, or renew the token if it has less than `ahead` seconds left.
+        Only one caller does it; the others wait and find it done. """
+        if not self._needs_renewal(ahead):
+            return
+        with self._lock:
+            if not self.token:
+                if not self._load():
+                    self.login()
+            elif self.remaining() < ahead:
+                logging.info(f"{type(self).__name__} token expires in {self.remaining():.0f}s. "
+                             f"Renewing.")
+                self.renew()
+
+    def validate(self) -> None:
+        """ Make sure there is a token good for a while yet. """
+        self._ensure(self.margin)
+
+    def __call__(self, r):
+        """ This is the interface to the requests library.
+        It validates the token and injects a auth header"""
+        self.validate()
+        r.headers["authorization"] = "Bearer " + self.token
+        return r
+
+    def start_renewer(self) -> None:
+        """ Renew the token in a background thread ahead of expiry, so the
+        requests never have to wait for it. """
+        if self._renewer is not None:
+            return
+        self._stop.clear()
+        self._renewer = threading.Thread(target=self._renew_ahead,
+                                         name=f"{type(self).__name__}-renewer", daemon=True)
+        self._renewer.start()
+
+    def stop_renewer(self) -> None:
+        self._stop.set()
+        if self._renewer is not None:
+            self._renewer.join()
+            self._renewer = None
+
+    def _renew_ahead(self) -> None:
+        wait = 0.0
+        while not self._stop.wait(wait):
+            try:
+                self._ensure(self.lead)
+                # Tokens shorter lived than the lead are renewed halfway through their life instead.
+                wait = max(1.0, self.remaining() - self.lead, self.remaining() / 2)
+            except Exception as exception:  # pylint: disable=broad-except
+                # Requests renew it themselves if it comes to that.
+                logging.error(f"Renewing {type(self).__name__} token in the background failed: "
+                              f"{exception!r}")
+                wait = RETRY_INTERVAL
+
+    def summary(self) -> str:
+        return (f"{type(self).__name__}: {self.logins} logins, {self.refreshes} refreshes"
+                f"{f', {self.cached} from the cache' if self.cache else ''}")
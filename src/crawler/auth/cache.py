@@ -0,0 +1,84 @@
+"""On-disk cache of the auth tokens, so a short crawler run reuses the token
+the run before it got instead of logging in again.
+
+The tokens are kept in a single JSON file readable by its owner only,
+keyed by the upstream and user they are for. A token is used as long as it
+has more than its driver's margin left; after that it is logged in or
+refreshed as usual and the new one is written back. Writes go to a temporary
+file renamed into place, under an exclusive lock, so runs started at the
+same time don't clobber each other's tokens.
+
+The cache is off unless configure() is given a path."""
+
+import json
+import logging
+import os
+import stat
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows. The rename alone keeps the file whole there.
+    fcntl = None
+
+_cache = None
+
+
+class TokenCache:
+    """ Tokens by key. Thread safe. """
+
+    def __init__(self, path: str):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self._lock = threading.Lock()
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path) as fh:
+                mode = os.fstat(fh.fileno()).st_mode
+                if mode & (stat.S_IRWXG | stat.S_IRWXO):
+                    logging.warning(f"Token cache {self.path} is readable by others. Ignoring it.")
+                    return {}
+                return json.load(fh)
+        except FileNotFoundError:
+            return {}
+        except ValueError as exception:
+            logging.warning(f"Token cache {self.path} is unreadable, starting over: {exception}")
+            return {}
+
+    def get(self, key: str) -> tuple:
+        """ The (token, expires) cached for key, expires in seconds since the epoch.
+        None if there is none. """
+        entry = self._read().get(key)
+        if not entry:
+            return None
+        return entry['token'], entry['expires']
+
+    def put(self, key: str, token: str, expires: float) -> None:
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        with self._lock, open(self.path + '.lock', 'a') as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            tokens = self._read()
+            tokens[key] = {'token': token, 'expires': expires}
+            # mkstemp creates the file with mode 600.
+            fd, temporary = tempfile.mkstemp(dir=directory, prefix='.tokens-')
+            try:
+                with os.fdopen(fd, 'w') as fh:
+                    json.dump(tokens, fh)
+                os.replace(temporary, self.path)
+            except BaseException:
+                os.unlink(temporary)
+                raise
+
+
+def configure(path: str = None) -> None:
+    """ Cache the tokens in the file at path. None turns the cache off. """
+    global _cache  # pylint: disable=global-statement
+    _cache = TokenCache(path) if path else None
+
+
+def shared() -> TokenCache:
+    """ The cache set up by configure(), None if it is off. """
+    return _cache
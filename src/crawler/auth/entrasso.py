@@ -7,43 +7,45 @@ import time
 
 import requests
 
+from .base import RenewingToken
+from .cache import TokenCache
 
-class EntraSSOToken(requests.auth.AuthBase):
+
+class EntraSSOToken(RenewingToken):
     """ Auth driver + service class for EntraSSO. Used by the requests lib when accessing services
-    protected by EntraSSO. """
+    protected by EntraSSO. Safe to share between threads, see RenewingToken. """
     auth_url: str = None
     token: str = None
     expires: int = None
     appid: str = None
     appname: str = None
     secret: str = None
+    margin = 120.0  # There's no refresh. We log in again with less than 2 minutes left.
+    lead = 300.0
 
 
-    def __init__(self, url: str, appid: str, appname: str, secret: str):
-        """ Initialize the object with base_url, username and password. """
+    def __init__(self, url: str, appid: str, appname: str, secret: str,
+                 session: requests.Session = None, cache: TokenCache = None):
+        """ Initialize the object with base_url, username and password.
+        Logins go through session if given. The token is kept in cache if given. """
+        super().__init__(cache)
         self.auth_url = url
         self.appid = appid
         self.appname = appname
         self.secret = secret
+        self.http = session or requests
+
+    def remaining(self) -> float:
+        return self.expires - time.time()
 
+    def renew(self):
+        self.login()
 
-    def __call__(self, r):
-        """ This is the interface to the requests library.
-        It validates the token and injects a auth header"""
-        now = int(time.time())
-        # Avoid recursion when using this object to refresh
-        # Be careful not to end up calling yourself.
+    def cache_key(self) -> str:
+        return f"entrasso {self.auth_url} {self.appid}"
 
-        if not self.token:
-            self.login()
-        delta = self.expires - now
-        logging.debug(f"EntraSSO session time remaining: {delta} (expires: {self.expires} now: {now}")
-        if delta < 120:
-            logging.info("EntraSSO token is expiring in less than 120 seconds. Deleting token.")
-            self.token = None
-            self.login()
-        r.headers["authorization"] = "Bearer " + self.token
-        return r
+    def _set_expires(self, expires: float) -> None:
+        self.expires = round(expires)
 
     def login(self):
         """Gets the LOGIN
@@ -65,12 +67,13 @@ class EntraSSOToken(requests.auth.AuthBase):
         }
         logging.info(f"EntraSSO: Logging in as appid: {self.appname} with id {self.appid}")
 
-        response = requests.post(self.auth_url,
+        response = self.http.post(self.auth_url,
                                  headers=headers, data=data)
         response.raise_for_status()
         xml_response = response.text
         root = ET.fromstring(xml_response)
         token = root.find('params').find('applicationtokenID').text
-        self.token = token
         expires = int(root.find('params').find('expires').text) // 1000
         self.expires = expires
+        self.token = token
+        self._logged_in()
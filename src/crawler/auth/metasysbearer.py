@@ -7,62 +7,65 @@ from datetime import timezone
 import requests
 from dateutil.parser import isoparse
 
+from .base import RenewingToken
+from .cache import TokenCache
 
-class BearerToken(requests.auth.AuthBase):
-    """ Auth driver + service class for metasys. Used by the requests lib. """
+
+class BearerToken(RenewingToken):
+    """ Auth driver + service class for metasys. Used by the requests lib.
+    Safe to share between threads, see RenewingToken. """
     base_url: str = None
     token: str = None
     expires: datetime.datetime = None
     username: str
     password: str
+    margin = 600.0  # Refresh with less than 10 minutes left.
+    lead = 900.0
 
-    def __init__(self, base_url, username: str, password: str):
-        """ Initialize the object with base_url, username and password. """
+    def __init__(self, base_url, username: str, password: str, session: requests.Session = None,
+                 cache: TokenCache = None):
+        """ Initialize the object with base_url, username and password.
+        Logins and refreshes go through session if given. The token is kept in cache if given. """
+        super().__init__(cache)
         self.base_url = base_url
         self.username = username
         self.password = password
-        self.validating = False
+        self.http = session or requests
         logging.info(f"Created a bearer object for {username} @ {base_url} ")
 
-    def __call__(self, r):
-        """ This is the interface to the requests library.
-        It validates the token and injects a auth header"""
-
-        # Avoid recursion when using this object to refresh:
-        if not self.validating:
-            self.validate()
-        r.headers["authorization"] = "Bearer " + self.token
-        return r
-
     def login(self):
         """Fires of a login request. Stores the token and its expiration."""
         logging.info(f"Logging in user {self.username}")
-        resp = requests.post(self.base_url + '/login',
-                             json={'username': self.username, 'password': self.password})
+        resp = self.http.post(self.base_url + '/login',
+                              json={'username': self.username, 'password': self.password})
         json_resp = resp.json()
-        self.token = json_resp["accessToken"]
         self.expires = isoparse(json_resp["expires"])
+        self.token = json_resp["accessToken"]
+        self._logged_in()
 
     def refresh(self):
         """ Refreshes a still valid token. """
         logging.info("Refreshing token")
-        self.validating = True
-        resp = requests.get(self.base_url + '/refreshToken', auth=self)  # This feels a bit wonky...
-        self.validating = False
+        # The header is set here rather than by auth=self, which would validate
+        # and end up back here.
+        resp = self.http.get(self.base_url + '/refreshToken',
+                             headers={'authorization': 'Bearer ' + self.token})
         json_resp = resp.json()
-        self.token = json_resp["accessToken"]
         self.expires = isoparse(json_resp["expires"])
+        self.token = json_resp["accessToken"]
+        self._refreshed()
 
-    def validate(self) -> int:
-        """Make sure everything is in place for auth.
-        Calls refresh() (if less than 600s left) or login()."""
-        if not self.token:
-            self.login()
-            return
-        now = datetime.datetime.now(timezone.utc)
-        delta = self.expires - now
-        if delta.seconds < 600:
-            # We have less than 600 seconds until the token expires.
-            # Refresh it.
-            logging.info(f"Token is about to expire ({delta.seconds}s left). Refreshing.")
+    def renew(self):
+        if self.remaining() <= 0:
+            self.login()  # Too late to refresh.
+        else:
             self.refresh()
+
+    def remaining(self) -> float:
+        return (self.expires - datetime.datetime.now(timezone.utc)).total_seconds()
+
+    def cache_key(self) -> str:
+        return f"metasys {self.base_url} {self.username}"
+
+    def _set_expires(self, expires: float) -> None:
+        self.expires = datetime.datetime.fromtimestamp(expires, timezone.utc)
@@ -1,338 +1,79 @@
 """ Crawler for the Metasys API."""
-import base64
-import json
 import os
 import re
 import sys
-import time
-import traceback
-import uuid
-from datetime import timezone, datetime
 import logging
-from functools import lru_cache
 
 import click
-import requests
-import sqlalchemy
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 
 # Local modules. Fix the somewhat braindead import path...
 # This injects the path where this file is located into the search path.
 sys.path.insert(0, os.path.realpath(os.path.dirname(__file__)))
 
-from db.models import MetasysObject, EnumSet, Base
-from db.base import get_dsn
+# The commands below wire these together. What they don't use themselves is
+# imported too, so everything the crawl is made of is at hand as crawler.X.
+# pylint: disable=unused-import
+from db.models import MetasysObject, EnumSet, EnumSetTotal, DiscoveryCheckpoint, BasOutbox, \
+    BuildingMapping, Base
+from db.base import get_dsn, db_engine, db_session
+from db.archive import CorruptRecord, ResponseArchive
+from db.enumsets import TypeDescriptions, UnknownObjectType
+from db.candidates import Shard, crawl_candidates, in_shard, count_crawl_candidates, \
+    iter_crawl_candidates, iter_leased_candidates
+from db.lease import CrawlLease, LEASE_DURATION, LEASE_BATCH_SIZE
+from db.results import write_crawl_results, CrawlResultBuffer, WRITE_BATCH_SIZE, \
+    WRITE_BATCH_INTERVAL
+from db.outbox import due_outbox_entries, drain_outbox, write_outbox_results, \
+    OUTBOX_BATCH_SIZE
 from auth.metasysbearer import BearerToken
 from auth.entrasso import EntraSSOToken
+from auth import cache as token_cache
 from model.bas import Bas
-
-from metadata.buildingmap import BUILDING_MAP
+from model.dto import build_bas_dto, b64_encode_response, _json_converter, DTO_ERRORS
+from net.ratelimit import RateLimiter, AdaptiveRateLimiter
+from net import client, retry
+from net.client import upstream
+from net.upstreams import METASYS, BAS, SSO
+from net.bas import send_to_bas, bas_sink, post_bas_dto, BasRejected, POST_BATCH_SIZE
+from sink.base import Sink
+from sink.bas import BasSink
+from sink.ndjson import NdjsonSink
+from metasys.objects import ObjectFetch, validate_metasys_object, fetch_metasys_object, nae_of
+from metasys.discovery import get_uuid_from_url, insert_objects, fetch_object_pages, \
+    load_checkpoints, ingest_page, get_objects, discover_objects, count_object_by_type
+from metasys.enumsets import fetch_enumset, enumset_total, grab_enumsets, ENUMSETS
+from engine.enrich import content_hash, record_success, record_unchanged, record_error, \
+    enrich_single_thing, enrich_single_thing_async, enrich_things, enrich_things_async, \
+    push_response_to_bas, BACKOFF_MIN, BACKOFF_MAX
+from engine.enrichpipeline import enrich_things_pipeline
+from engine.replay import replay_archive
+from metadata import resolver
+from metadata.lookups import real_estate_resolver, metasysid_to_real_estate, \
+    type_descriptions, get_type_description, load_lookups
+# pylint: enable=unused-import
 
 # Constants:
 
 REQUESTS_TIMEOUT = 30.0  # 30 second timeout on the requests sent.
 
 
-def db_engine() -> sqlalchemy.engine.Engine:
-    """ Acquire a database engine. Mostly used by session.
-    Uses the DSN env variable. """
-    dsn = get_dsn()
-    engine = create_engine(dsn)
-    return engine
-
-
-def db_session(engine: sqlalchemy.engine.Engine = None) -> sqlalchemy.orm.session.Session:
-    """ Get a database session. """
-    # Engine default to None. If it isn't set then we set it ourselves.
-    if not engine:
-        engine = db_engine()
-    Session = sessionmaker(bind=engine)  # pylint: disable=invalid-name
-    session = Session()
-    return session
-
-
-def get_uuid_from_url(url: str) -> str:
-    """ Strip the URL from the string. Returns the UUID. """
-    return url.split('/')[-1]
-
+def entrasso_token() -> EntraSSOToken:
+    """ The Entra SSO token for Bas, set up from the environment. """
+    return EntraSSOToken(url=os.environ['ENTRAOS_SSO_URL'],
+                         appid=os.environ['ENTRAOS_BAS_APPID'],
+                         appname=os.environ['ENTRAOS_BAS_APPNAME'],
+                         secret=os.environ['ENTRAOS_BAS_SECRET'],
+                         session=upstream(SSO),
+                         cache=token_cache.shared()
+                         )
 
-def insert_object(session, item, object_type):
-    """ Insert an item into the database if it doesn't exists. """
-    obj_id = item["id"]
-
-    existing_item = session.query(MetasysObject).filter_by(id=obj_id).first()
-    if existing_item and existing_item.discovered:
-        logging.debug(f"Ignoring {obj_id} as we've already discovered it.")
-        return
-
-    logging.info(f"Inserting {obj_id}")
-
-    parent_url = item["parentUrl"]
-    if parent_url:
-        parent_id = get_uuid_from_url(item["parentUrl"])
-    else:
-        parent_id = None
-
-    session.add(MetasysObject(id=obj_id,
-                              parentId=parent_id,
-                              itemReference=item["itemReference"],
-                              name=item["name"],
-                              discovered=datetime.now(timezone.utc),
-                              type=object_type
-                              ))
-    session.commit()
-
-
-def get_objects(session: sqlalchemy.orm.session.Session, base_url: str,
-                bearer: BearerToken, object_type: int, delay: float):
-    """ Get the list of objects from Metasys and store them in the database."""
-    page = 1
-    while True:
-        resp = requests.get(base_url +
-                            f"/objects?page={page}&type={object_type}&pageSize=1000&sort=name",
-                            auth=bearer, timeout=REQUESTS_TIMEOUT)
-        json_response = resp.json()
-        items = json_response["items"]
-        logging.info(f"Working on page ({page} - {len(items)} items")
-        for item in json_response["items"]:
-            insert_object(session, item, object_type)
-        logging.info(f"Page({page}) complete.")
-        page = page + 1
-        if json_response["next"] is None:  # the last page has a none link to next.
-            break
-        time.sleep(delay)
-
-
-def validate_metasys_object(response: str):
-    """Validate that the JSON we get is valid JSON and doesn't
-    contain errors.
-
-    Throws ValueError upon failure. The JSON parser might also throw errors.
-    """
 
-    j = json.loads(response)
-    if 'message' in j:
-        raise ValueError(f'Error message found in response: {j["message"]}')
-
-    if 'item' not in j:
-        raise ValueError('No item in reponse.')
-
-
-def enrich_single_thing(session: sqlalchemy.orm.session.Session,
-                        base_url: str,
-                        metasys_bearer: BearerToken,
-                        item_object: MetasysObject,
-                        entrasso: EntraSSOToken
-                        ):
-    """ Fetch a single object from Metasys and store the response.
-    Note that this modifies the DBO object we've been handled and
-    we expect the caller to commit() these changes at some point
-    if you wanna persist them.
-
-    """
-    try:
-        resp = requests.get(base_url + f"/objects/{item_object.id}",
-                            auth=metasys_bearer, timeout=REQUESTS_TIMEOUT)
-        validate_metasys_object(resp.text)  # Validate the response. Throws exceptions.
-        item_object.lastCrawl = datetime.now(timezone.utc)
-        push_response_to_bas(session, resp.text, item_object, entrasso)  # Push to Bas. Throws exceptions.
-        item_object.successes += 1
-        item_object.lastSync = datetime.now(tz=timezone.utc)
-
-    except requests.exceptions.RequestException as requests_exception:
-        item_object.lastError = datetime.now(timezone.utc)
-        item_object.errors += 1
-        logging.error(requests_exception)
-    except Exception as response_exception:
-        item_object.lastError = datetime.now(timezone.utc)
-        item_object.errors += 1
-        logging.error(response_exception)
-        # Todo: Perhaps abort here? We don't know what happened.
-
-
-# This is the deep crawl. Might wanna try to cut down on the number of arguments.
-def enrich_things(session: sqlalchemy.orm.session.Session,
-                  base_url: str,
-                  metasys_bearer: BearerToken,
-                  entrasso_bearer: EntraSSOToken,
-                  delay: float,
-                  refresh: bool,
-                  item_prefix: str = None) -> None:
-    """ Get a list of Metasys Objects we should enrich.
-
-    ATM we can query both the Objects and the Network Device tables. It needs a itemReference if
-    we are to do filtering."""
-
-    # Build query.
-    query = session.query(MetasysObject)
-    if item_prefix:
-        query = query.filter(MetasysObject.itemReference.like(item_prefix + '%'))
-    if not refresh:  # Disregard successes. Fetch new data:
-        query = query.filter(MetasysObject.successes == 0)
-
-    item_objects = query.all()
-
-    total_objects = len(item_objects)
-    objects_crawled = 0
-    for item_object in item_objects:
-        objects_crawled = objects_crawled + 1
-        logging.info(f"Enriching object {item_object.id} - {item_object.name} ({objects_crawled}/{total_objects})")
-        enrich_single_thing(session, base_url, metasys_bearer, item_object, entrasso_bearer)
-        # Note that item_object has mutated here. error/success and lastSync has updated.
-        # So we need to commit.
-        session.commit()  # Commit after each object. Might throw.
-        logging.debug(f"Sleeping for {delay} seconds.")
-        time.sleep(delay)
-
-
-def count_object_by_type(base_url: str, bearer: BearerToken, delay: float, start: int, finish: int):
-    """ Used to list counts of different object types in the API. Used during exploration. """
-    logging.info(f"Starting count {start} --> {finish} with {delay}s delay on {base_url}")
-    logging.info("We ignore types with 0 entries so it'll take some time before you see output.")
-    print('type,count', flush=True)
-    for type_idx in range(start, finish):
-        resp = requests.get(base_url +
-                            f"/objects?type={type_idx}",
-                            auth=bearer, timeout=REQUESTS_TIMEOUT)
-        json_resp = resp.json()
-        total = json_resp["total"]
-        if total > 0:
-            print(f'{type_idx},{total}', flush=True)
-        time.sleep(delay)
-
-
-def metasysid_to_real_estate(metasysid: str) -> str:
-    """Takes something like 'GP-SXD9E-113:SOKP16-NAE4/FCB.434_121-1OU001.VAVmaks4'
-    and spits out 'kjorbo' using BUILDING_MAP (dict)
-
-    This is used when we push data into the Bas API.
-
-    """
-
-    try:
-        rx = re.compile('^([^:]+):([^-]+)')
-        sd, building = rx.findall(metasysid)[0]
-    except IndexError as e:
-        logging.error("Regular expression did not match. This should not happen.")
-        raise IndexError from e
-    except Exception as e:
-        logging.error(f"metasysid_to_real_estate: Could not make sense of {metasysid}")
-        raise ValueError("Regular expression error") from e
-    if building not in BUILDING_MAP:
-        logging.error(f"Can't find {building} in BUILDING_MAP - please update.")
-        return 'ukjent'
-    return BUILDING_MAP[building]
-
-
-def _json_converter(whatever) -> str:
-    """Helper to match various types into something that the JSON lib can grok."""
-    if isinstance(whatever, datetime):
-        return whatever.utcnow().isoformat() + 'Z'  # somewhat of a hack. Forces UTC.
-    if isinstance(whatever, uuid.UUID):
-        return str(whatever)
-
-
-@lru_cache(maxsize=256)
-def get_type_description(session: sqlalchemy.orm.session.Session, object_type: int) -> str:
-    """Returns the string representation of the object type. Note that
-    functools will cache the result of this so we don't have to hit
-    the database for every lookup. """
-    enumset = session.query(EnumSet).filter_by(id=object_type).first()
-    if not enumset.description:
-        # Note that this will only fire off once per input as the result is cached.
-        logging.error(f"No description found for type {object_type}")
-        logging.error(f"Make sure you've fetched the enumsets from metasys (508 and 507)")
-        sys.exit(1)  # I consider this a fatal error.
-    return enumset.description
-
-
-def b64_encode_response(metasysresp: str) -> str:
-    return base64.b64encode(metasysresp.encode('utf8')).decode('utf8')
-
-
-def push_response_to_bas(session: sqlalchemy.orm.session.Session,
-                         metasysresp: str,         # Response string with item.
-                         metadata: MetasysObject,  # DBO
-                         entrasso: EntraSSOToken):
-    """ Push a single Response from the Metasys API to the Bas API. """
-    j = json.loads(metasysresp)
-    # Build the DTO useing model (model/bas.py)
-    try:
-        base_url = os.environ['ENTRAOS_BAS_BASEURL']
-    except KeyError:
-        logging.error("Environment variable ENTRAOS_BAS_BASEURL is not set")
-        sys.exit(1)
-    try:
-        bas = Bas(
-            id=metadata.id,  # id - get from item or metadata
-            realEstate=metasysid_to_real_estate(metadata.itemReference),  # generate from building
-            parentId=metadata.parentId,  # from metadata or parse parentUrl
-            type=get_type_description(session, metadata.type),  # generate from metadata type - Looks up enumtype.
-            discovered=_json_converter(metadata.discovered),  # datetime        # metadata
-            lastCrawl=_json_converter(metadata.lastCrawl),  # metadata
-            lastError=_json_converter(metadata.lastError),  # metadata
-            successes=metadata.successes,  # metadata
-            errors=metadata.errors,  # metadata
-            response=b64_encode_response(metasysresp),  # generate from response. just b64-encode the string.
-            name=metadata.name,  # from item or metadata
-            itemReference=metadata.itemReference,  # from item or metadata
-            tfm=metadata.name,
-            description=j['item']['description']
-        )
-    except Exception as e:
-        logging.error(f"Exception caugh while creating DTO: {e}")
-        logging.error("Aborting. Please investigate.")
-        sys.exit(1)
-    url = f"{base_url}/metadata/bas/realestate/{bas.realEstate}"
-
-    try:
-        resp = requests.post(url,
-                             headers={'Content-Type': 'application/json'},
-                             json=bas.as_dict(), timeout=REQUESTS_TIMEOUT,
-                             auth=entrasso)
-    except requests.exceptions.RequestException as e:
-        logging.error(f'Request error while creating/sending request to Bas: {e}')
-        traceback.print_exc()
-        sys.exit(1)
-    # Bail on error.
-    if resp.status_code >= 400:
-        logging.error(f'Got error ({resp.status_code}/{resp.reason}) POSTing to {url}')
-        logging.error(f'Aborting')
-        sys.exit(1)
-    logging.info("Object pushed to Bas")
-
-
-def grab_enumsets(base_url: str,
-                  bearer: BearerToken,
-                  dbsess: sqlalchemy.orm.session.Session,
-                  enumset: int, delay: float) -> None:
-    """This function gets invoked when running crawler enumset and it grabs the enumsets.
-    These are used to translate the type field into a somewhat meaningful string.
-    """
-    page = 1
-    count = 0
-    while True:
-        logging.info(f'Getting enumset {enumset}')
-        resp = requests.get(base_url + f'/enumSets/{enumset}/members?page={page}&pageSize=1000',
-                            auth=bearer, timeout=REQUESTS_TIMEOUT)
-        resp.raise_for_status()
-
-        json_response = resp.json()
-        for item in json_response['items']:
-            enumset_id = item['id']
-            description = item['description']
-            db_item = EnumSet(id=enumset_id, description=description or "", enumset=enumset)
-            logging.debug(f"Adding enumset ID {enumset_id}, description: {description} in set {enumset}")
-            dbsess.merge(db_item)
-            dbsess.commit()
-            count = count + 1
-
-        page = page + 1
-        if json_response["next"] is None:  # the last page has a none link to next.
-            break
-        time.sleep(delay)
+def _sink(ndjson: str, limiter: RateLimiter, post_batch: int, concurrency: int) -> Sink:
+    """ The sink for the push and replay commands. """
+    if ndjson:
+        return NdjsonSink(ndjson)
+    return bas_sink(entrasso_token(), limiter, post_batch, concurrency)
 
 
 #
@@ -341,7 +82,31 @@ def grab_enumsets(base_url: str,
 
 @click.group()
 @click.option('--debug/--no-debug', default=False, help='Set log level to DEBUG.')
-def cli(debug):
+@click.option('--pool-size', type=click.INT, default=client.DEFAULT_POOL_SIZE, show_default=True,
+              help='Connections kept open to each of Metasys, Bas and the SSO. '
+                   'Raised to the concurrency of a crawl if that is higher.')
+@click.option('--timeout', type=click.FLOAT, default=REQUESTS_TIMEOUT, show_default=True,
+              help='Seconds before a request times out.')
+@click.option('--gzip/--no-gzip', default=True, show_default=True,
+              help='Ask for compressed responses.')
+@click.option('--attempts', type=click.INT, default=retry.DEFAULT_ATTEMPTS, show_default=True,
+              help='Times a request is tried on connection errors, timeouts, 429 and 5xx '
+                   'before giving up on it. Retries back off exponentially with jitter.')
+@click.option('--breaker-cooldown', type=click.FLOAT, default=retry.DEFAULT_COOLDOWN,
+              show_default=True,
+              help='Seconds to pause the requests to an upstream that looks down before trying it '
+                   'again. Doubled while it stays down.')
+@click.option('--building-map', type=click.Path(exists=True, dir_okay=False),
+              envvar='CRAWLER_BUILDING_MAP',
+              help='JSON file of {building: real estate} overriding the built in building map '
+                   'and the buildingMap table. [env var: CRAWLER_BUILDING_MAP]')
+@click.option('--token-cache', 'token_cache_path', type=click.Path(dir_okay=False),
+              envvar='CRAWLER_TOKEN_CACHE',
+              help='File to keep the Metasys and EntraSSO tokens in between runs, so a run only '
+                   'logs in once the token it finds there is about to expire. '
+                   '[env var: CRAWLER_TOKEN_CACHE]')
+def cli(debug, pool_size, timeout, gzip, attempts, breaker_cooldown, building_map,
+        token_cache_path):
     """ Crawler CLI for the Metasys API """
     # print(f"Metasys crawler {__version__}")
     if debug:
@@ -351,6 +116,10 @@ def cli(debug):
 
     logging.basicConfig(level=log_level,
                         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    client.configure(pool_size=pool_size, timeout=timeout, gzip=gzip)
+    retry.configure(attempts=attempts, cooldown=breaker_cooldown)
+    token_cache.configure(token_cache_path)
+    resolver.configure(building_map)
 
     try:
         load_dotenv()
@@ -362,7 +131,17 @@ def cli(debug):
 @cli.command()
 @click.option('--object-type', type=click.INT, required=False,
               help='Only fetch object of type OBJECT-TYPE. If not set then we get all known types.')
-def objects(object_type):
+@click.option('--concurrency', type=click.INT, default=1, show_default=True,
+              help='Number of object types to fetch at once.')
+@click.option('--rate', type=click.FLOAT, default=2.0, show_default=True,
+              help='Starting requests per second to Metasys, shared by all concurrent fetches.')
+@click.option('--max-rate', type=click.FLOAT, default=20.0, show_default=True,
+              help='The rate adapts to how Metasys copes but never goes above this.')
+@click.option('--prefetch', type=click.INT, default=1, show_default=True,
+              help='Number of pages of a type to fetch at once once the page count is known.')
+@click.option('--resume', is_flag=True,
+              help='Skip the pages a previous run has already stored.')
+def objects(object_type, concurrency, rate, max_rate, prefetch, resume):
     """Get the list of objects and stores them in the database for crawling.
     Pass the object type. This is an INTEGER. If no object type is given
     then the script will grab all know object types.
@@ -383,13 +162,38 @@ def objects(object_type):
     username = os.environ['METASYS_USERNAME']
     password = os.environ['METASYS_PASSWORD']
     logging.info(f"Crawling objects with type {object_type}")
-    bearer = BearerToken(base_url, username, password)
+    # Before the sessions are handed out. Growing the pools replaces them.
+    # Every type being fetched has its pages prefetched.
+    client.reserve(concurrency * (prefetch + 1))
+    bearer = BearerToken(base_url, username, password, upstream(METASYS), token_cache.shared())
     dbsess = db_session()
-    if object_type:
-        get_objects(dbsess, base_url, bearer, object_type, 0.5)
-    else:
-        for object_type_from_known in known_types:
-            get_objects(dbsess, base_url, bearer, object_type_from_known, 0.5)
+    object_types = [object_type] if object_type else known_types
+    checkpoints = load_checkpoints(dbsess) if resume else None
+    limiter = AdaptiveRateLimiter(rate, max_rate=max_rate, name='Metasys')
+    bearer.start_renewer()
+    try:
+        if concurrency > 1:
+            discover_objects(dbsess, base_url, bearer, object_types,
+                             concurrency, limiter, prefetch, checkpoints)
+        else:
+            for object_type_to_fetch in object_types:
+                get_objects(dbsess, base_url, bearer, object_type_to_fetch, limiter, prefetch,
+                            checkpoints)
+    finally:
+        bearer.stop_renewer()
+    logging.info(bearer.summary())
+    logging.info(limiter.summary())
+    logging.info(retry.summary())
+
+
+def parse_shard(ctx, param, value) -> Shard:  # pylint: disable=unused-argument
+    """ click callback turning "i/N" into a Shard. """
+    if value is None:
+        return None
+    match = re.fullmatch(r'(\d+)/(\d+)', value)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise click.BadParameter(f'Expected i/N with 1 <= i <= N, ie 1/4. Got "{value}"')
+    return Shard(int(match.group(1)), int(match.group(2)))
 
 
 @cli.command()
@@ -397,28 +201,178 @@ def objects(object_type):
               help='itemReference prefix ie something like "GP-SXD9E-113:SOKP22"')
 @click.option('--refresh', type=click.BOOL,
               help="The crawler won't refresh existing data unless told to", default=False)
-def deep(item_prefix, refresh):
+@click.option('--engine', type=click.Choice(['sequential', 'async', 'pipeline']),
+              default='sequential', show_default=True,
+              help='Crawl one object at a time or several concurrently.')
+@click.option('--concurrency', type=click.INT, default=4, show_default=True,
+              help='Objects in flight at once with the async engine.')
+@click.option('--fetch-workers', type=click.INT, default=4, show_default=True,
+              help='Metasys fetch workers with the pipeline engine.')
+@click.option('--push-workers', type=click.INT, default=4, show_default=True,
+              help='Bas push workers with the pipeline engine.')
+@click.option('--rate', type=click.FLOAT, default=0.5, show_default=True,
+              help='Starting requests per second, to Metasys and to Bas.')
+@click.option('--max-rate', type=click.FLOAT, default=20.0, show_default=True,
+              help='The rates adapt to how Metasys and Bas cope but never go above this.')
+@click.option('--write-batch', type=click.INT, default=WRITE_BATCH_SIZE, show_default=True,
+              help='Write the crawl results back to the database in batches of this many objects.')
+@click.option('--write-interval', type=click.FLOAT, default=WRITE_BATCH_INTERVAL, show_default=True,
+              help='Max seconds a crawl result waits before it is written.')
+@click.option('--schedule', is_flag=True,
+              help='Crawl every object, the most stale first, leaving the failing ones alone '
+                   'while they back off.')
+@click.option('--time-budget', type=click.FLOAT,
+              help="Minutes to crawl for. Objects not started by then wait for the next crawl.")
+@click.option('--force-push', is_flag=True,
+              help="Push every object to Bas, also the ones that haven't changed since the last "
+                   "push.")
+@click.option('--shard', callback=parse_shard,
+              help='Crawl shard i of N, ie 2/4, so N processes can share the crawl. '
+                   '--rate and --max-rate are shared between the shards.')
+@click.option('--leases', is_flag=True,
+              help='Share the crawl with any number of other workers by leasing objects through '
+                   'the database.')
+@click.option('--lease-duration', type=click.FLOAT, default=LEASE_DURATION, show_default=True,
+              help="Seconds before the leases of a worker that has died run out.")
+@click.option('--nae-cap', type=click.INT, default=2, show_default=True,
+              help='Max Metasys fetches in flight per NAE with the async and pipeline engines. '
+                   'The NAEs are taken in turn. 0 for no cap.')
+@click.option('--outbox', is_flag=True,
+              help='Write the DTOs to the outbox for crawler push instead of pushing them to Bas.')
+@click.option('--archive', type=click.Path(file_okay=False),
+              help='Directory to archive the Metasys responses in, for crawler replay.')
+def deep(item_prefix, refresh, engine, concurrency, fetch_workers, push_workers, rate, max_rate,
+         write_batch, write_interval, schedule, time_budget, force_push, shard, leases,
+         lease_duration, nae_cap, outbox, archive):
     """Do a deep crawl fetching every object taking the prefix into account. """
+    if shard and leases:
+        raise click.UsageError("Use either --shard or --leases, not both.")
+
+    # Before the sessions are handed out. Growing the pools replaces them.
+    client.reserve({'async': concurrency,
+                    'pipeline': max(fetch_workers, push_workers)}.get(engine, 1))
 
     # Setup the metasys auth object. This will raise exceptions if it fails.
     metasys_baseurl = os.environ['METASYS_BASEURL']
     metasys_username = os.environ['METASYS_USERNAME']
     metasys_password = os.environ['METASYS_PASSWORD']
-    bearer = BearerToken(metasys_baseurl, metasys_username, metasys_password)
-
-    # And ditto for the entrasso object:
-    entrasso_auth_url = os.environ['ENTRAOS_SSO_URL']
-    entraos_bas_appname = os.environ['ENTRAOS_BAS_APPNAME']
-    entraos_bas_appid = os.environ['ENTRAOS_BAS_APPID']
-    entraos_bas_secret = os.environ['ENTRAOS_BAS_SECRET']
-
-    entrasso = EntraSSOToken(url=entrasso_auth_url,
-                             appid=entraos_bas_appid,
-                             appname=entraos_bas_appname,
-                             secret=entraos_bas_secret
-                             )
+    bearer = BearerToken(metasys_baseurl, metasys_username, metasys_password, upstream(METASYS),
+                         token_cache.shared())
+
+    # And ditto for the entrasso object. Not needed if crawler push talks to Bas.
+    entrasso = None if outbox else entrasso_token()
+    session = db_session()
+    if shard:
+        # Every shard gets its share of the rates so together they stay within them.
+        rate, max_rate = rate / shard.count, max_rate / shard.count
+        logging.info(f"Crawling shard {shard.index}/{shard.count} at {rate:.2f}-{max_rate:.2f} "
+                     f"requests/s")
+    limiter = AdaptiveRateLimiter(rate, max_rate=max_rate, name='Metasys')
+    bas_limiter = AdaptiveRateLimiter(rate, max_rate=max_rate, name='Bas')
+    lease = CrawlLease(session.get_bind(), lease_duration) if leases else None
+    scheduling = dict(schedule=schedule, time_budget=time_budget * 60 if time_budget else None,
+                      force_push=force_push, shard=shard, lease=lease, outbox=outbox,
+                      archive=ResponseArchive(archive) if archive else None)
+
+    def crawl():
+        if engine == 'async':
+            enrich_things_async(session, metasys_baseurl, bearer, entrasso, concurrency, refresh,
+                                item_prefix, limiter, bas_limiter, write_batch, write_interval,
+                                nae_cap=nae_cap, **scheduling)
+        elif engine == 'pipeline':
+            enrich_things_pipeline(session, metasys_baseurl, bearer, entrasso, refresh, item_prefix,
+                                   fetch_workers, push_workers, limiter, bas_limiter,
+                                   write_batch=write_batch, write_interval=write_interval,
+                                   nae_cap=nae_cap, **scheduling)
+        else:
+            enrich_things(session, metasys_baseurl, bearer, entrasso, limiter, refresh, item_prefix,
+                          bas_limiter, write_batch, write_interval, **scheduling)
+
+    # Renew the tokens ahead of expiry so the workers don't wait for it.
+    tokens = [token for token in (bearer, entrasso) if token]
+    for token in tokens:
+        token.start_renewer()
+    try:
+        if lease:
+            with lease:
+                crawl()
+        else:
+            crawl()
+    finally:
+        for token in tokens:
+            token.stop_renewer()
+        if scheduling['archive']:
+            scheduling['archive'].close()
+    for token in tokens:
+        logging.info(token.summary())
+    logging.info(real_estate_resolver().summary())
+    logging.info(limiter.summary())
+    logging.info(bas_limiter.summary())
+    logging.info(retry.summary())
+
+
+@cli.command()
+@click.option('--concurrency', type=click.INT, default=4, show_default=True,
+              help='Number of POSTs to Bas in flight at once.')
+@click.option('--rate', type=click.FLOAT, default=0.5, show_default=True,
+              help='Requests per second to start out at. Adapts to how Bas copes.')
+@click.option('--max-rate', type=click.FLOAT, default=20.0, show_default=True,
+              help='Requests per second the adaptive rate never goes above.')
+@click.option('--batch-size', type=click.INT, default=OUTBOX_BATCH_SIZE, show_default=True,
+              help='Outbox entries taken per round.')
+@click.option('--follow', is_flag=True,
+              help='Keep waiting for new entries once the outbox is drained.')
+@click.option('--post-batch', type=click.INT, default=POST_BATCH_SIZE, show_default=True,
+              help='DTOs per POST to Bas, sent as a gzipped JSON array. Only if Bas takes arrays.')
+@click.option('--ndjson', type=click.Path(dir_okay=False),
+              help='Append the DTOs to this file, one JSON per line, instead of pushing them '
+                   'to Bas.')
+def push(concurrency, rate, max_rate, batch_size, follow, post_batch, ndjson):
+    """Push the DTOs a deep crawl with --outbox has written to Bas.
+    With --ndjson they are taken out of the outbox and written to the file. """
+    session = db_session()
+    limiter = AdaptiveRateLimiter(rate, max_rate=max_rate, name='Bas')
+    client.reserve(concurrency)
+    with _sink(ndjson, limiter, post_batch, concurrency) as sink:
+        counts = drain_outbox(session, sink, batch_size, follow)
+    waiting = session.query(BasOutbox).count()
+    logging.info(f"Pushed {counts['pushed']} to Bas, {counts['failed']} failed. "
+                 f"{waiting} left in the outbox.")
+    logging.info(sink.summary())
+    logging.info(limiter.summary())
+    logging.info(retry.summary())
+
+
+@cli.command()
+@click.option('--archive', type=click.Path(exists=True, file_okay=False), required=True,
+              help='Directory with the archive a deep crawl with --archive wrote.')
+@click.option('--item-prefix', type=click.STRING,
+              help='Only replay the objects with an itemReference starting with this.')
+@click.option('--concurrency', type=click.INT, default=8, show_default=True,
+              help='Number of POSTs to Bas in flight at once.')
+@click.option('--rate', type=click.FLOAT, default=5.0, show_default=True,
+              help='Requests per second to start out at. Adapts to how Bas copes.')
+@click.option('--max-rate', type=click.FLOAT, default=100.0, show_default=True,
+              help='Requests per second the adaptive rate never goes above.')
+@click.option('--post-batch', type=click.INT, default=POST_BATCH_SIZE, show_default=True,
+              help='DTOs per POST to Bas, sent as a gzipped JSON array. Only if Bas takes arrays.')
+@click.option('--ndjson', type=click.Path(dir_okay=False),
+              help='Append the DTOs to this file, one JSON per line, instead of pushing them '
+                   'to Bas.')
+def replay(archive, item_prefix, concurrency, rate, max_rate, post_batch, ndjson):
+    """Push the archived Metasys responses to Bas again without crawling Metasys. """
     session = db_session()
-    enrich_things(session, metasys_baseurl, bearer, entrasso, 2.0, refresh, item_prefix)
+    limiter = AdaptiveRateLimiter(rate, max_rate=max_rate, name='Bas')
+    client.reserve(concurrency)
+    with ResponseArchive(archive) as responses, \
+            _sink(ndjson, limiter, post_batch, concurrency) as sink:
+        counts = replay_archive(session, responses, sink, item_prefix)
+    logging.info(f"Replayed {counts['pushed']} objects to Bas, {counts['failed']} failed, "
+                 f"{counts['skipped']} skipped.")
+    logging.info(real_estate_resolver().summary())
+    logging.info(sink.summary())
+    logging.info(limiter.summary())
+    logging.info(retry.summary())
 
 
 @cli.command()
@@ -430,25 +384,34 @@ def count_object_types():
     base_url = os.environ['METASYS_BASEURL']
     username = os.environ['METASYS_USERNAME']
     password = os.environ['METASYS_PASSWORD']
-    bearer = BearerToken(base_url, username, password)
-    count_object_by_type(base_url, bearer, 0.2, 0, 1000)
+    bearer = BearerToken(base_url, username, password, upstream(METASYS), token_cache.shared())
+    limiter = AdaptiveRateLimiter(5.0, name='Metasys')
+    count_object_by_type(base_url, bearer, limiter, 0, 1000)
+    logging.info(limiter.summary())
 
 
 @cli.command()
-@click.option('--enumset', type=click.INT,
-              help='grab a specific enumset. Default is to grab 507 and 508.')
-def get_enumset(enumset: int = None):
-    """Grabs an enumset from metasys and populates the local database with it."""
+@click.option('--enumset', type=click.INT, multiple=True,
+              help='grab a specific enumset. Repeat it for several. '
+                   'Default is to grab 507 and 508.')
+@click.option('--if-stale', is_flag=True,
+              help="Leave the enumsets alone unless the number of members Metasys has "
+                   "in one of them changed. Cheap enough to run before every deep crawl.")
+def get_enumset(enumset: tuple = (), if_stale: bool = False):
+    """Grabs the enumsets from metasys and populates the local database with them."""
     base_url = os.environ['METASYS_BASEURL']
     username = os.environ['METASYS_USERNAME']
     password = os.environ['METASYS_PASSWORD']
-    bearer = BearerToken(base_url, username, password)
+    enumsets = enumset or ENUMSETS
+    # Before the sessions are handed out. Growing the pools replaces them.
+    client.reserve(len(enumsets))
+    bearer = BearerToken(base_url, username, password, upstream(METASYS), token_cache.shared())
     dbsess = db_session()
-    if enumset:
-        grab_enumsets(base_url, bearer, dbsess, enumset, 1.0)
-    else:
-        grab_enumsets(base_url, bearer, dbsess, 507, 1.0)
-        grab_enumsets(base_url, bearer, dbsess, 508, 1.0)
+    # A request a second per enumset.
+    limiter = AdaptiveRateLimiter(float(len(enumsets)), name='Metasys')
+    counts = grab_enumsets(base_url, bearer, dbsess, enumsets, limiter, if_stale)
+    logging.info(f"Refreshed {len(counts)} of {len(enumsets)} enumsets: {counts}")
+    logging.info(limiter.summary())
 
 
 # We typically won't be invoked like this, but if we do we set debug=True
@@ -0,0 +1,250 @@
+"""Archive of the raw Metasys responses, so Bas can be rebuilt or the DTO
+mapping changed without crawling Metasys again.
+
+The responses are appended, zlib compressed one by one, to segment files of
+up to segment_size bytes. A record is a header (magic, length of the id,
+length of the body, crc32 of the body), the object id and the compressed
+body. Every segment has an index file next to it with the id, offset and
+length of each of its records, so opening the archive doesn't mean reading
+all of it. An index that doesn't cover its segment, ie after a crash, is
+rebuilt by scanning the segment, and a torn record at the end is cut off.
+
+The archive keeps the latest response of every object in an in-memory
+id -> location map. Reads go through read-only memory maps of the segments,
+so looking up any response is a dict lookup, a crc check and a decompress.
+
+Several processes can write to the same archive, ie the workers of a
+sharded or leased crawl. A record and its index entry are appended under
+an exclusive lock on the segment, at the end of the segment as it is then,
+and a segment is only loaded under that lock. A process only knows of the
+records the others wrote before it opened the archive."""
+
+import collections
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows. Only one process can write to an archive there.
+    fcntl = None
+
+SEGMENT_SIZE = 64 * 1024 * 1024  # Bytes per segment file before a new one is started.
+
+_MAGIC = b'MRA1'
+_RECORD = struct.Struct('<4sHII')  # Magic, id length, body length, crc32 of the body.
+# Index entries: id length, body offset, body length. The id follows.
+_ENTRY = struct.Struct('<HQI')
+_SEGMENT_NAME = re.compile(r'^(\d{6})\.seg$')
+
+Location = collections.namedtuple('Location', ['segment', 'offset', 'length'])
+
+
+class CorruptRecord(ValueError):
+    """ An archived record doesn't match its crc or isn't the one the index points to. """
+
+
+def _lock(fh) -> None:
+    if fcntl:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+
+
+def _unlock(fh) -> None:
+    if fcntl:
+        fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+class ResponseArchive:
+    """ Append-only archive of responses keyed by object id. Thread safe.
+    Use it as a context manager or close() it when done. """
+
+    def __init__(self, path: str, segment_size: int = SEGMENT_SIZE, level: int = 6):
+        self.path = path
+        self.segment_size = segment_size
+        self.level = level
+        self._index = {}
+        self._maps = {}
+        self._lock = threading.Lock()
+        self._segment = None  # Number, data and index file of the segment being appended to.
+        self._data = None
+        self._entries = None
+        os.makedirs(path, exist_ok=True)
+        for segment in self._segments():
+            self._load(segment)
+        logging.info(f"Response archive {path}: {len(self._index)} objects")
+
+    def _file(self, segment: int, suffix: str) -> str:
+        return os.path.join(self.path, f"{segment:06d}.{suffix}")
+
+    def _segments(self) -> list:
+        matches = map(_SEGMENT_NAME.match, os.listdir(self.path))
+        return sorted(int(match.group(1)) for match in matches if match)
+
+    def _load(self, segment: int) -> None:
+        """ Add the records of a segment to the index, from its index file if that is complete.
+        Locks the segment so no other process is halfway through appending to it. """
+        with open(self._file(segment, 'seg'), 'ab') as lock:
+            _lock(lock)
+            size = os.fstat(lock.fileno()).st_size
+            entries = self._read_entries(segment)
+            last = entries[-1][1] if entries else None
+            if entries is None or (last and last.offset + last.length != size) \
+                    or (not entries and size):
+                logging.warning(f"Index of archive segment {segment} is incomplete. Rebuilding it.")
+                entries = self._scan(segment)
+        self._index.update(entries)
+
+    def _read_entries(self, segment: int) -> list:
+        """ The (id, location) pairs in the index file of a segment,
+        None if it is missing or torn. """
+        try:
+            with open(self._file(segment, 'idx'), 'rb') as fh:
+                data = fh.read()
+        except FileNotFoundError:
+            return None
+        entries, position = [], 0
+        while position < len(data):
+            if position + _ENTRY.size > len(data):
+                return None
+            id_length, offset, length = _ENTRY.unpack_from(data, position)
+            position += _ENTRY.size + id_length
+            if position > len(data):
+                return None
+            entries.append((data[position - id_length:position].decode('utf-8'),
+                            Location(segment, offset, length)))
+        return entries
+
+    def _scan(self, segment: int) -> list:
+        """ Read the records of a segment, cut off a torn one at the end and
+        write a fresh index. """
+        entries, position = [], 0
+        with open(self._file(segment, 'seg'), 'r+b') as fh:
+            data = fh.read()
+            while position + _RECORD.size <= len(data):
+                magic, id_length, length, crc = _RECORD.unpack_from(data, position)
+                offset = position + _RECORD.size + id_length
+                if magic != _MAGIC or offset + length > len(data) \
+                        or zlib.crc32(data[offset:offset + length]) != crc:
+                    break
+                entries.append((data[position + _RECORD.size:offset].decode('utf-8'),
+                                Location(segment, offset, length)))
+                position = offset + length
+            if position < len(data):
+                logging.warning(f"Cutting off {len(data) - position} bytes of a torn record "
+                                f"in archive segment {segment}")
+                fh.truncate(position)
+        with open(self._file(segment, 'idx'), 'wb') as fh:
+            fh.write(b''.join(_entry(object_id, location) for object_id, location in entries))
+        return entries
+
+    def _writable(self, size: int) -> int:
+        """ Lock the segment to append to, a later one if the record doesn't fit,
+        and return its size. Call with the lock held and _unlock() when done. """
+        if self._data is None:
+            segments = self._segments()
+            self._segment = segments[-1] if segments else 1
+            self._open(self._segment)
+        while True:
+            _lock(self._data)
+            end = os.fstat(self._data.fileno()).st_size  # Other processes may have appended since.
+            if not end or end + size <= self.segment_size:
+                return end
+            _unlock(self._data)
+            self._close_writer()
+            self._segment += 1
+            self._open(self._segment)
+
+    def _open(self, segment: int) -> None:
+        self._data = open(self._file(segment, 'seg'), 'ab')
+        self._entries = open(self._file(segment, 'idx'), 'ab')
+
+    def _close_writer(self) -> None:
+        if self._data is not None:
+            self._data.close()
+            self._entries.close()
+            self._data = self._entries = None
+
+    def put(self, object_id: str, response: str) -> None:
+        """ Append the response for an object. It replaces the one archived before, if any. """
+        body = zlib.compress(response.encode('utf-8'), self.level)
+        key = object_id.encode('utf-8')
+        record = _RECORD.pack(_MAGIC, len(key), len(body), zlib.crc32(body)) + key + body
+        with self._lock:
+            end = self._writable(len(record))
+            try:
+                location = Location(self._segment, end + _RECORD.size + len(key), len(body))
+                self._data.write(record)
+                # Before the index entry, which must not point past the end of the segment.
+                self._data.flush()
+                self._entries.write(_entry(object_id, location))
+                self._entries.flush()
+            finally:
+                _unlock(self._data)
+            self._index[object_id] = location
+
+    def _map(self, location: Location) -> mmap.mmap:
+        """ Memory map of the segment holding location, remapped if the segment
+        has grown past it since it was mapped. Call with the lock held. """
+        mapped = self._maps.get(location.segment)
+        if mapped is None or len(mapped) < location.offset + location.length:
+            if mapped is not None:
+                mapped.close()
+            with open(self._file(location.segment, 'seg'), 'rb') as fh:
+                mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[location.segment] = mapped
+        return mapped
+
+    def get(self, object_id: str) -> str:
+        """ The latest response archived for an object. KeyError if there is
+        none, CorruptRecord if what is archived isn't it. """
+        key = object_id.encode('utf-8')
+        with self._lock:
+            location = self._index[object_id]
+            mapped = self._map(location)
+            start = location.offset - len(key) - _RECORD.size
+            header = mapped[start:start + _RECORD.size] if start >= 0 else b''
+            stored_key = mapped[start + _RECORD.size:location.offset] if start >= 0 else b''
+            body = mapped[location.offset:location.offset + location.length]
+        if len(header) != _RECORD.size:
+            raise CorruptRecord(f"Archived record of {object_id} is corrupt")
+        magic, id_length, length, crc = _RECORD.unpack(header)
+        if magic != _MAGIC or id_length != len(key) or stored_key != key or length != len(body) \
+                or zlib.crc32(body) != crc:
+            raise CorruptRecord(f"Archived record of {object_id} is corrupt")
+        return zlib.decompress(body).decode('utf-8')
+
+    def ids(self) -> list:
+        """ The ids of the archived objects in the order they are stored,
+        which reads the segments front to back. """
+        with self._lock:
+            return [object_id for object_id, _ in
+                    sorted(self._index.items(), key=lambda item: item[1])]
+
+    def __contains__(self, object_id: str) -> bool:
+        return object_id in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_writer()
+            for mapped in self._maps.values():
+                mapped.close()
+            self._maps.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback_):
+        self.close()
+        return False
+
+
+def _entry(object_id: str, location: Location) -> bytes:
+    key = object_id.encode('utf-8')
+    return _ENTRY.pack(len(key), location.offset, location.length) + key
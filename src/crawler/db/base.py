@@ -2,7 +2,33 @@
 
 import os
 
+import sqlalchemy
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+# Older Sqlite builds refuse statements with more than 999 bound parameters,
+# so IN (...) lookups are chunked below that.
+IN_CLAUSE_CHUNK_SIZE = 500
+
 
 def get_dsn() -> str:
     """Return DSN - throws an exception if it isn't set."""
     return os.environ["DSN"]
+
+
+def db_engine() -> sqlalchemy.engine.Engine:
+    """ Acquire a database engine. Mostly used by session.
+    Uses the DSN env variable. """
+    dsn = get_dsn()
+    engine = create_engine(dsn)
+    return engine
+
+
+def db_session(engine: sqlalchemy.engine.Engine = None) -> sqlalchemy.orm.session.Session:
+    """ Get a database session. """
+    # Engine default to None. If it isn't set then we set it ourselves.
+    if not engine:
+        engine = db_engine()
+    Session = sessionmaker(bind=engine)  # pylint: disable=invalid-name
+    session = Session()
+    return session
@@ -0,0 +1,180 @@
+"""The objects a deep crawl enriches. They are streamed a batch at a time,
+in id order or the most stale first with a schedule, and sliced into shards
+or leased from the pool shared with the other workers."""
+
+import collections
+import logging
+import time
+import zlib
+from datetime import timezone, datetime
+
+import sqlalchemy
+from sqlalchemy import and_, or_
+
+from .lease import CrawlLease, LEASE_BATCH_SIZE
+from .models import MetasysObject
+
+CANDIDATE_BATCH_SIZE = 500  # Deep crawl candidates loaded per query.
+
+
+def crawl_candidates(session: sqlalchemy.orm.session.Session,
+                     refresh: bool,
+                     item_prefix: str = None,
+                     schedule: bool = False) -> sqlalchemy.orm.query.Query:
+    """ Build the query for the objects a deep crawl should enrich.
+    With schedule every object is a candidate except the ones backing off
+    after failures. """
+    query = session.query(MetasysObject)
+    if item_prefix:
+        query = query.filter(MetasysObject.itemReference.like(item_prefix + '%'))
+    if schedule:
+        query = query.filter(or_(MetasysObject.nextAttempt.is_(None),
+                                 MetasysObject.nextAttempt <= datetime.now(timezone.utc)))
+    elif not refresh:  # Disregard successes. Fetch new data:
+        query = query.filter(MetasysObject.successes == 0)
+    return query
+
+
+# One of `count` slices of the objects. index is 1-based, as given on the command line.
+Shard = collections.namedtuple('Shard', ['index', 'count'])
+
+
+def in_shard(object_id: str, shard: Shard = None) -> bool:
+    """ Whether an object belongs to the shard. The crc32 of the id is the same
+    in every process on every machine, unlike hash(). No shard means all of them. """
+    return shard is None or zlib.crc32(object_id.encode('utf8')) % shard.count == shard.index - 1
+
+
+def count_crawl_candidates(session: sqlalchemy.orm.session.Session,
+                           refresh: bool,
+                           item_prefix: str = None,
+                           schedule: bool = False,
+                           shard: Shard = None) -> int:
+    """ Number of objects a deep crawl will enrich. Sharding can't be done in
+    the query so the ids are read and counted here then. """
+    query = crawl_candidates(session, refresh, item_prefix, schedule)
+    if shard is None:
+        return query.count()
+    return sum(1 for (object_id,) in query.with_entities(MetasysObject.id)
+               if in_shard(object_id, shard))
+
+
+def _keyset_batches(make_query, keyset, batch_size: int):
+    """ Run the query a batch at a time, ordered by the keyset columns.
+    make_query(last) returns the query for the rows after the last row of
+    the previous batch, or from the start when last is None. """
+    last = None
+    while True:
+        batch = make_query(last).order_by(*keyset).limit(batch_size).all()
+        if not batch:
+            return
+        # Grab the keys before the caller gets the chance to expunge the row.
+        last = tuple(getattr(batch[-1], column.key) for column in keyset)
+        yield batch
+
+
+def _scheduled_batches(session: sqlalchemy.orm.session.Session, item_prefix: str, batch_size: int):
+    """ The objects that have never been synced in id order, then the rest
+    from the most stale up. Objects synced after we started are left for the
+    next crawl, so the ones we sync now don't come round again. """
+    started = datetime.now(timezone.utc)
+
+    def never_synced(last):
+        query = crawl_candidates(session, True, item_prefix, True) \
+            .filter(MetasysObject.lastSync.is_(None))
+        if last:
+            query = query.filter(MetasysObject.id > last[0])
+        return query
+
+    def stale(last):
+        query = crawl_candidates(session, True, item_prefix, True) \
+            .filter(MetasysObject.lastSync < started)
+        if last:
+            last_sync, last_id = last
+            query = query.filter(or_(MetasysObject.lastSync > last_sync,
+                                     and_(MetasysObject.lastSync == last_sync,
+                                          MetasysObject.id > last_id)))
+        return query
+
+    yield from _keyset_batches(never_synced, (MetasysObject.id,), batch_size)
+    yield from _keyset_batches(stale, (MetasysObject.lastSync, MetasysObject.id), batch_size)
+
+
+def iter_crawl_candidates(session: sqlalchemy.orm.session.Session,
+                          refresh: bool,
+                          item_prefix: str = None,
+                          detach: bool = False,
+                          batch_size: int = CANDIDATE_BATCH_SIZE,
+                          schedule: bool = False,
+                          deadline: float = None,
+                          shard: Shard = None):
+    """ Stream the deep crawl candidates, one batch per query using keyset
+    pagination. Only a batch is loaded at a time, so the first object is
+    ready right away and memory doesn't grow with the table.
+
+    The order is by primary key, or by staleness with schedule. Nothing
+    more is handed out once time.monotonic() passes the deadline. With a
+    shard the objects belonging to other shards are passed over.
+
+    The caller should expunge the objects it is done with, or pass detach to
+    get them expunged before they're handed out. """
+    def by_id(last):
+        query = crawl_candidates(session, refresh, item_prefix)
+        if last:
+            query = query.filter(MetasysObject.id > last[0])
+        return query
+
+    if schedule:
+        batches = _scheduled_batches(session, item_prefix, batch_size)
+    else:
+        batches = _keyset_batches(by_id, (MetasysObject.id,), batch_size)
+    for batch in batches:
+        for item_object in batch:
+            if not in_shard(item_object.id, shard):
+                session.expunge(item_object)  # The caller never sees it.
+                continue
+            if deadline is not None and time.monotonic() > deadline:
+                logging.info("Time budget for the crawl is spent. Stopping.")
+                return
+            if detach:
+                session.expunge(item_object)
+            yield item_object
+
+
+# Never synced first, then the most stale. Sorting on IS NOT NULL puts the
+# NULLs first on every database.
+_SCHEDULED_ORDER = (MetasysObject.lastSync.isnot(None), MetasysObject.lastSync, MetasysObject.id)
+
+
+def iter_leased_candidates(session: sqlalchemy.orm.session.Session,
+                           lease: CrawlLease,
+                           refresh: bool,
+                           item_prefix: str = None,
+                           batch_size: int = LEASE_BATCH_SIZE,
+                           schedule: bool = False,
+                           deadline: float = None):
+    """ Stream deep crawl candidates leased from the pool shared with the other
+    workers, claiming a new batch once the last one has been handed out.
+    Selection and order are as with iter_crawl_candidates(). The objects are
+    detached. """
+    order = _SCHEDULED_ORDER if schedule else (MetasysObject.id,)
+    while True:
+        batch = lease.claim(session, crawl_candidates(session, refresh, item_prefix, schedule),
+                            order, batch_size)
+        if not batch:
+            return
+        for item_object in batch:
+            if deadline is not None and time.monotonic() > deadline:
+                logging.info("Time budget for the crawl is spent. Stopping.")
+                return
+            yield item_object
+
+
+def candidate_stream(session: sqlalchemy.orm.session.Session, refresh: bool, item_prefix: str,
+                     schedule: bool, deadline: float, shard: Shard, lease: CrawlLease):
+    """ The detached candidates for a deep crawl engine, leased if we share the crawl. """
+    if lease is not None:
+        return iter_leased_candidates(session, lease, refresh, item_prefix, schedule=schedule,
+                                      deadline=deadline)
+    return iter_crawl_candidates(session, refresh, item_prefix, detach=True,
+                                 schedule=schedule, deadline=deadline, shard=shard)
@@ -0,0 +1,55 @@
+"""The descriptions of the Metasys object types, from the enumsets
+(507 and 508) crawler get-enumset stores in the database.
+
+They are loaded in one query into a TypeDescriptions map that can't be
+changed afterwards, so the workers of a crawl can all read from the same
+one without locking and without a database session of their own."""
+
+import logging
+import types
+
+import sqlalchemy
+
+from .models import EnumSet
+
+
+class UnknownObjectType(LookupError):
+    """ There is no description for an object type. The enumsets are
+    missing from the database or Metasys has a type they don't cover. """
+
+    def __init__(self, object_type: int):
+        super().__init__(f"No description found for object type {object_type}. Make sure "
+                         f"you've fetched the enumsets from Metasys (507 and 508) with "
+                         f"crawler get-enumset.")
+        self.object_type = object_type
+
+
+class TypeDescriptions:
+    """ Read-only object type -> description map. """
+    __slots__ = ('_descriptions',)
+
+    def __init__(self, descriptions: dict):
+        self._descriptions = types.MappingProxyType(dict(descriptions))
+
+    def __getitem__(self, object_type: int) -> str:
+        try:
+            return self._descriptions[object_type]
+        except KeyError:
+            raise UnknownObjectType(object_type) from None
+
+    def __contains__(self, object_type: int) -> bool:
+        return object_type in self._descriptions
+
+    def __len__(self) -> int:
+        return len(self._descriptions)
+
+
+def load_type_descriptions(session: sqlalchemy.orm.session.Session) -> TypeDescriptions:
+    """ Read the descriptions of every type. Types with an empty description are left out. """
+    descriptions = {}
+    query = session.query(EnumSet.id, EnumSet.description).order_by(EnumSet.enumset)
+    for object_type, description in query:
+        if description:
+            descriptions.setdefault(object_type, description)
+    logging.info(f"Loaded {len(descriptions)} object type descriptions")
+    return TypeDescriptions(descriptions)
@@ -0,0 +1,108 @@
+"""Leases on the deep crawl candidates, kept in the database so workers on
+any number of machines can share a crawl."""
+
+import logging
+import os
+import socket
+import threading
+import uuid
+from datetime import timezone, datetime, timedelta
+
+import sqlalchemy
+from sqlalchemy import and_, or_
+
+from .models import MetasysObject
+
+LEASE_DURATION = 300.0  # Seconds a worker's lease on a batch of objects lasts unless renewed.
+LEASE_BATCH_SIZE = 50  # Objects leased at a time. Small enough to spread the work around.
+
+
+class CrawlLease:
+    """ Leases on deep crawl candidates kept in the database, so any number of
+    workers on any number of machines can share a crawl without stepping on
+    each other. Workers claim a batch of objects at a time and the leases are
+    released as the results are written. While the worker lives its leases
+    are renewed in the background. If it dies they run out after `duration`
+    seconds and the objects go back in the pool for the others.
+
+    Use it as a context manager around the crawl. Leases still held when it
+    exits, ie on objects that didn't make it before the time budget ran
+    out, are released then. """
+
+    def __init__(self, engine: sqlalchemy.engine.Engine, duration: float = LEASE_DURATION,
+                 owner: str = None):
+        self.engine = engine
+        self.duration = duration
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.started = datetime.now(timezone.utc)
+        self.claimed = 0
+        self._stop = threading.Event()
+        self._renewer = None
+
+    def _expires(self) -> datetime:
+        return datetime.now(timezone.utc) + timedelta(seconds=self.duration)
+
+    def claim(self, session: sqlalchemy.orm.session.Session, query: sqlalchemy.orm.query.Query,
+              order: tuple, batch_size: int = LEASE_BATCH_SIZE) -> list:
+        """ Lease the first batch_size objects of the candidate query in the
+        given order. Objects leased by others, or crawled by anyone since we
+        started, are passed over. Returns the objects we got, detached. """
+        now = datetime.now(timezone.utc)
+        table = MetasysObject.__table__
+        free = or_(table.c.leaseExpires.is_(None), table.c.leaseExpires < now)
+        todo = and_(or_(table.c.lastSync.is_(None), table.c.lastSync < self.started),
+                    or_(table.c.lastError.is_(None), table.c.lastError < self.started))
+        candidates = query.filter(free, todo).with_entities(MetasysObject.id)
+        object_ids = [object_id for (object_id,) in candidates.order_by(*order).limit(batch_size)]
+        if object_ids:
+            # Another worker may have beaten us to some of them. Checking again in
+            # the UPDATE leaves those out; the database makes sure only one wins.
+            session.execute(table.update().where(table.c.id.in_(object_ids)).where(free).values(
+                leaseOwner=self.owner, leaseExpires=self._expires()))
+        session.commit()
+        position = {object_id: idx for idx, object_id in enumerate(object_ids)}
+        batch = sorted(session.query(MetasysObject).filter(MetasysObject.id.in_(object_ids),
+                                                           MetasysObject.leaseOwner == self.owner),
+                       key=lambda item_object: position[item_object.id]) if object_ids else []
+        for item_object in batch:
+            session.expunge(item_object)
+        self.claimed += len(batch)
+        logging.debug(f"{self.owner} leased {len(batch)} of {len(object_ids)} objects")
+        return batch
+
+    def renew(self) -> int:
+        """ Extend every lease we hold. Returns how many there are. """
+        table = MetasysObject.__table__
+        result = self.engine.execute(table.update().where(table.c.leaseOwner == self.owner).values(
+            leaseExpires=self._expires()))
+        return result.rowcount
+
+    def release(self) -> None:
+        """ Give up every lease we hold. """
+        table = MetasysObject.__table__
+        self.engine.execute(table.update().where(table.c.leaseOwner == self.owner).values(
+            leaseOwner=None, leaseExpires=None))
+
+    def _keep_renewing(self) -> None:
+        while not self._stop.wait(self.duration / 3):
+            try:
+                self.renew()
+            except sqlalchemy.exc.SQLAlchemyError as exception:
+                # The leases last a while yet. Better luck next time.
+                logging.warning(f"Failed to renew the leases of {self.owner}: {exception}")
+
+    def __enter__(self):
+        self.started = datetime.now(timezone.utc)
+        self._stop.clear()
+        self._renewer = threading.Thread(target=self._keep_renewing, name="lease-renewer",
+                                         daemon=True)
+        self._renewer.start()
+        logging.info(f"Sharing the crawl with other workers as {self.owner}")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback_):
+        self._stop.set()
+        self._renewer.join()
+        self.release()
+        logging.info(f"{self.owner} leased {self.claimed} objects")
+        return False
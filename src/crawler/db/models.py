@@ -1,6 +1,6 @@
 """Database objects for the crawler. """
 
-from sqlalchemy import Column, Integer, String, DateTime, Text
+from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -24,7 +24,19 @@ class MetasysObject(Base):  # pylint: disable=too-few-public-methods
     # Included for convenience:
     name = Column(String, nullable=True)
     itemReference = Column(String, nullable=True)
-    lastSync = Column(DateTime, nullable=True)
+    lastSync = Column(DateTime, index=True, nullable=True)
+    # Objects failing are left alone until this time. See the crawl scheduler.
+    nextAttempt = Column(DateTime, index=True, nullable=True)
+    # Hash of the item last pushed to Bas. Unchanged objects aren't pushed again.
+    contentHash = Column(String(32), nullable=True)
+    # The real estate it was last pushed to. Objects mapped elsewhere since are fetched in full.
+    realEstate = Column(String, nullable=True)
+    # Validators from the last fetch, sent back as is to make the next one conditional.
+    etag = Column(String, nullable=True)
+    lastModified = Column(String, nullable=True)
+    # The worker crawling the object and until when. See CrawlLease in db/lease.py.
+    leaseOwner = Column(String, nullable=True)
+    leaseExpires = Column(DateTime, index=True, nullable=True)
 
     def as_dict(self, excluded_keys: dict) -> dict:
         """ Returns a dict with copies of the data in the object.
@@ -46,3 +58,51 @@ class EnumSet(Base):  # pylint: disable=too-few-public-methods
     id = Column(Integer, primary_key=True)
     description = Column(String, nullable=False)
     enumset = Column(Integer, nullable=False)
+
+
+class EnumSetTotal(Base):  # pylint: disable=too-few-public-methods
+    """ The number of members Metasys had in an enumset when we last fetched
+    it. The enumsets share members, so the rows in enumSets can't be counted
+    to tell whether one is up to date. """
+    __tablename__ = "enumSetTotals"
+    enumset = Column(Integer, primary_key=True)
+    total = Column(Integer, nullable=False)
+
+
+class DiscoveryCheckpoint(Base):  # pylint: disable=too-few-public-methods
+    """ A page of the /objects listing that has been stored during discovery.
+    Written in the same transaction as the objects on the page so a crawl
+    that dies can be resumed from where it stopped."""
+    __tablename__ = "discoveryCheckpoint"
+    objectType = Column(Integer, primary_key=True)
+    page = Column(Integer, primary_key=True)
+    completedAt = Column(DateTime, nullable=False)
+    itemCount = Column(Integer, nullable=False)
+    # Set on the page where Metasys had no next link. The type is done then.
+    lastPage = Column(Boolean, nullable=False, default=False)
+
+
+class BasOutbox(Base):  # pylint: disable=too-few-public-methods
+    """ A DTO waiting to be pushed to Bas. Written by the deep crawl with
+    --outbox, in the same transaction as the crawl results, and drained by
+    crawler push. The entries of an object are pushed in order of id and
+    deleted once Bas has taken them."""
+    __tablename__ = "basOutbox"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    objectId = Column(String, index=True, nullable=False)
+    realEstate = Column(String, nullable=False)
+    body = Column(Text, nullable=False)  # The DTO as JSON, POSTed as is.
+    created = Column(DateTime, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    # Entries that failed are left alone until this time.
+    nextAttempt = Column(DateTime, index=True, nullable=True)
+    lastError = Column(Text, nullable=True)
+
+
+class BuildingMapping(Base):  # pylint: disable=too-few-public-methods
+    """ Override of a building in the static building -> real estate map in
+    metadata/buildingmap.py, so a building can be added or moved without a
+    code change. Read at the start of every crawl. """
+    __tablename__ = "buildingMap"
+    building = Column(String, primary_key=True)
+    realEstate = Column(String, nullable=False)
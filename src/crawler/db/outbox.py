@@ -0,0 +1,115 @@
+"""The outbox. A deep crawl with --outbox writes the DTOs here instead of
+pushing them, in the same transaction as its results, and crawler push
+drains it to Bas."""
+
+import collections
+import json
+import logging
+import time
+from datetime import timezone, datetime, timedelta
+from functools import partial
+
+import sqlalchemy
+from sqlalchemy import bindparam, or_
+from sqlalchemy.orm import aliased
+
+from model.bas import Bas
+from sink.base import Sink
+from .base import IN_CLAUSE_CHUNK_SIZE
+from .models import BasOutbox
+
+OUTBOX_BATCH_SIZE = 200  # Outbox entries pushed to Bas per round.
+OUTBOX_BACKOFF_MIN = timedelta(minutes=1)  # Wait before retrying an outbox entry Bas didn't take...
+OUTBOX_BACKOFF_MAX = timedelta(hours=6)    # ...doubled for every failure up to this.
+
+
+def outbox_entry(bas: Bas) -> dict:
+    """ Map a DTO to a basOutbox row. """
+    return dict(objectId=bas.id, realEstate=bas.realEstate, body=json.dumps(bas.as_dict()),
+                created=datetime.now(timezone.utc), attempts=0)
+
+
+def due_outbox_entries(session: sqlalchemy.orm.session.Session,
+                       batch_size: int = OUTBOX_BATCH_SIZE) -> list:
+    """ The next outbox entries to push: the oldest entry of every object,
+    unless it is backing off after a failure. An object's later entries wait
+    for that one, so an object's entries reach Bas in the order they were
+    written while different objects can be pushed at the same time. """
+    older = aliased(BasOutbox)
+    queued_before = session.query(older.id).filter(older.objectId == BasOutbox.objectId,
+                                                   older.id < BasOutbox.id)
+    return (session.query(BasOutbox.id, BasOutbox.objectId, BasOutbox.realEstate, BasOutbox.body,
+                          BasOutbox.attempts)
+            .filter(or_(BasOutbox.nextAttempt.is_(None),
+                        BasOutbox.nextAttempt <= datetime.now(timezone.utc)))
+            .filter(~queued_before.exists())
+            .order_by(BasOutbox.id)
+            .limit(batch_size)
+            .all())
+
+
+def _outbox_backoff(attempts: int) -> timedelta:
+    """ How long to leave an outbox entry alone after it failed `attempts` times. """
+    return min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_MIN * 2 ** min(attempts - 1, 32))
+
+
+def write_outbox_results(session: sqlalchemy.orm.session.Session, pushed: list,
+                         failed: list) -> None:
+    """ Acknowledge the entries Bas has taken by deleting them and back off
+    the failed ones, in a single commit. Deleting is idempotent, so an entry
+    acknowledged twice or pushed again after a crash before the commit does
+    no harm; Bas just gets the same DTO again. failed holds (entry, exception). """
+    table = BasOutbox.__table__
+    for chunk in (pushed[i:i + IN_CLAUSE_CHUNK_SIZE]
+                  for i in range(0, len(pushed), IN_CLAUSE_CHUNK_SIZE)):
+        session.execute(table.delete().where(table.c.id.in_(chunk)))
+    if failed:
+        now = datetime.now(timezone.utc)
+        statement = table.update().where(table.c.id == bindparam('b_id')).values(
+            attempts=bindparam('b_attempts'),
+            nextAttempt=bindparam('b_nextAttempt'),
+            lastError=bindparam('b_lastError'))
+        session.execute(statement, [dict(b_id=entry.id,
+                                         b_attempts=entry.attempts + 1,
+                                         b_nextAttempt=now + _outbox_backoff(entry.attempts + 1),
+                                         b_lastError=str(exception))
+                                    for entry, exception in failed])
+    session.commit()
+
+
+def drain_outbox(session: sqlalchemy.orm.session.Session,
+                 sink: Sink,
+                 batch_size: int = OUTBOX_BATCH_SIZE,
+                 follow: bool = False,
+                 poll_interval: float = 10.0) -> collections.Counter:
+    """ Push the outbox through the sink, ie a BasSink, in rounds of batch_size
+    entries. Entries the sink couldn't deliver are backed off and tried again
+    later. Stops when nothing is due, unless follow is set; then it waits
+    poll_interval seconds for the crawl to add more. Returns the number of
+    entries pushed and failed. """
+    counts = collections.Counter()
+    while True:
+        entries = due_outbox_entries(session, batch_size)
+        session.commit()  # Don't sit on a read transaction while pushing.
+        if not entries:
+            if not follow:
+                break
+            time.sleep(poll_interval)
+            continue
+        pushed, failed = [], []
+
+        def delivered(entry, error: Exception) -> None:
+            if error is None:
+                pushed.append(entry.id)
+            else:
+                logging.error(f"Pushing outbox entry {entry.id} for {entry.objectId} failed: "
+                              f"{error}")
+                failed.append((entry, error))
+
+        for entry in entries:
+            sink.put(entry.realEstate, entry.body, partial(delivered, entry))
+        sink.flush()
+        write_outbox_results(session, pushed, failed)
+        counts.update(pushed=len(pushed), failed=len(failed))
+        logging.info(f"Outbox: {counts['pushed']} pushed, {counts['failed']} failed")
+    return counts
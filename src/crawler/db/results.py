@@ -0,0 +1,100 @@
+"""Writing what a deep crawl did with the objects back to the database, a
+batch at a time."""
+
+import logging
+import time
+
+import sqlalchemy
+from sqlalchemy import bindparam, or_
+
+from .models import MetasysObject, BasOutbox
+
+WRITE_BATCH_SIZE = 100  # Crawl results written per UPDATE batch.
+WRITE_BATCH_INTERVAL = 5.0  # Max seconds a crawl result waits to be written.
+
+
+def write_crawl_results(session: sqlalchemy.orm.session.Session, item_objects: list,
+                        lease_owner: str = None, outbox_entries: list = None) -> None:
+    """ Write the crawl bookkeeping of a batch of objects back to the database
+    as one executemany UPDATE and a single commit. With a lease_owner the
+    leases on the objects are released as well. The outbox entries are
+    added in the same transaction, so an object is never recorded as synced
+    without its DTO waiting in the outbox. """
+    if not item_objects:
+        return
+    if outbox_entries:
+        session.execute(BasOutbox.__table__.insert(), outbox_entries)
+    table = MetasysObject.__table__
+    statement = table.update().where(table.c.id == bindparam('b_id')).values(
+        lastCrawl=bindparam('b_lastCrawl'),
+        lastError=bindparam('b_lastError'),
+        lastSync=bindparam('b_lastSync'),
+        nextAttempt=bindparam('b_nextAttempt'),
+        contentHash=bindparam('b_contentHash'),
+        realEstate=bindparam('b_realEstate'),
+        etag=bindparam('b_etag'),
+        lastModified=bindparam('b_lastModified'),
+        successes=bindparam('b_successes'),
+        errors=bindparam('b_errors'))
+    if lease_owner is not None:
+        # If our lease ran out and somebody else has leased the object since, it's theirs to write.
+        statement = statement.where(or_(table.c.leaseOwner == lease_owner,
+                                        table.c.leaseOwner.is_(None))) \
+            .values(leaseOwner=None, leaseExpires=None)
+    session.execute(statement, [dict(b_id=item_object.id,
+                                     b_lastCrawl=item_object.lastCrawl,
+                                     b_lastError=item_object.lastError,
+                                     b_lastSync=item_object.lastSync,
+                                     b_nextAttempt=item_object.nextAttempt,
+                                     b_contentHash=item_object.contentHash,
+                                     b_realEstate=item_object.realEstate,
+                                     b_etag=item_object.etag,
+                                     b_lastModified=item_object.lastModified,
+                                     b_successes=item_object.successes,
+                                     b_errors=item_object.errors)
+                                for item_object in item_objects])
+    session.commit()
+    logging.debug(f"Wrote crawl results for {len(item_objects)} objects")
+
+
+class CrawlResultBuffer:
+    """ Collects the objects a deep crawl is done with, along with their
+    outbox entries if any, and writes them with write_crawl_results() once
+    batch_size objects are waiting or interval seconds have passed since the
+    last write. Use it as
+    a context manager so whatever is left is written when the crawl stops,
+    however it stops. """
+
+    def __init__(self, session: sqlalchemy.orm.session.Session,
+                 batch_size: int = WRITE_BATCH_SIZE, interval: float = WRITE_BATCH_INTERVAL,
+                 lease_owner: str = None):
+        self.session = session
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lease_owner = lease_owner
+        self.written = 0
+        self._pending = []
+        self._outbox = []
+        self._last_write = time.monotonic()
+
+    def add(self, item_object: MetasysObject, outbox_entry: dict = None) -> None:
+        self._pending.append(item_object)
+        if outbox_entry is not None:
+            self._outbox.append(outbox_entry)
+        if len(self._pending) >= self.batch_size \
+                or time.monotonic() - self._last_write >= self.interval:
+            self.flush()
+
+    def flush(self) -> None:
+        pending, self._pending = self._pending, []
+        outbox, self._outbox = self._outbox, []
+        write_crawl_results(self.session, pending, self.lease_owner, outbox)
+        self.written += len(pending)
+        self._last_write = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback_):
+        self.flush()
+        return False
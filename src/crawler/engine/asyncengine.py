@@ -0,0 +1,51 @@
+"""Asyncio engine for the deep crawl. Keeps a fixed number of objects in
+flight at once. The blocking bits (the HTTP calls through requests) are run
+in a thread pool while everything touching the database stays on the event
+loop thread, so a single session can be used safely."""
+
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable
+
+
+async def in_thread(func: Callable, *args, **kwargs):
+    """ Run a blocking call in the engine's thread pool and wait for it. """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+async def _drain(items, handle: Callable) -> None:
+    """ Worker coroutine. The workers share the iterator; only the loop thread
+    advances it so there is no need for locking. """
+    for item in items:
+        await handle(item)
+
+
+async def _run(items: Iterable, handle: Callable, concurrency: int) -> None:
+    iterator = iter(items)
+    workers = [asyncio.ensure_future(_drain(iterator, handle)) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(*workers)
+    except Exception:
+        # Don't leave the other workers dangling on a closed loop.
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+
+
+def run_concurrently(items: Iterable, handle: Callable, concurrency: int) -> None:
+    """ Await handle(item) for every item with at most `concurrency` in flight.
+    Items are pulled from the iterable as workers become free, so it can be
+    a lazy query. Exceptions from handle() abort the run. """
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    loop.set_default_executor(executor)
+    logging.info(f"Async engine starting with {concurrency} objects in flight")
+    try:
+        loop.run_until_complete(_run(items, handle, concurrency))
+    finally:
+        executor.shutdown(wait=True)
+        loop.close()
@@ -0,0 +1,345 @@
+"""The deep crawl. Every object is fetched from Metasys, mapped to a Bas DTO
+and pushed to Bas, or written to the outbox, unless it hasn't changed since
+the last push. The sequential and the async engine are here, the pipeline
+is in enrichpipeline.py. They share the steps for a single object and the
+bookkeeping."""
+
+import hashlib
+import json
+import logging
+import time
+from datetime import timezone, datetime, timedelta
+
+import requests
+import sqlalchemy
+
+from auth.entrasso import EntraSSOToken
+from auth.metasysbearer import BearerToken
+from db.archive import ResponseArchive
+from db.candidates import Shard, candidate_stream, count_crawl_candidates
+from db.lease import CrawlLease
+from db.models import MetasysObject
+from db.outbox import outbox_entry
+from db.results import CrawlResultBuffer, WRITE_BATCH_SIZE, WRITE_BATCH_INTERVAL
+from metadata.lookups import load_lookups, metasysid_to_real_estate
+from metasys.objects import ObjectFetch, fetch_metasys_object, nae_of
+from model.dto import build_bas_dto
+from net.bas import post_bas_dto
+from net.ratelimit import RateLimiter
+from .asyncengine import in_thread, run_concurrently
+from .fairness import interleave, KeyedLimiter
+
+BACKOFF_MIN = timedelta(hours=1)  # Wait before retrying an object that failed...
+BACKOFF_MAX = timedelta(days=14)  # ...doubled for every failure in a row up to this.
+NAE_WINDOW = 500  # Candidates read ahead to interleave the NAEs.
+
+
+def _validators(item_object: MetasysObject, force_push: bool) -> dict:
+    """ The validators to make the fetch of an object conditional. A forced
+    push needs the body so it doesn't get any. """
+    if force_push:
+        return {}
+    return dict(etag=item_object.etag, last_modified=item_object.lastModified)
+
+
+def fetch_object(base_url: str, metasys_bearer: BearerToken, item_object: MetasysObject,
+                 limiter: RateLimiter = None, force_push: bool = False,
+                 nae_limiter: KeyedLimiter = None, archive: ResponseArchive = None,
+                 real_estate: str = None) -> ObjectFetch:
+    """ fetch_metasys_object() for a crawl. Conditional, and within the cap
+    on requests in flight to the object's NAE if there is one. With an
+    archive the response is archived. Objects missing from the archive are
+    fetched in full so it gets them, and so are objects that have been
+    mapped to another real estate than the one they were pushed to. """
+    not_archived = archive is not None and item_object.id not in archive
+    moved = real_estate is not None and real_estate != item_object.realEstate
+    validators = _validators(item_object, force_push or not_archived or moved)
+    if nae_limiter is None:
+        fetched = fetch_metasys_object(base_url, metasys_bearer, item_object.id, limiter,
+                                       **validators)
+    else:
+        with nae_limiter.hold(nae_of(item_object.itemReference)):
+            fetched = fetch_metasys_object(base_url, metasys_bearer, item_object.id, limiter,
+                                           **validators)
+    if archive is not None and fetched.text is not None:
+        archive.put(item_object.id, fetched.text)
+    return fetched
+
+
+def content_hash(metasysresp: str, real_estate: str = None) -> str:
+    """ Compact hash of the item in a Metasys response and the real estate it
+    goes to. The item is serialized with sorted keys and no whitespace so
+    formatting doesn't count as a change. A building mapped to another real
+    estate does. """
+    item = json.loads(metasysresp)['item']
+    normalized = json.dumps([item, real_estate], sort_keys=True, separators=(',', ':'),
+                            ensure_ascii=False)
+    return hashlib.blake2b(normalized.encode('utf8'), digest_size=16).hexdigest()
+
+
+def is_unchanged(item_object: MetasysObject, fetched: ObjectFetch, digest: str,
+                 force_push: bool) -> bool:
+    """ Whether Bas already has what we just fetched. """
+    if fetched.text is None:  # Not modified.
+        return True
+    return (not force_push and item_object.contentHash is not None
+            and item_object.contentHash == digest)
+
+
+def _keep_validators(item_object: MetasysObject, fetched: ObjectFetch = None) -> None:
+    """ Validators are only kept once Bas has the object. Otherwise a failed
+    push could be followed by a 304 and the object would never get there. """
+    if fetched is not None:
+        item_object.etag = fetched.etag
+        item_object.lastModified = fetched.lastModified
+
+
+def record_success(item_object: MetasysObject, digest: str = None,
+                   fetched: ObjectFetch = None, real_estate: str = None) -> None:
+    item_object.successes += 1
+    item_object.lastSync = datetime.now(tz=timezone.utc)
+    item_object.nextAttempt = None
+    if digest is not None:
+        item_object.contentHash = digest
+    if real_estate is not None:
+        item_object.realEstate = real_estate
+    _keep_validators(item_object, fetched)
+
+
+def record_unchanged(item_object: MetasysObject, fetched: ObjectFetch = None) -> None:
+    """ The object is the same as the last time we pushed it. Bas is in
+    sync without a push so it isn't counted as one. """
+    item_object.lastSync = datetime.now(tz=timezone.utc)
+    item_object.nextAttempt = None
+    _keep_validators(item_object, fetched)
+    logging.info(f"Object {item_object.id} unchanged. Not pushed to Bas")
+
+
+def _backoff(item_object: MetasysObject) -> timedelta:
+    """ How long to leave an object alone after it failed. The wait doubles
+    if the previous attempt failed too, so the streak is kept in the distance
+    between lastError and nextAttempt. """
+    previous_error, previous_next = item_object.lastError, item_object.nextAttempt
+    failing = previous_error and (item_object.lastSync is None
+                                  or previous_error > item_object.lastSync)
+    if not (failing and previous_next):
+        return BACKOFF_MIN
+    return min(BACKOFF_MAX, max(BACKOFF_MIN, 2 * (previous_next - previous_error)))
+
+
+def record_error(item_object: MetasysObject, exception: Exception) -> None:
+    now = datetime.now(timezone.utc)
+    item_object.nextAttempt = now + _backoff(item_object)
+    item_object.lastError = now
+    item_object.errors += 1
+    logging.error(exception)
+
+
+def push_response_to_bas(session: sqlalchemy.orm.session.Session,
+                         metasysresp: str,         # Response string with item.
+                         metadata: MetasysObject,  # DBO
+                         entrasso: EntraSSOToken,
+                         limiter: RateLimiter = None):
+    """ Push a single Response from the Metasys API to the Bas API. """
+    post_bas_dto(build_bas_dto(session, metasysresp, metadata), entrasso, limiter)
+
+
+def enrich_single_thing(session: sqlalchemy.orm.session.Session,
+                        base_url: str,
+                        metasys_bearer: BearerToken,
+                        item_object: MetasysObject,
+                        entrasso: EntraSSOToken,
+                        limiter: RateLimiter = None,
+                        bas_limiter: RateLimiter = None,
+                        force_push: bool = False,
+                        outbox: bool = False,
+                        archive: ResponseArchive = None
+                        ) -> dict:
+    """ Fetch a single object from Metasys and store the response.
+    Note that this modifies the DBO object we've been handled and
+    we expect the caller to commit() these changes at some point
+    if you wanna persist them.
+
+    The fetch is conditional and the push to Bas is skipped if the object
+    hasn't changed since it was last pushed, unless force_push is set.
+    With outbox the DTO isn't pushed but returned as an outbox entry for the
+    caller to write along with the changes. With an archive the responses
+    are archived as well.
+    """
+    try:
+        real_estate = metasysid_to_real_estate(item_object.itemReference)
+        fetched = fetch_object(base_url, metasys_bearer, item_object, limiter, force_push,
+                               archive=archive, real_estate=real_estate)
+        item_object.lastCrawl = datetime.now(timezone.utc)
+        digest = fetched.text and content_hash(fetched.text, real_estate)
+        if is_unchanged(item_object, fetched, digest, force_push):
+            record_unchanged(item_object, fetched)
+            return None
+        if outbox:
+            entry = outbox_entry(build_bas_dto(session, fetched.text, item_object,
+                                               real_estate=real_estate))
+            record_success(item_object, digest, fetched, real_estate)
+            return entry
+        # Push to Bas. Throws.
+        push_response_to_bas(session, fetched.text, item_object, entrasso, bas_limiter)
+        record_success(item_object, digest, fetched, real_estate)
+
+    except requests.exceptions.RequestException as requests_exception:
+        record_error(item_object, requests_exception)
+    except Exception as response_exception:
+        record_error(item_object, response_exception)
+        # Todo: Perhaps abort here? We don't know what happened.
+    return None
+
+
+async def enrich_single_thing_async(session: sqlalchemy.orm.session.Session,
+                                    base_url: str,
+                                    metasys_bearer: BearerToken,
+                                    item_object: MetasysObject,
+                                    entrasso: EntraSSOToken,
+                                    limiter: RateLimiter = None,
+                                    bas_limiter: RateLimiter = None,
+                                    force_push: bool = False,
+                                    nae_limiter: KeyedLimiter = None,
+                                    outbox: bool = False,
+                                    archive: ResponseArchive = None) -> dict:
+    """ The async take on enrich_single_thing(). The HTTP calls run in the
+    engine's thread pool while the DTO and the bookkeeping are done on the
+    loop thread, the only one touching the session. """
+    try:
+        real_estate = metasysid_to_real_estate(item_object.itemReference)
+        fetched = await in_thread(fetch_object, base_url, metasys_bearer, item_object, limiter,
+                                  force_push, nae_limiter, archive, real_estate)
+        item_object.lastCrawl = datetime.now(timezone.utc)
+        digest = fetched.text and content_hash(fetched.text, real_estate)
+        if is_unchanged(item_object, fetched, digest, force_push):
+            record_unchanged(item_object, fetched)
+            return None
+        bas = build_bas_dto(session, fetched.text, item_object, real_estate=real_estate)
+        entry = outbox_entry(bas) if outbox else None
+        if not outbox:
+            await in_thread(post_bas_dto, bas, entrasso, bas_limiter)
+        record_success(item_object, digest, fetched, real_estate)
+        return entry
+    except Exception as response_exception:  # pylint: disable=broad-except
+        record_error(item_object, response_exception)
+    return None
+
+
+def nae_fairness(candidates, nae_cap: int = None):
+    """ Interleave the candidates round-robin over their NAEs and set up the
+    cap on fetches in flight per NAE. Nothing changes without a cap. """
+    if not nae_cap:
+        return candidates, None
+    return (interleave(candidates, lambda item_object: nae_of(item_object.itemReference),
+                       NAE_WINDOW),
+            KeyedLimiter(nae_cap, 'NAE'))
+
+
+def crawl_deadline(time_budget: float = None) -> float:
+    """ time.monotonic() value a crawl with time_budget seconds should stop at. """
+    return None if time_budget is None else time.monotonic() + time_budget
+
+
+# This is the deep crawl. Might wanna try to cut down on the number of arguments.
+def enrich_things(session: sqlalchemy.orm.session.Session,
+                  base_url: str,
+                  metasys_bearer: BearerToken,
+                  entrasso_bearer: EntraSSOToken,
+                  limiter: RateLimiter,
+                  refresh: bool,
+                  item_prefix: str = None,
+                  bas_limiter: RateLimiter = None,
+                  write_batch: int = WRITE_BATCH_SIZE,
+                  write_interval: float = WRITE_BATCH_INTERVAL,
+                  schedule: bool = False,
+                  time_budget: float = None,
+                  force_push: bool = False,
+                  shard: Shard = None,
+                  lease: CrawlLease = None,
+                  outbox: bool = False,
+                  archive: ResponseArchive = None) -> None:
+    """ Get a list of Metasys Objects we should enrich.
+
+    ATM we can query both the Objects and the Network Device tables. It needs a itemReference if
+    we are to do filtering. The limiters pace the requests to Metasys and Bas. The results
+    are written back in batches of write_batch objects or every write_interval seconds.
+
+    With schedule the most stale objects go first and the failing ones are
+    left alone while they back off. No new objects are started once
+    time_budget seconds have passed. Objects that haven't changed since they
+    were last pushed aren't pushed again unless force_push is set. With a
+    shard only the objects in that shard are crawled. With a lease the
+    objects are leased from the pool shared with other workers. With outbox
+    the DTOs are written to the outbox for crawler push instead of pushed.
+    With an archive the Metasys responses are archived for crawler replay."""
+
+    deadline = crawl_deadline(time_budget)
+    load_lookups(session)
+    total_objects = count_crawl_candidates(session, refresh, item_prefix, schedule, shard)
+    objects_crawled = 0
+    with CrawlResultBuffer(session, write_batch, write_interval, lease and lease.owner) as results:
+        for item_object in candidate_stream(session, refresh, item_prefix, schedule, deadline,
+                                            shard, lease):
+            objects_crawled = objects_crawled + 1
+            logging.info(f"Enriching object {item_object.id} - {item_object.name} "
+                         f"({objects_crawled}/{total_objects})")
+            entry = enrich_single_thing(session, base_url, metasys_bearer, item_object,
+                                        entrasso_bearer, limiter, bas_limiter, force_push,
+                                        outbox, archive)
+            # Note that item_object has mutated here. error/success and lastSync has updated.
+            # It's detached so the changes are written through the buffer.
+            results.add(item_object, entry)
+
+
+def enrich_things_async(session: sqlalchemy.orm.session.Session,
+                        base_url: str,
+                        metasys_bearer: BearerToken,
+                        entrasso_bearer: EntraSSOToken,
+                        concurrency: int,
+                        refresh: bool,
+                        item_prefix: str = None,
+                        limiter: RateLimiter = None,
+                        bas_limiter: RateLimiter = None,
+                        write_batch: int = WRITE_BATCH_SIZE,
+                        write_interval: float = WRITE_BATCH_INTERVAL,
+                        schedule: bool = False,
+                        time_budget: float = None,
+                        force_push: bool = False,
+                        shard: Shard = None,
+                        lease: CrawlLease = None,
+                        outbox: bool = False,
+                        archive: ResponseArchive = None,
+                        nae_cap: int = None) -> None:
+    """ Deep crawl with `concurrency` objects in flight at once. Same selection,
+    scheduling, sharding, leasing, change detection, outbox, archiving,
+    bookkeeping and batched write back as enrich_things(). The limiters
+    pace the requests to Metasys and Bas.
+    With nae_cap the objects are taken round-robin from the NAEs and no
+    more than nae_cap fetches are in flight to any one NAE. """
+    deadline = crawl_deadline(time_budget)
+    load_lookups(session)
+    total_objects = count_crawl_candidates(session, refresh, item_prefix, schedule, shard)
+    objects_crawled = 0
+
+    async def handle(item_object: MetasysObject) -> None:
+        nonlocal objects_crawled
+        objects_crawled = objects_crawled + 1
+        logging.info(f"Enriching object {item_object.id} - {item_object.name} "
+                     f"({objects_crawled}/{total_objects})")
+        entry = await enrich_single_thing_async(session, base_url, metasys_bearer, item_object,
+                                                entrasso_bearer, limiter, bas_limiter, force_push,
+                                                nae_limiter, outbox, archive)
+        results.add(item_object, entry)
+
+    # Log in up front so the workers don't all try at once.
+    metasys_bearer.validate()
+    if not outbox:
+        entrasso_bearer.validate()
+    # The workers pull from the stream as they go. Only the loop thread touches it and the buffer.
+    candidates, nae_limiter = nae_fairness(
+        candidate_stream(session, refresh, item_prefix, schedule, deadline, shard, lease), nae_cap)
+    with CrawlResultBuffer(session, write_batch, write_interval, lease and lease.owner) as results:
+        run_concurrently(candidates, handle, concurrency)
+    if nae_limiter:
+        logging.info(nae_limiter.summary())
@@ -0,0 +1,153 @@
+"""The deep crawl as a pipeline (pipeline.py) with a stage per step and
+workers of its own for every stage. The steps for an object are the ones
+the other engines take, see enrich.py."""
+
+import itertools
+import logging
+from datetime import timezone, datetime
+
+import requests
+import sqlalchemy
+
+from auth.entrasso import EntraSSOToken
+from auth.metasysbearer import BearerToken
+from db.archive import ResponseArchive
+from db.base import db_session
+from db.candidates import Shard, candidate_stream, count_crawl_candidates
+from db.lease import CrawlLease
+from db.models import MetasysObject
+from db.outbox import outbox_entry
+from db.results import write_crawl_results, WRITE_BATCH_SIZE, WRITE_BATCH_INTERVAL
+from metadata.lookups import load_lookups, metasysid_to_real_estate
+from model.dto import DTO_ERRORS, build_bas_dto
+from net import retry
+from net.bas import post_bas_dto
+from net.ratelimit import RateLimiter
+from .enrich import content_hash, crawl_deadline, fetch_object, is_unchanged, nae_fairness, \
+    record_error, record_success, record_unchanged
+from .pipeline import Pipeline, Stage, BatchStage
+
+
+class CrawlTask:  # pylint: disable=too-few-public-methods
+    """ An object on its way through the deep crawl pipeline. """
+
+    def __init__(self, item_object: MetasysObject):
+        self.item_object = item_object
+        self.real_estate = None  # Where the object goes in Bas.
+        self.fetched = None   # What we got from Metasys, an ObjectFetch.
+        self.bas = None       # DTO built from the response.
+        self.digest = None    # Content hash of the response.
+        self.unchanged = False  # Same as the last push. Nothing to send.
+        self.outbox = None    # Outbox entry for the DTO instead of pushing it.
+        self.error = None     # Set by the first stage that failed.
+
+
+def enrich_things_pipeline(session: sqlalchemy.orm.session.Session,
+                           base_url: str,
+                           metasys_bearer: BearerToken,
+                           entrasso_bearer: EntraSSOToken,
+                           refresh: bool,
+                           item_prefix: str = None,
+                           fetch_workers: int = 4,
+                           push_workers: int = 4,
+                           limiter: RateLimiter = None,
+                           bas_limiter: RateLimiter = None,
+                           queue_size: int = 100,
+                           write_batch: int = WRITE_BATCH_SIZE,
+                           write_interval: float = WRITE_BATCH_INTERVAL,
+                           schedule: bool = False,
+                           time_budget: float = None,
+                           force_push: bool = False,
+                           shard: Shard = None,
+                           lease: CrawlLease = None,
+                           outbox: bool = False,
+                           archive: ResponseArchive = None,
+                           nae_cap: int = None) -> None:
+    """ Deep crawl as a pipeline: fetch -> transform -> push -> persist.
+
+    Every stage has its own workers and a bounded inbox so a slow Bas holds
+    back the Metasys fetching and the other way around. A failed object skips
+    the rest of the stages and goes straight to persist, the only stage
+    touching the database, which writes the results in batches.
+
+    The candidates are streamed through a session of their own while the
+    persist stage writes through the one passed in. Scheduling, sharding,
+    leasing, change detection, the outbox and the archive work as in
+    enrich_things(), the NAE cap as in enrich_things_async()."""
+    deadline = crawl_deadline(time_budget)
+    total_objects = count_crawl_candidates(session, refresh, item_prefix, schedule, shard)
+    # Load the types and the building map up front so the transform stage doesn't need the session.
+    load_lookups(session)
+    # Hand the connection back. The persist stage picks up a fresh one in its own thread.
+    session.commit()
+    progress = itertools.count(1)
+
+    def fetch(task: CrawlTask) -> CrawlTask:
+        item_object = task.item_object
+        logging.info(f"Enriching object {item_object.id} - {item_object.name} "
+                     f"({next(progress)}/{total_objects})")
+        try:
+            task.real_estate = metasysid_to_real_estate(item_object.itemReference)
+            task.fetched = fetch_object(base_url, metasys_bearer, item_object, limiter,
+                                        force_push, nae_limiter, archive, task.real_estate)
+            item_object.lastCrawl = datetime.now(timezone.utc)
+        except Exception as exception:  # pylint: disable=broad-except
+            task.error = exception
+        return task
+
+    def transform(task: CrawlTask) -> CrawlTask:
+        if task.error is None:
+            text = task.fetched.text
+            task.digest = text and content_hash(text, task.real_estate)
+            task.unchanged = is_unchanged(task.item_object, task.fetched, task.digest, force_push)
+            if not task.unchanged:
+                try:
+                    task.bas = build_bas_dto(None, text, task.item_object,
+                                             real_estate=task.real_estate)
+                except DTO_ERRORS as exception:
+                    task.error = exception
+                if outbox and task.bas is not None:
+                    task.outbox, task.bas = outbox_entry(task.bas), None
+            # Not needed any more. Keep the queues lean.
+            task.fetched = task.fetched._replace(text=None)
+        return task
+
+    def push_stage(task: CrawlTask) -> CrawlTask:
+        if task.error is None and task.bas is not None:
+            try:
+                post_bas_dto(task.bas, entrasso_bearer, bas_limiter)
+            except requests.exceptions.RequestException as exception:
+                task.error = exception
+            task.bas = None
+        return task
+
+    def persist(tasks: list) -> None:
+        for task in tasks:
+            if task.error is not None:
+                record_error(task.item_object, task.error)
+            elif task.unchanged:
+                record_unchanged(task.item_object, task.fetched)
+            else:
+                record_success(task.item_object, task.digest, task.fetched, task.real_estate)
+        write_crawl_results(session, [task.item_object for task in tasks], lease and lease.owner,
+                            [task.outbox for task in tasks if task.outbox is not None])
+
+    # The objects are handled by the worker threads. They are detached so
+    # nothing triggers lazy loads from other threads.
+    reader = db_session(session.get_bind())
+    candidates, nae_limiter = nae_fairness(
+        candidate_stream(reader, refresh, item_prefix, schedule, deadline, shard, lease), nae_cap)
+    pipeline = Pipeline([Stage('fetch', fetch, fetch_workers, queue_size),
+                         Stage('transform', transform, 1, queue_size),
+                         Stage('push', push_stage, push_workers, queue_size),
+                         BatchStage('persist', persist, write_batch, write_interval, queue_size)],
+                        reporters=[reporter.summary for reporter in
+                                   (limiter, bas_limiter, nae_limiter, retry) if reporter])
+    # Log in up front so the workers don't all try at once.
+    metasys_bearer.validate()
+    if not outbox:
+        entrasso_bearer.validate()
+    try:
+        pipeline.run(CrawlTask(item_object) for item_object in candidates)
+    finally:
+        reader.close()
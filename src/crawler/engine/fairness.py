@@ -0,0 +1,74 @@
+"""Fair sharing of Metasys between the controllers behind it. Metasys proxies
+object reads to the NAEs in the field, so a slow NAE holds up every request
+sent its way and a burst of requests to one NAE can overload it. interleave()
+spreads the work out over the NAEs and KeyedLimiter caps how many requests
+each of them has in flight at once."""
+
+import collections
+import contextlib
+import threading
+from typing import Callable, Hashable, Iterable
+
+
+def interleave(items: Iterable, key: Callable, window: int = 500):
+    """ Yield the items round-robin over the groups given by key(item), ie
+    a1 b1 c1 a2 b2 a3 for the groups a, b and c. At most `window` items are
+    read ahead, so memory stays bounded and a lazy source stays lazy, but
+    only the items within the window are interleaved. """
+    groups = collections.OrderedDict()  # Rotated as we go. The next group is at the front.
+    iterator = iter(items)
+    buffered = 0
+    exhausted = False
+    while True:
+        while not exhausted and buffered < window:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                exhausted = True
+                break
+            groups.setdefault(key(item), collections.deque()).append(item)
+            buffered += 1
+        if not groups:
+            return
+        group_key, group = groups.popitem(last=False)
+        if len(group) > 1:
+            groups[group_key] = group  # Back of the line.
+        buffered -= 1
+        yield group.popleft()
+
+
+class KeyedLimiter:
+    """ Thread safe cap on how many callers can hold the same key at once. """
+    cap: int
+
+    def __init__(self, cap: int, name: str = 'key'):
+        if cap < 1:
+            raise ValueError(f"Cap must be at least 1, got {cap}")
+        self.cap = cap
+        self.name = name
+        self.waits = 0  # Times a caller had to wait for its turn.
+        self._in_flight = collections.Counter()
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def hold(self, key: Hashable):
+        """ Block until there are less than `cap` holders of the key, and hold it. """
+        with self._condition:
+            if self._in_flight[key] >= self.cap:
+                self.waits += 1
+            while self._in_flight[key] >= self.cap:
+                self._condition.wait()
+            self._in_flight[key] += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_flight[key] -= 1
+                if not self._in_flight[key]:
+                    del self._in_flight[key]
+                self._condition.notify_all()
+
+    def summary(self) -> str:
+        with self._condition:
+            busy = len(self._in_flight)
+        return f"Max {self.cap} in flight per {self.name}: {busy} busy, {self.waits} waits"
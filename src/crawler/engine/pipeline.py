@@ -0,0 +1,223 @@
+"""Staged pipeline for the deep crawl. Each stage is a pool of worker threads
+reading from a bounded queue and handing its results to the next stage's
+queue. A full queue blocks the stage in front of it, so a slow stage holds
+back the ones feeding it instead of piling up work in memory.
+
+Each stage keeps count of what it has done and the pipeline logs the queue
+depth and throughput of every stage, which shows where the bottleneck is."""
+
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Iterable
+
+_DONE = object()     # End of stream marker passed down the stages.
+_TIMEOUT = object()  # Returned by Pipeline.get() when the wait runs out.
+_POLL = 0.5          # Seconds between checks for an aborted pipeline while blocked.
+
+
+class PipelineAborted(Exception):
+    """ Raised in the workers when another part of the pipeline has failed. """
+
+
+class Stage:
+    """ A pool of worker threads running handle(item) on everything that
+    arrives in the inbox. Whatever handle() returns is passed on to the next
+    stage unless it is None. """
+    name: str
+    workers: int
+
+    def __init__(self, name: str, handle: Callable, workers: int = 1, queue_size: int = 100):
+        self.name = name
+        self.handle = handle
+        self.workers = workers
+        self.inbox = queue.Queue(maxsize=queue_size)
+        self.next = None  # Set up by the Pipeline.
+        self.processed = 0
+        self._lock = threading.Lock()
+        self._running = workers
+
+    def _count(self, items: int) -> None:
+        with self._lock:
+            self.processed += items
+
+    def _forward(self, pipeline, item) -> None:
+        if self.next is not None and item is not None:
+            pipeline.put(self.next.inbox, item)
+
+    def _finish(self, pipeline) -> None:
+        """ The last worker out tells every worker of the next stage to stop. """
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        if last and self.next is not None:
+            for _ in range(self.next.workers):
+                pipeline.put(self.next.inbox, _DONE)
+
+    def work(self, pipeline) -> None:
+        """ Worker thread main loop. """
+        while True:
+            item = pipeline.get(self.inbox)
+            if item is _DONE:
+                break
+            result = self.handle(item)
+            self._count(1)
+            self._forward(pipeline, result)
+        self._finish(pipeline)
+
+    def report(self, elapsed: float) -> str:
+        rate = self.processed / elapsed if elapsed > 0 else 0.0
+        return (f"{self.name}: queue {self.inbox.qsize()}/{self.inbox.maxsize}, "
+                f"{self.processed} done ({rate:.1f}/s)")
+
+
+class BatchStage(Stage):
+    """ Single worker stage collecting items and handing them to
+    handle(list) once batch_size items have arrived or max_wait seconds
+    have passed since the first one. Whatever is left is flushed at the end. """
+
+    def __init__(self, name: str, handle: Callable, batch_size: int = 100, max_wait: float = 5.0,
+                 queue_size: int = 100):
+        super().__init__(name, handle, workers=1, queue_size=queue_size)
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+
+    def _flush(self, pipeline, batch: list) -> None:
+        result = self.handle(batch)
+        self._count(len(batch))
+        self._forward(pipeline, result)
+
+    def _drain(self) -> list:
+        """ The items left in the inbox when the pipeline is aborted. """
+        items = []
+        while True:
+            try:
+                item = self.inbox.get_nowait()
+            except queue.Empty:
+                return items
+            if item is not _DONE:
+                items.append(item)
+
+    def work(self, pipeline) -> None:
+        batch = []
+        deadline = None
+        try:
+            while True:
+                timeout = max(0.0, deadline - time.monotonic()) if batch else None
+                item = pipeline.get(self.inbox, timeout)
+                if item is _DONE:
+                    break
+                if item is not _TIMEOUT:
+                    batch.append(item)
+                    deadline = deadline or time.monotonic() + self.max_wait
+                if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                    pending, batch = batch, []  # Not handled again below if the handler fails.
+                    self._flush(pipeline, pending)
+                    deadline = None
+        except PipelineAborted:
+            # What made it this far is done with, ie pushed to Bas. Don't lose it.
+            batch.extend(self._drain())
+            raise
+        finally:
+            if batch:
+                self._flush(pipeline, batch)
+        self._finish(pipeline)
+
+
+class Pipeline:
+    """ Chains the stages together and runs them. If any stage raises,
+    everything is stopped and the exception is re-raised from run(). """
+
+    def __init__(self, stages: list, report_interval: float = 30.0, reporters: list = None):
+        """ reporters are callables returning a line to log along with the stage reports. """
+        self.stages = stages
+        self.reporters = reporters or []
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next = next_stage
+        self.report_interval = report_interval
+        self._stop = threading.Event()
+        self._failure = None
+        self._started = None
+
+    def abort(self, name: str, exception: BaseException) -> None:
+        if self._failure is None:
+            logging.error(f"Pipeline {name} failed: {exception!r}")
+            self._failure = exception
+        self._stop.set()
+
+    def put(self, inbox: queue.Queue, item) -> None:
+        """ Blocking put that gives up if the pipeline has been aborted. """
+        while True:
+            if self._stop.is_set():
+                raise PipelineAborted()
+            try:
+                inbox.put(item, timeout=_POLL)
+                return
+            except queue.Full:
+                continue
+
+    def get(self, inbox: queue.Queue, timeout: float = None):
+        """ Blocking get that gives up if the pipeline has been aborted.
+        Returns _TIMEOUT if nothing arrived within timeout seconds. """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self._stop.is_set():
+                raise PipelineAborted()
+            wait = _POLL if deadline is None else min(_POLL, max(0.0, deadline - time.monotonic()))
+            try:
+                return inbox.get(timeout=wait)
+            except queue.Empty:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return _TIMEOUT
+
+    def _run_worker(self, stage: Stage) -> None:
+        try:
+            stage.work(self)
+        except PipelineAborted:
+            pass
+        except BaseException as exception:  # pylint: disable=broad-except
+            # SystemExit included. The thread would otherwise die silently and hang the pipeline.
+            self.abort(f"stage {stage.name}", exception)
+
+    def report(self) -> None:
+        elapsed = time.monotonic() - self._started
+        for stage in self.stages:
+            logging.info(f"Pipeline {stage.report(elapsed)}")
+        for reporter in self.reporters:
+            logging.info(reporter())
+
+    def _reporter(self, done: threading.Event) -> None:
+        while not done.wait(self.report_interval):
+            self.report()
+
+    def run(self, items: Iterable) -> None:
+        """ Feed the items through the stages and wait for all of them to finish. """
+        self._started = time.monotonic()
+        threads = [threading.Thread(target=self._run_worker, args=(stage,),
+                                    name=f"{stage.name}-{idx}", daemon=True)
+                   for stage in self.stages for idx in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+        done = threading.Event()
+        reporter = threading.Thread(target=self._reporter, args=(done,), name="pipeline-report",
+                                    daemon=True)
+        reporter.start()
+        first = self.stages[0]
+        try:
+            for item in items:
+                self.put(first.inbox, item)
+            for _ in range(first.workers):
+                self.put(first.inbox, _DONE)
+        except PipelineAborted:
+            pass
+        except BaseException as exception:
+            self.abort("source", exception)
+        finally:
+            for thread in threads:
+                thread.join()
+            done.set()
+            reporter.join()
+        self.report()
+        if self._failure is not None:
+            raise self._failure
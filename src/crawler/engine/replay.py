@@ -0,0 +1,57 @@
+"""Replaying the Metasys responses a deep crawl archived (db/archive.py) to
+Bas, without crawling Metasys again."""
+
+import collections
+import json
+import logging
+from functools import partial
+
+import sqlalchemy
+
+from db.archive import CorruptRecord, ResponseArchive
+from db.base import IN_CLAUSE_CHUNK_SIZE
+from db.models import MetasysObject
+from metadata.lookups import load_lookups
+from model.dto import DTO_ERRORS, build_bas_dto
+from sink.base import Sink
+
+
+def replay_archive(session: sqlalchemy.orm.session.Session,
+                   archive: ResponseArchive,
+                   sink: Sink,
+                   item_prefix: str = None) -> collections.Counter:
+    """ Push the archived responses to Bas again without asking Metasys, ie
+    after Bas has lost data or the DTO mapping has changed. Builds the DTOs
+    as push_response_to_bas() does and hands them to the sink, ie a BasSink
+    or an NdjsonSink for a dry run. The metadata for the DTOs comes from the
+    database, so objects that aren't there are skipped, as are the ones
+    outside item_prefix. Returns the number of objects pushed, failed and skipped. """
+    counts = collections.Counter()
+    load_lookups(session)
+
+    def delivered(object_id: str, error: Exception) -> None:
+        if error is None:
+            counts['pushed'] += 1
+        else:
+            logging.error(f"Replaying {object_id} failed: {error}")
+            counts['failed'] += 1
+
+    object_ids = archive.ids()
+    for chunk in (object_ids[i:i + IN_CLAUSE_CHUNK_SIZE]
+                  for i in range(0, len(object_ids), IN_CLAUSE_CHUNK_SIZE)):
+        query = session.query(MetasysObject).filter(MetasysObject.id.in_(chunk))
+        if item_prefix:
+            query = query.filter(MetasysObject.itemReference.startswith(item_prefix))
+        item_objects = {item_object.id: item_object for item_object in query}
+        counts['skipped'] += len(chunk) - len(item_objects)
+        for object_id in chunk:
+            if object_id in item_objects:
+                try:
+                    bas = build_bas_dto(session, archive.get(object_id), item_objects[object_id])
+                except DTO_ERRORS + (CorruptRecord,) as exception:
+                    delivered(object_id, exception)
+                    continue
+                sink.put(bas.realEstate, json.dumps(bas.as_dict()), partial(delivered, object_id))
+        session.expunge_all()  # Done with this lot. Don't let the identity map grow.
+    sink.flush()
+    return counts
@@ -0,0 +1,77 @@
+"""What the Bas DTOs are looked up in: the building -> real estate resolver
+and the object type descriptions. Both are loaded at the start of a crawl
+and shared read-only by its workers from then on."""
+
+import threading
+
+import click
+import sqlalchemy
+
+from db.enumsets import TypeDescriptions, load_type_descriptions
+from db.models import BuildingMapping
+from . import resolver
+from .buildingmap import BUILDING_MAP
+from .resolver import RealEstateResolver
+
+
+_real_estates = None
+_real_estates_lock = threading.Lock()
+
+
+def real_estate_resolver(session: sqlalchemy.orm.session.Session = None,
+                         reload: bool = False) -> RealEstateResolver:
+    """The building -> real estate resolver, built on first use or when
+    reload is set, ie at the start of a crawl. BUILDING_MAP is overridden
+    by the buildingMap table, if there's a session to read it with, and by
+    the --building-map file. See metadata/resolver.py. """
+    global _real_estates  # pylint: disable=global-statement
+    with _real_estates_lock:
+        if _real_estates is None or reload:
+            overrides = {} if session is None else \
+                {mapping.building: mapping.realEstate for mapping in session.query(BuildingMapping)}
+            _real_estates = RealEstateResolver(BUILDING_MAP, overrides, resolver.file_overrides())
+        return _real_estates
+
+
+def metasysid_to_real_estate(metasysid: str) -> str:
+    """Takes something like 'GP-SXD9E-113:SOKP16-NAE4/FCB.434_121-1OU001.VAVmaks4'
+    and spits out 'kjorbo' using the real estate resolver.
+
+    This is used when we push data into the Bas API.
+
+    """
+    return real_estate_resolver().resolve(metasysid)
+
+
+_type_descriptions = None
+_type_descriptions_lock = threading.Lock()
+
+
+def type_descriptions(session: sqlalchemy.orm.session.Session = None,
+                      reload: bool = False) -> TypeDescriptions:
+    """The object type descriptions, read from the database on first use
+    or when reload is set, ie at the start of a crawl. Shared read-only by
+    all the workers from then on. """
+    global _type_descriptions  # pylint: disable=global-statement
+    with _type_descriptions_lock:
+        if _type_descriptions is None or reload:
+            if session is None:
+                raise RuntimeError("The object type descriptions haven't been loaded")
+            _type_descriptions = load_type_descriptions(session)
+        return _type_descriptions
+
+
+def get_type_description(session: sqlalchemy.orm.session.Session, object_type: int) -> str:
+    """Returns the string representation of the object type. Raises
+    UnknownObjectType if there is none, which fails the object. """
+    return type_descriptions(session)[object_type]
+
+
+def load_lookups(session: sqlalchemy.orm.session.Session) -> None:
+    """ Load the type descriptions and the building map for a crawl, before the workers start.
+    Without any type descriptions every object would fail, so the crawl stops right away. """
+    if not type_descriptions(session, reload=True):
+        raise click.ClickException("There are no object type descriptions in the database. "
+                                   "Fetch the enumsets from Metasys (507 and 508) with "
+                                   "crawler get-enumset first.")
+    real_estate_resolver(session, reload=True)
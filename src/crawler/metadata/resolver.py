@@ -0,0 +1,94 @@
+"""Resolves the itemReferences of the Metasys objects to Bas real estates.
+
+An itemReference starts with the site and the building, ie
+'GP-SXD9E-113:SOKP16-NAE4/FCB.434_121-1OU001.VAVmaks4' is building SOKP16
+at site GP-SXD9E-113. The building is looked up in the static BUILDING_MAP
+and the overrides on top of it, ie the buildingMap table and a JSON file of
+{building: real estate} set with configure(), so buildings can be added or
+moved without a code change. The outcome is remembered per site and building.
+
+A building that isn't mapped goes to UNKNOWN_REAL_ESTATE. It is warned
+about once and counted, and summary() reports them all together."""
+
+import collections
+import json
+import logging
+import re
+import threading
+
+UNKNOWN_REAL_ESTATE = 'ukjent'
+
+_PREFIX = re.compile(r'^([^:]+):([^-]+)')  # Site and building.
+_overrides_file = None
+
+
+class InvalidItemReference(ValueError):
+    """ An itemReference without a site and a building in it. """
+
+
+class RealEstateResolver:
+    """ itemReference -> real estate. Thread safe. """
+
+    def __init__(self, *maps: dict):
+        """ maps are {building: real estate}, each overriding the ones before it. """
+        self._map = {}
+        for mapping in maps:
+            self._map.update(mapping or {})
+        self._memo = {}  # Site and building -> (real estate, the building if it isn't mapped).
+        self.unmapped = collections.Counter()  # Objects per building that isn't mapped.
+        self._lock = threading.Lock()
+
+    def _lookup(self, building: str) -> tuple:
+        real_estate = self._map.get(building)
+        if real_estate is not None:
+            return real_estate, None
+        logging.warning(f"Can't find building {building} in the building map. Its objects go to "
+                        f"{UNKNOWN_REAL_ESTATE}. Please update BUILDING_MAP or the overrides.")
+        return UNKNOWN_REAL_ESTATE, building
+
+    def resolve(self, item_reference: str) -> str:
+        """ The real estate for an itemReference. InvalidItemReference if it isn't one. """
+        match = _PREFIX.match(item_reference or '')
+        if match is None:
+            raise InvalidItemReference(f"Could not make sense of itemReference {item_reference}")
+        prefix = match.group(0)
+        resolved = self._memo.get(prefix)
+        if resolved is None:
+            with self._lock:
+                resolved = self._memo.get(prefix)
+                if resolved is None:
+                    resolved = self._memo[prefix] = self._lookup(match.group(2))
+        real_estate, unmapped = resolved
+        if unmapped is not None:
+            with self._lock:
+                self.unmapped[unmapped] += 1
+        return real_estate
+
+    def resolve_many(self, item_references) -> list:
+        """ The real estates for a batch of itemReferences, in order. """
+        return [self.resolve(item_reference) for item_reference in item_references]
+
+    def summary(self) -> str:
+        unmapped = ', '.join(f"{building} ({objects} objects)"
+                             for building, objects in self.unmapped.most_common())
+        return (f"Real estates: {len(self._map)} buildings mapped, "
+                f"{len(self._memo)} sites/buildings seen"
+                f"{f', not mapped: {unmapped}' if unmapped else ''}")
+
+
+def configure(overrides_file: str = None) -> None:
+    """ Override the building map with the {building: real estate} JSON file at overrides_file. """
+    global _overrides_file  # pylint: disable=global-statement
+    _overrides_file = overrides_file
+
+
+def file_overrides() -> dict:
+    """ The overrides from the file set up by configure(), if any. """
+    if not _overrides_file:
+        return {}
+    with open(_overrides_file) as fh:
+        overrides = json.load(fh)
+    if not isinstance(overrides, dict):
+        raise ValueError(f"Expected {{building: real estate}} in {_overrides_file}")
+    logging.info(f"Loaded {len(overrides)} building overrides from {_overrides_file}")
+    return overrides
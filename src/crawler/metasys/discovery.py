@@ -0,0 +1,255 @@
+"""Discovery: walking the /objects listing of Metasys a type at a time and
+storing the objects for the deep crawl. Every page stored is checkpointed,
+so a discovery that dies can be resumed where it stopped."""
+
+import collections
+import itertools
+import logging
+import math
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone, datetime
+
+import sqlalchemy
+
+from auth.metasysbearer import BearerToken
+from db.base import IN_CLAUSE_CHUNK_SIZE
+from db.models import MetasysObject, DiscoveryCheckpoint
+from net.ratelimit import RateLimiter
+from net.upstreams import METASYS, send
+
+OBJECTS_PAGE_SIZE = 1000  # Max page size for the /objects listing.
+
+
+def get_uuid_from_url(url: str) -> str:
+    """ Strip the URL from the string. Returns the UUID. """
+    return url.split('/')[-1]
+
+
+def _object_row(item: dict, object_type: int, discovered: datetime) -> dict:
+    """ Map an item from the /objects listing to a metasysCrawl row. """
+    parent_url = item["parentUrl"]
+    if parent_url:
+        parent_id = get_uuid_from_url(parent_url)
+    else:
+        parent_id = None
+
+    return dict(id=item["id"],
+                parentId=parent_id,
+                itemReference=item["itemReference"],
+                name=item["name"],
+                discovered=discovered,
+                type=object_type
+                )
+
+
+def insert_objects(session: sqlalchemy.orm.session.Session, items: list, object_type: int) -> int:
+    """ Insert a page of items into the database, leaving the ones we already have alone.
+
+    This does one existence check for the whole page, one bulk insert and
+    one commit. Returns the number of rows inserted."""
+    page_ids = list({item["id"] for item in items})
+    known_ids = set()
+    for offset in range(0, len(page_ids), IN_CLAUSE_CHUNK_SIZE):
+        chunk = page_ids[offset:offset + IN_CLAUSE_CHUNK_SIZE]
+        query = session.query(MetasysObject.id).filter(MetasysObject.id.in_(chunk))
+        known_ids.update(row[0] for row in query)
+
+    discovered = datetime.now(timezone.utc)
+    rows = []
+    for item in items:
+        obj_id = item["id"]
+        if obj_id in known_ids:
+            logging.debug(f"Ignoring {obj_id} as we've already discovered it.")
+            continue
+        known_ids.add(obj_id)  # Guards against duplicates within the page.
+        rows.append(_object_row(item, object_type, discovered))
+
+    if rows:
+        logging.info(f"Inserting {len(rows)} new objects of type {object_type}")
+        session.bulk_insert_mappings(MetasysObject, rows)
+    session.commit()
+    return len(rows)
+
+
+def _get_objects_page(base_url: str, bearer: BearerToken, object_type: int, page: int,
+                      limiter: RateLimiter = None) -> dict:
+    """ Fetch a single page of the /objects listing. """
+    resp = send(limiter, METASYS, 'get',
+                base_url + f"/objects?page={page}&type={object_type}"
+                           f"&pageSize={OBJECTS_PAGE_SIZE}&sort=name",
+                auth=bearer)
+    return resp.json()
+
+
+def _prefetch_object_pages(base_url: str, bearer: BearerToken, object_type: int, pages: range,
+                           limiter: RateLimiter, window: int):
+    """ Fetch the given pages concurrently, at most `window` ahead of the consumer.
+    Yields (page, json_response) in page order. """
+    pages = iter(pages)
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        pending = collections.deque(
+            (page, executor.submit(_get_objects_page, base_url, bearer, object_type, page, limiter))
+            for page in itertools.islice(pages, window))
+        while pending:
+            page, future = pending.popleft()
+            json_response = future.result()
+            next_page = next(pages, None)
+            if next_page is not None:
+                pending.append((next_page, executor.submit(_get_objects_page, base_url, bearer,
+                                                           object_type, next_page, limiter)))
+            yield page, json_response
+
+
+def fetch_object_pages(base_url: str, bearer: BearerToken, object_type: int,
+                       limiter: RateLimiter = None, prefetch: int = 1,
+                       skip_pages: set = frozenset()):
+    """ Generator walking the /objects listing for a type. Yields (page, items, last_page).
+
+    With prefetch > 1 the page count is worked out from the "total" in the
+    first response and the rest of the pages are fetched concurrently, with
+    up to `prefetch` pages in flight. Pages are still yielded in order.
+    Pages in skip_pages are not fetched. """
+    page = 1
+    while True:
+        if page in skip_pages:
+            page = page + 1
+            continue
+        json_response = _get_objects_page(base_url, bearer, object_type, page, limiter)
+        logging.info(f"Working on page ({page} - {len(json_response['items'])} items")
+        yield page, json_response["items"], json_response["next"] is None
+        if json_response["next"] is None:  # the last page has a none link to next.
+            break
+        last_page = math.ceil(json_response.get("total", 0) / OBJECTS_PAGE_SIZE)
+        if prefetch > 1 and last_page > page + 1:
+            logging.info(f"Prefetching pages {page + 1} to {last_page} of type {object_type}")
+            pages = [idx for idx in range(page + 1, last_page + 1) if idx not in skip_pages]
+            for page, json_response in _prefetch_object_pages(base_url, bearer, object_type,
+                                                              pages, limiter, prefetch):
+                logging.info(f"Working on page ({page} - {len(json_response['items'])} items")
+                yield page, json_response["items"], json_response["next"] is None
+                if json_response["next"] is None:
+                    return
+            # The total grew while we were at it. Carry on one page at a time.
+            page = last_page
+        page = page + 1
+
+
+def load_checkpoints(session: sqlalchemy.orm.session.Session) -> dict:
+    """ Returns the completed discovery pages as {object_type: {page: last_page}}. """
+    checkpoints = collections.defaultdict(dict)
+    for checkpoint in session.query(DiscoveryCheckpoint):
+        checkpoints[checkpoint.objectType][checkpoint.page] = checkpoint.lastPage
+    return checkpoints
+
+
+def ingest_page(session: sqlalchemy.orm.session.Session, object_type: int, page: int,
+                items: list, last_page: bool) -> int:
+    """ Store a page of the listing and checkpoint it in the same transaction. """
+    session.merge(DiscoveryCheckpoint(objectType=object_type,
+                                      page=page,
+                                      completedAt=datetime.now(timezone.utc),
+                                      itemCount=len(items),
+                                      lastPage=last_page))
+    return insert_objects(session, items, object_type)  # Commits.
+
+
+def _pages_to_skip(checkpoints: dict, object_type: int):
+    """ Returns the pages of a type we can skip when resuming or None if the type is done. """
+    if not checkpoints:
+        return frozenset()
+    completed = checkpoints.get(object_type, {})
+    if any(completed.values()):
+        return None
+    return frozenset(completed)
+
+
+def get_objects(session: sqlalchemy.orm.session.Session, base_url: str,
+                bearer: BearerToken, object_type: int,
+                limiter: RateLimiter = None, prefetch: int = 1, checkpoints: dict = None):
+    """ Get the list of objects from Metasys and store them in the database.
+    Pass the checkpoints from load_checkpoints() to skip the pages we already have."""
+    skip_pages = _pages_to_skip(checkpoints, object_type)
+    if skip_pages is None:
+        logging.info(f"Type {object_type} has already been discovered. Skipping.")
+        return
+    for page, items, last_page in fetch_object_pages(base_url, bearer, object_type,
+                                                     limiter, prefetch, skip_pages):
+        inserted = ingest_page(session, object_type, page, items, last_page)
+        logging.info(f"Page({page}) complete. {inserted} new objects.")
+
+
+def discover_objects(session: sqlalchemy.orm.session.Session, base_url: str,
+                     bearer: BearerToken, object_types: list, concurrency: int,
+                     limiter: RateLimiter, prefetch: int = 1, checkpoints: dict = None):
+    """ Discover several object types at once.
+
+    A pool of threads fetches the types, sharing the limiter. The pages are
+    handed over through a bounded queue to this thread, which does all the
+    database writes. Pages for a given type arrive in order as a single
+    worker walks through them."""
+    pages = queue.Queue(maxsize=concurrency * 2)
+    stop = threading.Event()
+
+    def hand_over(entry) -> None:
+        # Give up if the writer has died, otherwise we'd block forever on a full queue.
+        while not stop.is_set():
+            try:
+                pages.put(entry, timeout=1.0)
+                return
+            except queue.Full:
+                continue
+
+    def worker(object_type: int) -> None:
+        try:
+            for page, items, last_page in fetch_object_pages(base_url, bearer, object_type,
+                                                             limiter=limiter, prefetch=prefetch,
+                                                             skip_pages=skip_pages[object_type]):
+                if stop.is_set():
+                    return
+                hand_over((object_type, page, (items, last_page)))
+        except Exception:
+            logging.error(f"Discovery of type {object_type} failed.")
+            raise
+        finally:
+            hand_over((object_type, None, None))  # Tell the writer we're done with this type.
+
+    skip_pages = {object_type: _pages_to_skip(checkpoints, object_type)
+                  for object_type in object_types}
+    finished = [object_type for object_type, skip in skip_pages.items() if skip is None]
+    if finished:
+        logging.info(f"Skipping types that have already been discovered: {finished}")
+    object_types = [object_type for object_type in object_types
+                    if skip_pages[object_type] is not None]
+
+    bearer.validate()  # Log in once up front rather than in every worker.
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(worker, object_type) for object_type in object_types]
+        try:
+            remaining = len(futures)
+            while remaining:
+                object_type, page, payload = pages.get()
+                if page is None:
+                    remaining -= 1
+                    continue
+                inserted = ingest_page(session, object_type, page, *payload)
+                logging.info(f"Type {object_type} page({page}) complete. {inserted} new objects.")
+        finally:
+            stop.set()
+    for future in futures:
+        future.result()  # Surface any worker exceptions.
+
+
+def count_object_by_type(base_url: str, bearer: BearerToken, limiter: RateLimiter, start: int,
+                         finish: int):
+    """ Used to list counts of different object types in the API. Used during exploration. """
+    logging.info(f"Starting count {start} --> {finish} on {base_url}")
+    logging.info("We ignore types with 0 entries so it'll take some time before you see output.")
+    print('type,count', flush=True)
+    for type_idx in range(start, finish):
+        resp = send(limiter, METASYS, 'get', base_url + f"/objects?type={type_idx}", auth=bearer)
+        json_resp = resp.json()
+        total = json_resp["total"]
+        if total > 0:
+            print(f'{type_idx},{total}', flush=True)
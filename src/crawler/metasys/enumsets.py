@@ -0,0 +1,116 @@
+"""The enumsets with the descriptions of the object types, fetched from
+Metasys and stored for the deep crawl. db/enumsets.py reads them back."""
+
+import collections
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlalchemy
+
+from auth.metasysbearer import BearerToken
+from db.base import IN_CLAUSE_CHUNK_SIZE
+from db.models import EnumSet, EnumSetTotal
+from net.ratelimit import RateLimiter
+from net.upstreams import METASYS, send
+
+ENUMSETS = (507, 508)  # The enumsets with the object type descriptions.
+ENUMSET_PAGE_SIZE = 1000  # Members per page of an enumset.
+
+
+def _get_enumset_page(base_url: str, bearer: BearerToken, enumset: int, page: int,
+                      limiter: RateLimiter = None, page_size: int = ENUMSET_PAGE_SIZE) -> dict:
+    """ Fetch a page of the members of an enumset. """
+    resp = send(limiter, METASYS, 'get',
+                base_url + f'/enumSets/{enumset}/members?page={page}&pageSize={page_size}',
+                auth=bearer)
+    resp.raise_for_status()
+    return resp.json()
+
+
+# The members of an enumset, a list per page, and how many the server said it has.
+EnumSetFetch = collections.namedtuple('EnumSetFetch', ['total', 'pages'])
+
+
+def enumset_total(base_url: str, bearer: BearerToken, enumset: int,
+                  limiter: RateLimiter = None) -> int:
+    """ The number of members of an enumset on the server. A one member page
+    is enough to get it. """
+    return _get_enumset_page(base_url, bearer, enumset, 1, limiter, page_size=1)['total']
+
+
+def fetch_enumset(base_url: str, bearer: BearerToken, enumset: int,
+                  limiter: RateLimiter = None) -> EnumSetFetch:
+    """ Fetch the members of an enumset. """
+    pages = []
+    page = 1
+    while True:
+        logging.info(f'Getting enumset {enumset} page {page}')
+        json_response = _get_enumset_page(base_url, bearer, enumset, page, limiter)
+        pages.append(json_response['items'])
+        if json_response["next"] is None:  # the last page has a none link to next.
+            return EnumSetFetch(json_response['total'], pages)
+        page = page + 1
+
+
+def upsert_enumset_page(session: sqlalchemy.orm.session.Session, enumset: int, items: list) -> int:
+    """ Store a page of enumset members, replacing the ones we have. One
+    existence check, one bulk insert and update and one commit for the page.
+    Returns the number of members stored. """
+    rows = {item['id']: dict(id=item['id'], description=item['description'] or "", enumset=enumset)
+            for item in items}
+    page_ids = list(rows)
+    known_ids = set()
+    for offset in range(0, len(page_ids), IN_CLAUSE_CHUNK_SIZE):
+        chunk = page_ids[offset:offset + IN_CLAUSE_CHUNK_SIZE]
+        known_ids.update(row[0] for row in session.query(EnumSet.id).filter(EnumSet.id.in_(chunk)))
+    session.bulk_update_mappings(EnumSet, [row for enum_id, row in rows.items()
+                                           if enum_id in known_ids])
+    session.bulk_insert_mappings(EnumSet, [row for enum_id, row in rows.items()
+                                           if enum_id not in known_ids])
+    session.commit()
+    return len(rows)
+
+
+def grab_enumsets(base_url: str,
+                  bearer: BearerToken,
+                  dbsess: sqlalchemy.orm.session.Session,
+                  enumsets: list = ENUMSETS, limiter: RateLimiter = None,
+                  if_stale: bool = False) -> dict:
+    """This function gets invoked when running crawler get-enumset and it grabs the enumsets.
+    These are used to translate the type field into a somewhat meaningful string.
+
+    The enumsets are fetched concurrently and stored by this thread a page
+    per transaction, in the order they are given. A member in more than one
+    enumset ends up with the description from the last one, as the enumsets
+    share the table. The server's total of every enumset is kept along with
+    it. With if_stale the enumsets are left alone if the totals are the same
+    as last time. If any of them changed they are all fetched again, so the
+    shared members still get their descriptions in order. Returns the members
+    stored per enumset. """
+    known = {row.enumset: row.total for row in dbsess.query(EnumSetTotal)} if if_stale else {}
+    dbsess.commit()  # Don't sit on a transaction while fetching.
+    bearer.validate()  # Log in once up front rather than in every worker.
+    counts = {}
+    with ThreadPoolExecutor(max_workers=len(enumsets) or 1) as executor:
+        if if_stale:
+            futures = [(enumset, executor.submit(enumset_total, base_url, bearer, enumset,
+                                                 limiter))
+                       for enumset in enumsets]
+            stale = [enumset for enumset, future in futures
+                     if future.result() != known.get(enumset)]
+            if not stale:
+                logging.info(f"Enumsets {list(enumsets)} are up to date. Skipping.")
+                return counts
+            logging.info(f"Enumsets {stale} changed on the server. Refreshing all of "
+                         f"{list(enumsets)}.")
+        futures = [(enumset, executor.submit(fetch_enumset, base_url, bearer, enumset, limiter))
+                   for enumset in enumsets]
+        for enumset, future in futures:
+            fetched = future.result()
+            counts[enumset] = sum(upsert_enumset_page(dbsess, enumset, items)
+                                  for items in fetched.pages)
+            # After the members, so an enumset that didn't make it is stale next time.
+            dbsess.merge(EnumSetTotal(enumset=enumset, total=fetched.total))
+            dbsess.commit()
+            logging.info(f"Stored {counts[enumset]} members of enumset {enumset}")
+    return counts
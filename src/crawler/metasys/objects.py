@@ -0,0 +1,56 @@
+"""Fetching single objects from the Metasys API for the deep crawl. The
+fetch is conditional when we have the validators from the last one."""
+
+import collections
+import json
+
+from auth.metasysbearer import BearerToken
+from net.ratelimit import RateLimiter
+from net.upstreams import METASYS, send
+
+
+def validate_metasys_object(response: str):
+    """Validate that the JSON we get is valid JSON and doesn't
+    contain errors.
+
+    Throws ValueError upon failure. The JSON parser might also throw errors.
+    """
+
+    j = json.loads(response)
+    if 'message' in j:
+        raise ValueError(f'Error message found in response: {j["message"]}')
+
+    if 'item' not in j:
+        raise ValueError('No item in reponse.')
+
+
+# An object as fetched from Metasys along with the validators for the next fetch.
+# text is None if Metasys said the object hasn't changed (304 Not Modified).
+ObjectFetch = collections.namedtuple('ObjectFetch', ['text', 'etag', 'lastModified'])
+
+
+def fetch_metasys_object(base_url: str, metasys_bearer: BearerToken, object_id: str,
+                         limiter: RateLimiter = None, etag: str = None,
+                         last_modified: str = None) -> ObjectFetch:
+    """ Fetch a single object from Metasys and validate it. Throws exceptions.
+    Given the validators from an earlier fetch the request is conditional and
+    Metasys can skip sending an object that hasn't changed. """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    resp = send(limiter, METASYS, 'get', base_url + f"/objects/{object_id}",
+                headers=headers, auth=metasys_bearer)
+    if resp.status_code == 304:
+        # A 304 may or may not repeat the validators. Keep the ones we sent if not.
+        return ObjectFetch(None, resp.headers.get('ETag', etag),
+                           resp.headers.get('Last-Modified', last_modified))
+    validate_metasys_object(resp.text)  # Validate the response. Throws exceptions.
+    return ObjectFetch(resp.text, resp.headers.get('ETag'), resp.headers.get('Last-Modified'))
+
+
+def nae_of(item_reference: str) -> str:
+    """ The site and NAE an object lives on. 'GP-SXD9E-113:SOKP22-NAE4' for
+    'GP-SXD9E-113:SOKP22-NAE4/FCB.434_121-1OU001.VAVmaks4'. """
+    return (item_reference or '').split('/', 1)[0]
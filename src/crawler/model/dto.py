@@ -0,0 +1,63 @@
+"""Building the Bas DTO (bas.py) for an object from its Metasys response and
+what the crawl knows about it."""
+
+import base64
+import json
+import uuid
+from datetime import datetime
+
+import sqlalchemy
+
+from db.enumsets import UnknownObjectType
+from db.models import MetasysObject
+from metadata.lookups import get_type_description, metasysid_to_real_estate
+from metadata.resolver import InvalidItemReference
+from .bas import Bas
+
+# Objects that can't be mapped to a DTO. They fail on their own, the crawl carries on.
+DTO_ERRORS = (UnknownObjectType, InvalidItemReference)
+
+
+def _json_converter(whatever) -> str:
+    """Helper to match various types into something that the JSON lib can grok."""
+    if isinstance(whatever, datetime):
+        return whatever.utcnow().isoformat() + 'Z'  # somewhat of a hack. Forces UTC.
+    if isinstance(whatever, uuid.UUID):
+        return str(whatever)
+
+
+def b64_encode_response(metasysresp: str) -> str:
+    return base64.b64encode(metasysresp.encode('utf8')).decode('utf8')
+
+
+def build_bas_dto(session: sqlalchemy.orm.session.Session,
+                  metasysresp: str,         # Response string with item.
+                  metadata: MetasysObject,  # DBO
+                  type_description: str = None,
+                  real_estate: str = None
+                  ) -> Bas:
+    """ Build the Bas DTO for a single Response from the Metasys API.
+    The type description and the real estate are looked up unless they are given.
+    Raises one of DTO_ERRORS for an object that can't be mapped, which fails
+    that object. """
+    j = json.loads(metasysresp)
+    # Build the DTO useing model (model/bas.py)
+    return Bas(
+        id=metadata.id,  # id - get from item or metadata
+        # generate from building
+        realEstate=real_estate or metasysid_to_real_estate(metadata.itemReference),
+        parentId=metadata.parentId,  # from metadata or parse parentUrl
+        # Looked up from the enumsets.
+        type=type_description or get_type_description(session, metadata.type),
+        discovered=_json_converter(metadata.discovered),  # datetime        # metadata
+        lastCrawl=_json_converter(metadata.lastCrawl),  # metadata
+        lastError=_json_converter(metadata.lastError),  # metadata
+        successes=metadata.successes,  # metadata
+        errors=metadata.errors,  # metadata
+        # generate from response. just b64-encode the string.
+        response=b64_encode_response(metasysresp),
+        name=metadata.name,  # from item or metadata
+        itemReference=metadata.itemReference,  # from item or metadata
+        tfm=metadata.name,
+        description=j['item']['description']
+    )
@@ -0,0 +1,72 @@
+"""The Bas API. A DTO is POSTed to the real estate it belongs to, on its own
+or batched with others through a BasSink (sink/bas.py)."""
+
+import json
+import logging
+import os
+import sys
+
+import requests
+
+from auth.entrasso import EntraSSOToken
+from model.bas import Bas
+from sink.bas import BasSink, BATCH_SIZE as POST_BATCH_SIZE
+from .ratelimit import RateLimiter
+from .upstreams import BAS, send
+
+
+def _bas_url(real_estate: str) -> str:
+    try:
+        base_url = os.environ['ENTRAOS_BAS_BASEURL']
+    except KeyError:
+        logging.error("Environment variable ENTRAOS_BAS_BASEURL is not set")
+        sys.exit(1)
+    return f"{base_url}/metadata/bas/realestate/{real_estate}"
+
+
+def send_to_bas(real_estate: str, body, entrasso: EntraSSOToken,
+                limiter: RateLimiter = None, headers: dict = None) -> requests.Response:
+    """ POST a DTO serialized to JSON, or a request body made up by a sink,
+    to the Bas API. Retried as described in send(); the response is left
+    to the caller to check. """
+    return send(limiter, BAS, 'post', _bas_url(real_estate),
+                headers=headers or {'Content-Type': 'application/json'},
+                data=body.encode('utf-8') if isinstance(body, str) else body,
+                auth=entrasso)
+
+
+def bas_sink(entrasso: EntraSSOToken, limiter: RateLimiter = None,
+             post_batch: int = POST_BATCH_SIZE, concurrency: int = 4) -> BasSink:
+    """ Sink pushing to the Bas API, post_batch DTOs per POST. See sink/bas.py. """
+    entrasso.validate()  # Up front so the senders don't all try at once.
+
+    def post(real_estate: str, data: bytes, headers: dict) -> requests.Response:
+        return send_to_bas(real_estate, data, entrasso, limiter, headers)
+    return BasSink(post, batch_size=post_batch, concurrency=concurrency)
+
+
+class BasRejected(requests.exceptions.HTTPError):
+    """ Bas refused a DTO with a 4xx other than 429. Retrying it as is won't help. """
+
+
+def post_bas_dto(bas: Bas, entrasso: EntraSSOToken, limiter: RateLimiter = None) -> None:
+    """ POST a DTO to the Bas API. Raises if Bas is still failing after the
+    retries, so the object is tried again later, and BasRejected if Bas
+    refuses the DTO. Either way the object fails and the crawl carries on. """
+    url = _bas_url(bas.realEstate)
+    try:
+        resp = send_to_bas(bas.realEstate, json.dumps(bas.as_dict()), entrasso, limiter)
+    except requests.exceptions.RequestException as e:
+        logging.error(f'Request error while creating/sending request to Bas: {e}')
+        raise
+    if resp.status_code == 429 or resp.status_code >= 500:
+        # Bas is struggling. Not our fault, the object is pushed on a later crawl.
+        raise requests.exceptions.HTTPError(f'Got error ({resp.status_code}/{resp.reason}) '
+                                            f'POSTing to {url}', response=resp)
+    # Bas refused what we sent; that needs investigating.
+    if resp.status_code >= 400:
+        logging.error(f'Got error ({resp.status_code}/{resp.reason}) POSTing to {url}. '
+                      f'Bas refused the DTO for {bas.id}.')
+        raise BasRejected(f'Bas refused the DTO for {bas.id} ({resp.status_code}/{resp.reason})',
+                          response=resp)
+    logging.info("Object pushed to Bas")
@@ -0,0 +1,73 @@
+"""Shared HTTP client for the upstreams. Every upstream (Metasys, Bas and the
+SSO) gets one keep-alive requests.Session with a pool of connections, shared
+by all the threads of a crawl. A request then reuses a warm connection
+instead of paying for a TCP and TLS handshake every time.
+
+The sessions are created on first use with the settings from configure()."""
+
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_TIMEOUT = 30.0  # Seconds. Used unless a request gives its own timeout.
+DEFAULT_POOL_SIZE = 10  # Connections kept open per upstream.
+
+_settings = dict(pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, gzip=True)
+_sessions = {}
+_lock = threading.Lock()
+
+
+class UpstreamSession(requests.Session):
+    """ Keep-alive session for a single upstream with a default timeout.
+    Keeps count of the requests sent through it. """
+
+    def __init__(self, name: str, pool_size: int = DEFAULT_POOL_SIZE,
+                 timeout: float = DEFAULT_TIMEOUT, gzip: bool = True):
+        super().__init__()
+        self.name = name
+        self.timeout = timeout
+        self.requests = 0
+        # pool_block makes threads wait for a connection rather than open throwaway ones.
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.headers['Accept-Encoding'] = 'gzip, deflate' if gzip else 'identity'
+
+    def request(self, method, url, *args, **kwargs):  # pylint: disable=arguments-differ
+        kwargs.setdefault('timeout', self.timeout)
+        self.requests += 1
+        return super().request(method, url, *args, **kwargs)
+
+
+def configure(pool_size: int = None, timeout: float = None, gzip: bool = None) -> None:
+    """ Change the settings for the sessions. Sessions already handed out are
+    closed and new ones are created with the new settings on next use. """
+    with _lock:
+        for key, value in (('pool_size', pool_size), ('timeout', timeout), ('gzip', gzip)):
+            if value is not None:
+                _settings[key] = value
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+    logging.debug(f"HTTP client settings: {_settings}")
+
+
+def upstream(name: str) -> UpstreamSession:
+    """ The shared session for the upstream called name. """
+    with _lock:
+        if name not in _sessions:
+            _sessions[name] = UpstreamSession(name, **_settings)
+        return _sessions[name]
+
+
+def reserve(connections: int) -> None:
+    """ Make the pools big enough for `connections` requests in flight at once. """
+    if connections > _settings['pool_size']:
+        configure(pool_size=connections)
+
+
+def close_all() -> None:
+    """ Close every session and its connections. """
+    configure()
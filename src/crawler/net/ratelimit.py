@@ -0,0 +1,151 @@
+"""Rate limiting for the requests we send upstream. A single limiter is shared
+between all the threads of a crawl so the total request rate stays put
+regardless of the concurrency."""
+
+import collections
+import logging
+import threading
+import time
+
+import requests
+
+# Responses telling us the upstream is overloaded.
+OVERLOAD_STATUS_CODES = (429, 503)
+
+
+def _p95(latencies) -> float:
+    latencies = sorted(latencies)
+    if not latencies:
+        return 0.0
+    return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+
+class RateLimiter:
+    """ Thread safe token bucket. Every request takes one token; tokens are
+    added at `rate` per second up to `burst`. """
+    rate: float
+    burst: float
+
+    def __init__(self, rate: float, burst: float = 1.0, name: str = 'upstream'):
+        """ rate is in requests per second. """
+        if rate <= 0:
+            raise ValueError(f"Rate must be positive, got {rate}")
+        self.name = name
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        logging.info(f"Rate limiter for {name} created: {rate} requests/s (burst {self.burst})")
+
+    def _refill(self, now: float) -> None:
+        """ Add the tokens accrued since the last call. Call with the lock held. """
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self) -> None:
+        """ Block until we're allowed to send a request. """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def call(self, func, *args, **kwargs):
+        """ Wait for our turn and send the request, ie limiter.call(requests.get, url). """
+        self.acquire()
+        return func(*args, **kwargs)
+
+    def summary(self) -> str:
+        return f"Rate limiter for {self.name}: {self.rate:.2f} requests/s"
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """ Token bucket that adapts its rate AIMD style, like TCP congestion control.
+
+    Every `window` requests the latencies are looked at. If the p95 is below
+    latency_target and hasn't risen to twice the best p95 seen, the
+    rate goes up by `increase` requests/s. Otherwise it is multiplied by
+    `decrease`. A 429/503 response or a timeout cuts the rate right away, at
+    most once per `cooldown` seconds so a burst of rejected requests that
+    were already in flight only counts once. The rate stays within
+    [min_rate, max_rate]. """
+
+    def __init__(self, rate: float, min_rate: float = None, max_rate: float = None,
+                 increase: float = None, decrease: float = 0.5, latency_target: float = 2.0,
+                 window: int = 20, cooldown: float = 5.0, name: str = 'upstream'):
+        super().__init__(rate, name=name)
+        self.min_rate = min_rate or rate / 10
+        self.max_rate = max_rate or rate * 10
+        self.increase = increase or max(rate / 4, 0.1)
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.window = window
+        self.cooldown = cooldown
+        self.requests = 0
+        self.overloads = 0
+        self._latencies = collections.deque(maxlen=window)
+        self._since_adjust = 0
+        self._best_p95 = None
+        self._last_decrease = None
+
+    def p95(self) -> float:
+        """ 95th percentile latency of the last window of requests. """
+        with self._lock:
+            return _p95(self._latencies)
+
+    def _set_rate(self, rate: float, reason: str) -> None:
+        """ Call with the lock held. """
+        rate = min(self.max_rate, max(self.min_rate, rate))
+        if rate != self.rate:
+            logging.info(f"Rate limiter for {self.name}: {self.rate:.2f} -> {rate:.2f} "
+                         f"requests/s ({reason})")
+            self._refill(time.monotonic())  # Settle the tokens accrued at the old rate.
+            self.rate = rate
+        self._since_adjust = 0
+
+    def record(self, latency: float, overloaded: bool = False) -> None:
+        """ Feed back the outcome of a request. """
+        with self._lock:
+            self.requests += 1
+            now = time.monotonic()
+            if overloaded:
+                self.overloads += 1
+                if self._last_decrease is None or now - self._last_decrease >= self.cooldown:
+                    self._last_decrease = now
+                    self._set_rate(self.rate * self.decrease, "upstream overloaded")
+                return
+            self._latencies.append(latency)
+            self._since_adjust += 1
+            if self._since_adjust < self.window:
+                return
+            p95 = _p95(self._latencies)
+            self._best_p95 = p95 if self._best_p95 is None else min(self._best_p95, p95)
+            # Sub-second jitter on a fast upstream isn't worth backing off for.
+            rising = p95 > 2 * self._best_p95 and p95 > self.latency_target / 4
+            if p95 > self.latency_target or rising:
+                self._last_decrease = now
+                self._set_rate(self.rate * self.decrease, f"p95 latency {p95:.2f}s")
+            else:
+                self._set_rate(self.rate + self.increase, f"p95 latency {p95:.2f}s")
+
+    def call(self, func, *args, **kwargs):
+        """ Wait for our turn, send the request and learn from how it went. """
+        self.acquire()
+        start = time.monotonic()
+        try:
+            response = func(*args, **kwargs)
+        except requests.exceptions.Timeout:
+            self.record(time.monotonic() - start, overloaded=True)
+            raise
+        self.record(time.monotonic() - start,
+                    overloaded=response.status_code in OVERLOAD_STATUS_CODES)
+        return response
+
+    def summary(self) -> str:
+        return (f"Rate limiter for {self.name}: {self.rate:.2f} requests/s, "
+                f"{self.requests} requests, {self.overloads} overloaded, p95 {self.p95():.2f}s")
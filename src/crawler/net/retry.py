@@ -0,0 +1,229 @@
+"""Retries and circuit breakers for the requests we send upstream.
+
+A request that fails in a way worth another go (connection trouble, a
+timeout, 429 or a 5xx) is retried with jittered exponential backoff, or
+after as long as the upstream asks for in Retry-After.
+
+Every upstream has a circuit breaker. When it has seen `threshold`
+failures in a row it opens and the requests to that upstream wait instead
+of failing, which pauses the crawl. After the cooldown a single request is
+let through to probe. If that works the crawl carries on, otherwise the
+cooldown is doubled and we wait again."""
+
+import email.utils
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable
+
+import requests
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+RETRY_EXCEPTIONS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+DEFAULT_ATTEMPTS = 4
+DEFAULT_COOLDOWN = 30.0  # Seconds a circuit breaker stays open before the first probe.
+
+_policy_settings = dict(attempts=DEFAULT_ATTEMPTS, base=1.0, cap=60.0)
+_breaker_settings = dict(threshold=5, cooldown=DEFAULT_COOLDOWN, max_cooldown=900.0)
+_breakers = {}
+_policy = None
+_lock = threading.Lock()
+
+
+def retry_after(response: requests.Response) -> float:
+    """ Seconds the Retry-After header of a response asks us to wait, if any.
+    It is either a number of seconds or an HTTP date. """
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class CircuitBreaker:
+    """ Thread safe circuit breaker for one upstream. Call wait() before
+    every request and record() the outcome after. """
+
+    def __init__(self, name: str, threshold: int = 5, cooldown: float = 30.0,
+                 max_cooldown: float = 900.0):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0       # In a row.
+        self.trips = 0          # Times the breaker has opened.
+        self.paused = 0.0       # Seconds spent waiting on the breaker, summed over the callers.
+        self._open_until = None
+        self._current_cooldown = cooldown
+        self._probing = False
+        self._condition = threading.Condition()
+
+    @property
+    def is_open(self) -> bool:
+        with self._condition:
+            return self._open_until is not None
+
+    def wait(self) -> None:
+        """ Return right away while the breaker is closed. While it is open,
+        block until the cooldown is over and it is our turn to probe, or
+        another caller's probe has closed it. """
+        with self._condition:
+            start = time.monotonic()
+            while self._open_until is not None:
+                remaining = self._open_until - time.monotonic()
+                if remaining <= 0 and not self._probing:
+                    self._probing = True  # We're it. Everybody else waits for the outcome.
+                    break
+                self._condition.wait(remaining if remaining > 0 else None)
+            self.paused += time.monotonic() - start
+
+    def record(self, failed: bool) -> None:
+        with self._condition:
+            if not failed:
+                if self._open_until is not None:
+                    logging.info(f"{self.name} is back. Resuming.")
+                self.failures = 0
+                self._open_until = None
+                self._probing = False
+                self._current_cooldown = self.cooldown
+                self._condition.notify_all()
+                return
+            self.failures += 1
+            if self._probing:
+                # Still down. Wait longer before the next probe.
+                self._current_cooldown = min(self.max_cooldown, self._current_cooldown * 2)
+            elif self._open_until is not None or self.failures < self.threshold:
+                return
+            else:
+                self.trips += 1
+            self._probing = False
+            self._open_until = time.monotonic() + self._current_cooldown
+            logging.warning(f"{self.name} looks to be down after {self.failures} failures "
+                            f"in a row. Pausing requests to it for "
+                            f"{self._current_cooldown:.0f}s.")
+            self._condition.notify_all()
+
+    def summary(self) -> str:
+        return (f"Circuit breaker for {self.name}: opened {self.trips} times, "
+                f"paused {self.paused:.0f}s")
+
+
+class RetryPolicy:
+    """ How many times to try a request and how long to wait in between.
+    The wait before retry n is drawn uniformly from [0, min(cap, base * 2**n)]
+    ("full jitter") so clients that failed together don't retry together.
+    A Retry-After from the upstream is honored, up to max_retry_after. """
+
+    def __init__(self, attempts: int = 4, base: float = 1.0, cap: float = 60.0,
+                 max_retry_after: float = 300.0):
+        if attempts < 1:
+            raise ValueError(f"Need at least one attempt, got {attempts}")
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.max_retry_after = max_retry_after
+        self.retries = 0
+
+    def delay(self, retry: int, response: requests.Response = None) -> float:
+        """ Seconds to wait before retry number `retry`, counting from 0. """
+        asked = retry_after(response)
+        if asked is not None:
+            return min(asked, self.max_retry_after)
+        return random.uniform(0, min(self.cap, self.base * 2 ** retry))
+
+    def call(self, send: Callable, circuit: CircuitBreaker = None) -> requests.Response:
+        """ send() a request until it works or we run out of attempts. The
+        last response is returned, or the last exception raised, for the
+        caller to deal with. The circuit breaker sees every outcome; 429 only
+        means we're going too fast so it doesn't count as a failure there. """
+        for attempt in range(self.attempts):
+            if circuit is not None:
+                circuit.wait()
+            response = None
+            try:
+                response = send()
+            except RETRY_EXCEPTIONS as exception:
+                if circuit is not None:
+                    circuit.record(failed=True)
+                if attempt == self.attempts - 1:
+                    raise
+                reason = repr(exception)
+            except BaseException:
+                # Anything else, ie a login failing on the way, is not retried. The
+                # breaker still hears of it, or a probe would never finish and the
+                # callers waiting on it would hang.
+                if circuit is not None:
+                    circuit.record(failed=True)
+                raise
+            else:
+                retry = response.status_code in RETRY_STATUS_CODES
+                if circuit is not None:
+                    circuit.record(failed=retry and response.status_code != 429)
+                if not retry or attempt == self.attempts - 1:
+                    return response
+                reason = f"{response.status_code} {response.reason}"
+            delay = self.delay(attempt, response)
+            self.retries += 1
+            logging.info(f"Request failed ({reason}). Retrying in {delay:.1f}s "
+                         f"({attempt + 1}/{self.attempts - 1})")
+            time.sleep(delay)
+        raise AssertionError("Not reached")
+
+
+def configure(attempts: int = None, base: float = None, cap: float = None,
+              threshold: int = None, cooldown: float = None, max_cooldown: float = None) -> None:
+    """ Change the retry policy and the settings of the circuit breakers.
+    The breakers start over, closed. """
+    global _policy  # pylint: disable=global-statement
+    with _lock:
+        for settings, key, value in ((_policy_settings, 'attempts', attempts),
+                                     (_policy_settings, 'base', base),
+                                     (_policy_settings, 'cap', cap),
+                                     (_breaker_settings, 'threshold', threshold),
+                                     (_breaker_settings, 'cooldown', cooldown),
+                                     (_breaker_settings, 'max_cooldown', max_cooldown)):
+            if value is not None:
+                settings[key] = value
+        _policy = None
+        _breakers.clear()
+    logging.debug(f"Retry settings: {_policy_settings}, circuit breakers: {_breaker_settings}")
+
+
+def policy() -> RetryPolicy:
+    """ The shared retry policy. """
+    global _policy  # pylint: disable=global-statement
+    with _lock:
+        if _policy is None:
+            _policy = RetryPolicy(**_policy_settings)
+        return _policy
+
+
+def breaker(name: str) -> CircuitBreaker:
+    """ The shared circuit breaker for the upstream called name. """
+    with _lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, **_breaker_settings)
+        return _breakers[name]
+
+
+def call(name: str, send: Callable) -> requests.Response:
+    """ send() a request to the upstream called name with the shared retry
+    policy, behind that upstream's circuit breaker. """
+    return policy().call(send, breaker(name))
+
+
+def summary() -> str:
+    with _lock:
+        breakers = list(_breakers.values())
+        retries = _policy.retries if _policy is not None else 0
+    return "; ".join([f"Retries: {retries}"] + [circuit.summary() for circuit in breakers])
@@ -0,0 +1,25 @@
+"""The upstreams the crawler talks to and how a request is sent to one: on
+the upstream's shared session (client.py), paced by the rate limiter if
+there is one (ratelimit.py) and retried while the upstream is struggling
+(retry.py)."""
+
+import requests
+
+from . import retry
+from .client import upstream
+from .ratelimit import RateLimiter
+
+# The upstreams. Each has its own pool of connections, see client.py.
+METASYS = 'metasys'
+BAS = 'bas'
+SSO = 'entrasso'
+
+
+def send(limiter: RateLimiter, name: str, method: str, url: str, **kwargs) -> requests.Response:
+    """ Send a request to the upstream called name, through the limiter if we have one.
+    Failures worth another go are retried and while the upstream is down the
+    request waits for it to come back, see net/retry.py. """
+    func = getattr(upstream(name), method)
+    if limiter is None:
+        return retry.call(name, lambda: func(url, **kwargs))
+    return retry.call(name, lambda: limiter.call(func, url, **kwargs))
@@ -0,0 +1,148 @@
+"""Sink pushing the DTOs to the Bas API in batches.
+
+The DTOs are grouped by real estate, the part of the URL they are POSTed to.
+A group is sent as a single POST of a JSON array, gzip compressed, once it
+holds batch_size DTOs or max_bytes of them, or when the oldest DTO in it has
+waited interval seconds. That is one request, and one pass through the auth,
+for many DTOs. Batching is opt-in, since it needs Bas to take arrays. If Bas
+rejects a batch as such, or fails on the first batch sent, the DTOs are
+POSTed one by one and the sink sticks to single POSTs from then on.
+
+Up to `concurrency` requests are sent at once, whichever way they go."""
+
+import gzip
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import requests
+
+from .base import Sink
+
+BATCH_SIZE = 1                # DTOs per POST. Bas isn't known to take arrays.
+MAX_BATCH_BYTES = 1024 * 1024  # Uncompressed JSON per POST.
+BATCH_INTERVAL = 5.0          # Max seconds a DTO waits for its batch to fill up.
+# Responses to a batch saying this endpoint doesn't take them, as opposed to Bas failing.
+BATCH_REJECTED_STATUS_CODES = (400, 404, 405, 413, 415, 422)
+
+_JSON = {'Content-Type': 'application/json'}
+
+
+class _Group:  # pylint: disable=too-few-public-methods
+    """ The DTOs waiting for a real estate. """
+
+    def __init__(self):
+        self.items = []  # (body, done)
+        self.size = 0
+        self.started = time.monotonic()
+
+
+class BasSink(Sink):
+    """ post(real_estate, data, headers) sends a request body to the Bas
+    endpoint for the real estate and returns the response. With a
+    batch_size of 1 every DTO gets its own POST, as they always have.
+    Call put() and flush() from one thread at a time. """
+
+    def __init__(self, post: Callable, batch_size: int = BATCH_SIZE,
+                 max_bytes: int = MAX_BATCH_BYTES, interval: float = BATCH_INTERVAL,
+                 concurrency: int = 4, compress: bool = True):
+        super().__init__()
+        self.post = post
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.concurrency = concurrency
+        self.compress = compress
+        self.batching = batch_size > 1
+        # Until Bas has taken a batch, failing on one means it doesn't take them.
+        self.batch_accepted = False
+        self.requests = 0
+        self._groups = {}
+        self._ready = []  # (real estate, items) to send.
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def put(self, real_estate: str, body: str, done: Callable = None) -> None:
+        group = self._groups.setdefault(real_estate, _Group())
+        group.items.append((body, done))
+        group.size += len(body)
+        if len(group.items) >= self.batch_size or group.size >= self.max_bytes:
+            self._take(real_estate)
+        now = time.monotonic()
+        for stale in [key for key, waiting in self._groups.items()
+                      if now - waiting.started >= self.interval]:
+            self._take(stale)
+        if len(self._ready) >= self.concurrency:
+            self._send_ready()
+
+    def _take(self, real_estate: str) -> None:
+        """ Move a group to the ones ready to send. """
+        group = self._groups.pop(real_estate)
+        if self.batching:
+            self._ready.append((real_estate, group.items))
+        else:
+            self._ready.extend((real_estate, [item]) for item in group.items)
+
+    def flush(self) -> None:
+        for real_estate in list(self._groups):
+            self._take(real_estate)
+        self._send_ready()
+
+    def _send_ready(self) -> None:
+        ready, self._ready = self._ready, []
+        if not ready:
+            return
+        outcomes = list(self._executor.map(lambda unit: self._send(*unit), ready))
+        for (_, items), errors in zip(ready, outcomes):
+            for (_, done), error in zip(items, errors):
+                self._done(done, error)
+
+    def _post(self, real_estate: str, data: bytes, headers: dict) -> Exception:
+        """ Send a request body. Returns the exception if it didn't work out. """
+        with self._lock:
+            self.requests += 1
+        try:
+            resp = self.post(real_estate, data, headers)
+        except requests.exceptions.RequestException as exception:
+            return exception
+        if resp.status_code >= 400:
+            return requests.exceptions.HTTPError(f'Got error ({resp.status_code}/{resp.reason}) '
+                                                 f'POSTing to Bas for {real_estate}', response=resp)
+        return None
+
+    def _send(self, real_estate: str, items: list) -> list:
+        """ Send some DTOs for a real estate. Returns what happened to each. """
+        if len(items) > 1 and self.batching:
+            data = ('[' + ','.join(body for body, _ in items) + ']').encode('utf-8')
+            headers = dict(_JSON)
+            if self.compress:
+                data = gzip.compress(data)
+                headers['Content-Encoding'] = 'gzip'
+            error = self._post(real_estate, data, headers)
+            response = getattr(error, 'response', None)
+            status = response.status_code if response is not None else None
+            rejected = status in BATCH_REJECTED_STATUS_CODES or \
+                (status is not None and status >= 500 and not self.batch_accepted)
+            if error is None:
+                self.batch_accepted = True
+            if not rejected:
+                return [error] * len(items)
+            if error.response.status_code == 413:
+                logging.warning(f"Batch too large for Bas ({error}). POSTing its DTOs one by one.")
+            else:
+                logging.warning(f"Bas doesn't take batches ({error}). "
+                                f"Falling back to single POSTs.")
+                self.batching = False
+        return [self._post(real_estate, body.encode('utf-8'), dict(_JSON)) for body, _ in items]
+
+    def close(self) -> None:
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def summary(self) -> str:
+        return (f"Bas sink: {self.delivered} delivered, {self.failed} failed "
+                f"in {self.requests} requests{'' if self.batching else ', one by one'}")
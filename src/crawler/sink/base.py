@@ -0,0 +1,43 @@
+"""Sinks are where the DTOs of a crawl end up. put() hands a DTO over; when it
+has been delivered, or given up on, the done callback passed along with it is
+called with None or the exception. Sinks may hold on to DTOs to send them
+together, so flush() when the caller needs to know how it went. The callbacks
+run in the thread calling put(), flush() or close()."""
+
+from typing import Callable
+
+
+class Sink:
+    """ Base class for the sinks. """
+
+    def __init__(self):
+        self.delivered = 0
+        self.failed = 0
+
+    def put(self, real_estate: str, body: str, done: Callable = None) -> None:
+        """ Hand over a DTO, serialized to JSON, for a real estate. """
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        """ Deliver whatever is held on to. """
+
+    def close(self) -> None:
+        self.flush()
+
+    def _done(self, done: Callable, error: Exception = None) -> None:
+        if error is None:
+            self.delivered += 1
+        else:
+            self.failed += 1
+        if done is not None:
+            done(error)
+
+    def summary(self) -> str:
+        return f"{type(self).__name__}: {self.delivered} delivered, {self.failed} failed"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback_):
+        self.close()
+        return False
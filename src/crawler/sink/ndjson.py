@@ -0,0 +1,36 @@
+"""Sink writing the DTOs to a file, one JSON object per line, instead of
+pushing them anywhere. For dry runs, and to benchmark a crawl without Bas."""
+
+import json
+import threading
+from typing import Callable
+
+from .base import Sink
+
+
+class NdjsonSink(Sink):
+    """ Appends {"realEstate": ..., "dto": {...}} lines to the file at path. """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._fh = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def put(self, real_estate: str, body: str, done: Callable = None) -> None:
+        # The body is JSON already. No need to parse it only to serialize it again.
+        line = '{"realEstate": ' + json.dumps(real_estate) + ', "dto": ' + body + '}\n'
+        with self._lock:
+            self._fh.write(line)
+        self._done(done)
+
+    def flush(self) -> None:
+        with self._lock:
+            self._fh.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._fh.close()
+
+    def summary(self) -> str:
+        return f"NDJSON sink {self.path}: {self.delivered} written"
@@ -1,15 +1,24 @@
 """Shared fixtures are placed here and automagically discovered by pytest."""
+import collections
+import email.utils
+import hashlib
+import json
 import logging
 import os
 import sys
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 
 import datetime
 import time
 
 import pytest
+from sqlalchemy import create_engine
 from crawler.auth.entrasso import EntraSSOToken
 
 from crawler.auth.metasysbearer import BearerToken  # pylint: disable=wrong-import-position
+import crawler.crawler as crawler  # pylint: disable=wrong-import-position
 
 
 def pytest_sessionstart(session):
@@ -25,6 +34,14 @@ def pytest_sessionstart(session):
     root.addHandler(handler)
 
 
+@pytest.fixture(autouse=True)
+def quick_retries():
+    """ Retry without waiting and start every test with closed circuit breakers. """
+    crawler.retry.configure(attempts=crawler.retry.DEFAULT_ATTEMPTS, base=0.0, cooldown=0.1)
+    yield
+    crawler.retry.configure(base=1.0, cooldown=crawler.retry.DEFAULT_COOLDOWN)
+
+
 @pytest.fixture
 def username():
     return 'testuser'
@@ -63,6 +80,18 @@ def logged_in_metasys_bearer(requests_mock, metasys_baseurl, metasys_bearer, gen
     return metasys_bearer
 
 
+@pytest.fixture()
+def sqlite_session(tmp_path):
+    """ A session against a fresh Sqlite database with the crawler tables. It's
+    file backed so threads other than the test's see the same database. """
+    engine = create_engine('sqlite:///' + str(tmp_path / 'crawler.db'))
+    # Use the models as imported by the crawler module. See the sys.path hack there.
+    crawler.Base.metadata.create_all(engine)
+    session = crawler.db_session(engine)
+    yield session
+    session.close()
+
+
 # Fixtures for EntraSSO
 
 @pytest.fixture()
@@ -83,6 +112,7 @@ def entrasso_bearer(entrasso_auth_url, entrasso_secret):
 @pytest.fixture()
 def logged_in_entrasso_bearer(requests_mock, entrasso_bearer, generate_token, entrasso_auth_url) -> EntraSSOToken:
     """ Logs in entrasso. This can also happen explicitly or lazily, whenever it is used"""
+    # EntraSSO hands out expiry in milliseconds. See below.
     now_plus_one_hour = int(time.time()) + 3600
 
     response = f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
@@ -91,7 +121,7 @@ def logged_in_entrasso_bearer(requests_mock, entrasso_bearer, generate_token, en
        <applicationtokenID>{generate_token}</applicationtokenID>
        <applicationid>666</applicationid>
        <applicationname>Testing entrasso</applicationname>       
-       <expires>{now_plus_one_hour}</expires>
+       <expires>{now_plus_one_hour * 1000}</expires>
  </params>
  </applicationtoken>
 """
@@ -105,4 +135,107 @@ def logged_in_entrasso_bearer(requests_mock, entrasso_bearer, generate_token, en
 # Fixtures for BAS
 @pytest.fixture()
 def bas_target_url():
-    return "http://localhost/bas/metadata/bas/realestate"
\ No newline at end of file
+    return "http://localhost/bas/metadata/bas/realestate"
+
+# A stand-in for Metasys on a real socket, for the tests requests_mock can't do.
+
+class StandInMetasys:
+    """ Serves /login and /objects/{id} like Metasys does, with an ETag and a
+    Last-Modified on every object, and honors conditional GETs. POSTs to /bas
+    are accepted as pushes. Keeps count of connections, requests and body
+    bytes sent so tests can measure what keep-alive and validators save. """
+
+    def __init__(self):
+        self.objects = {}  # id -> (body, etag, last modified)
+        self.statuses = collections.Counter()
+        self.body_bytes = 0
+        self.pushes = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.base_url = None  # Set once the server is listening.
+
+    def put(self, object_id: str, text: str) -> None:
+        """ Add or change an object. Changes get a new ETag and Last-Modified. """
+        body = text.encode('utf8')
+        etag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+        self.objects[object_id] = (body, etag, email.utils.formatdate(time.time(), usegmt=True))
+
+    def not_modified(self, headers, etag: str, last_modified: str) -> bool:
+        if headers.get('If-None-Match'):  # Takes precedence over If-Modified-Since.
+            return headers['If-None-Match'] == etag
+        if headers.get('If-Modified-Since'):
+            since = email.utils.parsedate_to_datetime(headers['If-Modified-Since'])
+            return email.utils.parsedate_to_datetime(last_modified) <= since
+        return False
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep alive, like the real thing.
+    # Or the headers and body sent apart add a delayed ACK to every reply.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.standin.lock:
+            self.server.standin.connections += 1
+
+    def _reply(self, status: int, body: bytes = b'', headers: dict = None) -> None:
+        standin = self.server.standin
+        with standin.lock:
+            standin.statuses[status] += 1
+            standin.body_bytes += len(body)
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.endswith('/login'):
+            expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+            self._reply(200, json.dumps({'accessToken': 'standin_token',
+                                         'expires': expires.isoformat()}).encode())
+        elif self.path.startswith('/bas/'):
+            with self.server.standin.lock:
+                self.server.standin.pushes += 1
+            self._reply(200, b'{"message": "Thank you for your contribution"}')
+        else:
+            self._reply(404)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        standin = self.server.standin
+        object_id = self.path.rsplit('/', 1)[-1]
+        if '/objects/' not in self.path or object_id not in standin.objects:
+            self._reply(404, b'{"message": "Not found"}')
+            return
+        body, etag, last_modified = standin.objects[object_id]
+        validators = {'ETag': etag, 'Last-Modified': last_modified}
+        if standin.not_modified(self.headers, etag, last_modified):
+            self._reply(304, headers=validators)
+        else:
+            self._reply(200, body, validators)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture()
+def metasys_standin():
+    """ A StandInMetasys listening on localhost. Its base_url is the Metasys
+    API, base_url without /api/v2 plus /bas is where Bas pushes go. """
+    server = _ThreadingHTTPServer(('127.0.0.1', 0), _StandInHandler)
+    server.standin = StandInMetasys()
+    server.standin.base_url = f'http://127.0.0.1:{server.server_address[1]}/api/v2'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.standin
+    server.shutdown()
+    server.server_close()
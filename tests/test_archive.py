@@ -0,0 +1,92 @@
+"""
+Tests for the archive of Metasys responses.
+"""
+import os
+
+import pytest
+
+from crawler.db.archive import CorruptRecord, ResponseArchive
+
+
+def response(object_id: str, version: int = 1) -> str:
+    return (f'{{"item": {{"id": "{object_id}", "version": {version}, '
+            f'"description": "{"x" * 200}"}}}}')
+
+
+def test_put_and_get(tmp_path):
+    with ResponseArchive(str(tmp_path)) as archive:
+        archive.put('A', response('A'))
+        archive.put('B', response('B'))
+        assert archive.get('A') == response('A')
+        archive.put('A', response('A', 2))  # Latest wins.
+        assert archive.get('A') == response('A', 2)
+        assert archive.get('B') == response('B')
+        assert 'A' in archive and 'C' not in archive
+        assert len(archive) == 2
+        assert archive.ids() == ['B', 'A']
+        with pytest.raises(KeyError):
+            archive.get('C')
+    # Compressed on disk.
+    assert os.path.getsize(tmp_path / '000001.seg') < 3 * len(response('A'))
+
+
+def test_reopen_and_segments(tmp_path):
+    with ResponseArchive(str(tmp_path), segment_size=300) as archive:
+        for idx in range(10):
+            archive.put(f'obj{idx}', response(f'obj{idx}'))
+    assert len([name for name in os.listdir(tmp_path) if name.endswith('.seg')]) > 1
+    with ResponseArchive(str(tmp_path), segment_size=300) as archive:
+        assert len(archive) == 10
+        assert all(archive.get(f'obj{idx}') == response(f'obj{idx}') for idx in range(10))
+        archive.put('obj0', response('obj0', 2))
+        assert archive.get('obj0') == response('obj0', 2)
+
+
+def test_recovers_from_a_crash(tmp_path):
+    with ResponseArchive(str(tmp_path)) as archive:
+        archive.put('A', response('A'))
+        archive.put('B', response('B'))
+    # Died halfway through writing a record, and the index entry for B never made it.
+    with open(tmp_path / '000001.seg', 'ab') as fh:
+        fh.write(b'MRA1\x01\x00')
+    index = (tmp_path / '000001.idx').read_bytes()
+    (tmp_path / '000001.idx').write_bytes(index[:len(index) // 2 + 3])
+
+    with ResponseArchive(str(tmp_path)) as archive:
+        assert archive.ids() == ['A', 'B']
+        assert archive.get('B') == response('B')
+        archive.put('C', response('C'))
+    with ResponseArchive(str(tmp_path)) as archive:
+        assert archive.ids() == ['A', 'B', 'C']
+        assert archive.get('C') == response('C')
+
+
+def test_two_writers(tmp_path):
+    """ Two workers sharing an archive, ie shards of a crawl, don't
+    overwrite each other's records. """
+    first, second = ResponseArchive(str(tmp_path)), ResponseArchive(str(tmp_path))
+    try:
+        for idx in range(3):
+            first.put(f'A{idx}', response(f'A{idx}'))
+            second.put(f'B{idx}', response(f'B{idx}', 2))
+        assert all(first.get(f'A{idx}') == response(f'A{idx}') for idx in range(3))
+        assert all(second.get(f'B{idx}') == response(f'B{idx}', 2) for idx in range(3))
+    finally:
+        first.close()
+        second.close()
+    with ResponseArchive(str(tmp_path)) as archive:
+        assert len(archive) == 6
+        assert all(archive.get(f'A{idx}') == response(f'A{idx}') for idx in range(3))
+        assert all(archive.get(f'B{idx}') == response(f'B{idx}', 2) for idx in range(3))
+
+
+def test_corrupt_record(tmp_path):
+    with ResponseArchive(str(tmp_path)) as archive:
+        archive.put('A', response('A'))
+        location = archive._index['A']  # pylint: disable=protected-access
+    with open(tmp_path / '000001.seg', 'r+b') as fh:
+        fh.seek(location.offset + 5)
+        fh.write(b'\0\0\0')
+    with ResponseArchive(str(tmp_path)) as archive:
+        with pytest.raises(CorruptRecord):
+            archive.get('A')
@@ -0,0 +1,42 @@
+"""
+Tests for the asyncio engine used by the deep crawl.
+"""
+import threading
+import time
+
+import pytest
+
+from crawler.engine.asyncengine import in_thread, run_concurrently
+
+
+def test_concurrency_is_bounded():
+    lock = threading.Lock()
+    in_flight = [0]
+    peak = [0]
+    handled = []
+
+    def blocking_call(item):
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        time.sleep(0.02)
+        with lock:
+            in_flight[0] -= 1
+        return item
+
+    async def handle(item):
+        handled.append(await in_thread(blocking_call, item))
+
+    run_concurrently(range(20), handle, concurrency=4)
+    assert sorted(handled) == list(range(20))
+    assert peak[0] == 4
+
+
+def test_exceptions_abort_the_run():
+    async def handle(item):
+        if item == 3:
+            raise ValueError("Boom")
+        await in_thread(time.sleep, 0.01)
+
+    with pytest.raises(ValueError):
+        run_concurrently(range(10), handle, concurrency=2)
@@ -1,10 +1,13 @@
 import base64
+import gzip
 import os
 import json
 import logging
-from datetime import datetime, timezone
+import time
+from datetime import datetime, timedelta, timezone
 from unittest.mock import MagicMock, Mock
 
+import click
 import crawler.crawler as crawler
 import pytest
 import pytest_mock
@@ -40,13 +43,141 @@ def test_get_objects(requests_mock, metasys_baseurl, logged_in_metasys_bearer):
     mockdb_session = MagicMock()
 
     # Make sure that when the crawler queries for existing objects we make sure there are none.
-    # Perhaps we wanna write another test with existing objects that then get ignored.
-    mockdb_session.query.return_value.filter_by.return_value.first.return_value = None
-    crawler.get_objects(mockdb_session, metasys_baseurl, logged_in_metasys_bearer, 165, 0.0)
-    assert mockdb_session.add.call_count == 6  # We should have done 6 adds.
-    assert mockdb_session.commit.call_count == 6
-    assert mockdb_session.add.call_args_list[0][0][0].id == '3C30ACE2-9AD2-4C14-BB3E-480B99A3E9EE'
-    assert mockdb_session.add.call_args_list[5][0][0].id == '7B599BFB-3A4A-4F75-85E4-D746FA4EA6E0'
+    mockdb_session.query.return_value.filter.return_value = []
+    crawler.get_objects(mockdb_session, metasys_baseurl, logged_in_metasys_bearer, 165)
+    # One bulk insert and one commit per page.
+    assert mockdb_session.bulk_insert_mappings.call_count == 2
+    assert mockdb_session.commit.call_count == 2
+    first_page = mockdb_session.bulk_insert_mappings.call_args_list[0][0][1]
+    second_page = mockdb_session.bulk_insert_mappings.call_args_list[1][0][1]
+    assert len(first_page) + len(second_page) == 6
+    assert first_page[0]['id'] == '3C30ACE2-9AD2-4C14-BB3E-480B99A3E9EE'
+    assert second_page[-1]['id'] == '7B599BFB-3A4A-4F75-85E4-D746FA4EA6E0'
+
+
+def test_fetch_object_pages_prefetch(requests_mock, metasys_baseurl, logged_in_metasys_bearer,
+                                     mocker):
+    """With prefetch the pages after the first are fetched concurrently but yielded in order."""
+    items = []
+    for name in ('data/objects.page.1.json', 'data/objects.page.2.json'):
+        with open(get_path(name)) as fh:
+            items.extend(json.load(fh)["items"])
+    # As imported by the crawler module. See the sys.path hack there.
+    mocker.patch('metasys.discovery.OBJECTS_PAGE_SIZE', 2)
+    for page in range(1, 4):
+        requests_mock.get(metasys_baseurl + f'/objects?page={page}&', complete_qs=False,
+                          json={"total": len(items),
+                                "next": (None if page == 3
+                                         else f"{metasys_baseurl}/objects?page={page + 1}"),
+                                "items": items[(page - 1) * 2:page * 2]})
+
+    pages = list(crawler.fetch_object_pages(metasys_baseurl, logged_in_metasys_bearer, 165,
+                                            limiter=crawler.RateLimiter(100.0), prefetch=2))
+    assert [page for page, _, _ in pages] == [1, 2, 3]
+    assert [last_page for _, _, last_page in pages] == [False, False, True]
+    assert [item["id"] for _, page_items, _ in pages for item in page_items] == \
+        [item["id"] for item in items]
+    # Login and three pages.
+    assert requests_mock.call_count == 4
+
+
+def test_get_objects_resume(requests_mock, metasys_baseurl, logged_in_metasys_bearer,
+                            sqlite_session):
+    """Pages are checkpointed and skipped when resuming. Finished types aren't fetched at all."""
+    with open(get_path('data/objects.page.1.json')) as fh:
+        json_text1 = fh.read()
+    with open(get_path('data/objects.page.2.json')) as fh:
+        json_text2 = fh.read()
+    page1 = requests_mock.get(metasys_baseurl + '/objects?page=1&', complete_qs=False,
+                              text=json_text1)
+    page2 = requests_mock.get(metasys_baseurl + '/objects?page=2&', complete_qs=False,
+                              status_code=500)
+
+    with pytest.raises(json.decoder.JSONDecodeError):
+        crawler.get_objects(sqlite_session, metasys_baseurl, logged_in_metasys_bearer, 165)
+    checkpoints = crawler.load_checkpoints(sqlite_session)
+    assert checkpoints == {165: {1: False}}
+
+    page2 = requests_mock.get(metasys_baseurl + '/objects?page=2&', complete_qs=False,
+                              text=json_text2)
+    crawler.get_objects(sqlite_session, metasys_baseurl, logged_in_metasys_bearer, 165,
+                        checkpoints=checkpoints)
+    assert page1.call_count == 1
+    assert page2.call_count == 1
+    assert sqlite_session.query(crawler.MetasysObject).count() == 6
+
+    crawler.get_objects(sqlite_session, metasys_baseurl, logged_in_metasys_bearer, 165,
+                        checkpoints=crawler.load_checkpoints(sqlite_session))
+    assert page1.call_count == 1
+    assert page2.call_count == 1
+
+
+def test_discover_objects(requests_mock, metasys_baseurl, logged_in_metasys_bearer, sqlite_session):
+    """Several types fetched concurrently through the shared limiter, written by one thread."""
+    with open(get_path('data/objects.page.1.json')) as fh:
+        json_text1 = fh.read()
+    with open(get_path('data/objects.page.2.json')) as fh:
+        json_text2 = fh.read()
+    single_page = json.loads(json_text2)
+    for item in single_page["items"]:
+        item["id"] = item["id"][::-1]  # Make them distinct from the ones of type 165.
+    requests_mock.get(metasys_baseurl + '/objects?page=1&type=165&', complete_qs=False,
+                      text=json_text1)
+    requests_mock.get(metasys_baseurl + '/objects?page=2&type=165&', complete_qs=False,
+                      text=json_text2)
+    requests_mock.get(metasys_baseurl + '/objects?page=1&type=197&', complete_qs=False,
+                      json=single_page)
+
+    crawler.discover_objects(sqlite_session, metasys_baseurl, logged_in_metasys_bearer, [165, 197],
+                             concurrency=2, limiter=crawler.RateLimiter(100.0))
+    query = sqlite_session.query(crawler.MetasysObject)
+    assert query.filter_by(type=165).count() == 6
+    assert query.filter_by(type=197).count() == 3
+
+
+def test_insert_objects_skips_known(sqlite_session):
+    """Already discovered objects are left alone, duplicates within a page are dropped."""
+    with open(get_path('data/objects.page.1.json')) as fh:
+        items = json.load(fh)["items"]
+    assert crawler.insert_objects(sqlite_session, items[:2], 165) == 2
+    first_seen = sqlite_session.query(crawler.MetasysObject).get(items[0]["id"]).discovered
+
+    assert crawler.insert_objects(sqlite_session, items + items[2:], 165) == len(items) - 2
+    assert sqlite_session.query(crawler.MetasysObject).count() == len(items)
+    assert sqlite_session.query(crawler.MetasysObject).get(items[0]["id"]).discovered == first_seen
+
+
+def add_crawl_objects(session, count: int) -> list:
+    """Store `count` discovered objects ready for a deep crawl. Returns their ids in order."""
+    object_ids = [f"3C30ACE2-9AD2-4C14-BB3E-480B99A3E9E{idx}" for idx in range(count)]
+    session.add_all([
+        crawler.MetasysObject(id=object_id,
+                              name="Energi_kWh",
+                              itemReference="GP-SXD9E-113:SOKB16--NAE99/Powermeter.floor01",
+                              successes=0,
+                              errors=0,
+                              discovered=datetime.now(timezone.utc),
+                              type=129)
+        for object_id in object_ids])
+    session.commit()
+    return object_ids
+
+
+def posted(mock) -> list:
+    """The DTOs POSTed to a requests_mock endpoint, one by one or in gzipped batches."""
+    dtos = []
+    for request in mock.request_history:
+        body = request.body
+        if request.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        dto = json.loads(body)
+        dtos.extend(dto if isinstance(dto, list) else [dto])
+    return dtos
+
+
+def stored_objects(session) -> list:
+    session.expire_all()
+    return session.query(crawler.MetasysObject).order_by(crawler.MetasysObject.id).all()
 
 
 def test_enrich_objects(requests_mock,
@@ -54,37 +185,21 @@ def test_enrich_objects(requests_mock,
                         logged_in_metasys_bearer,
                         mocker,
                         logged_in_entrasso_bearer,
-                        bas_target_url
+                        bas_target_url,
+                        sqlite_session
                         ):
-    """Test the enrich objects function. Mocks the request and the database."""
+    """Test the enrich objects function. Mocks the requests, uses a scratch database."""
     with open(get_path('data/object.0.json')) as fh:
         json_text = fh.read()
-    j_dict = json.loads(json_text)
-    id = j_dict["item"]["id"]
 
     # Set up metasys mock for the request that the crawler will do to metasys.
-    # base_url + f"/objects/{item_object.id}" --> 'http://localhost/api/v2/objects/3C30ACE2-9AD2-4C14-BB3E-480B99A3E9EE'
-    requests_mock.get(metasys_baseurl + f'/objects/{id}', complete_qs=True, text=json_text)
-
-    # Mock the database..
-    return_obj = MetasysObject(id=id,
-                               name="Energi_kWh",
-                               itemReference="GP-SXD9E-113:SOKB16--NAE99/Powermeter.floor01",
-                               successes=0,
-                               discovered=datetime.now(timezone.utc),
-                               lastCrawl=datetime.now(timezone.utc),
-                               lastError=None,
-                               type=129,
-                               )
-    mockdb_session = Mock()
-    mockdb_session.query.return_value.all.return_value = [return_obj]  # This breaks if we filter the query....
-
-    # Monkey patching this so we don't have to mock it.
-    # This will replace the get_type_description in the crawler to return a value
-    # without a database.
-    mocker.patch('crawler.crawler.get_type_description',
-                 return_value='Powerthingy'
-                 )
+    # base_url + f"/objects/{item_object.id}"
+    #   --> 'http://localhost/api/v2/objects/3C30ACE2-9AD2-4C14-BB3E-480B99A3E9E0'
+    object_id, = add_crawl_objects(sqlite_session, 1)
+    requests_mock.get(metasys_baseurl + f'/objects/{object_id}', complete_qs=True, text=json_text)
+    # The crawl needs the type descriptions from the enumsets.
+    add_enumsets(sqlite_session, {129: 'Powerthingy'})
+    commit = mocker.spy(sqlite_session, 'commit')
 
     # Set up the mocks for the Bas API so we have somewhere to push.
     # We do a POST to http://localhost/bas/metadata/bas/realestate/kjorbo"
@@ -94,14 +209,15 @@ def test_enrich_objects(requests_mock,
                        text='{ "message": "Thank you for your contribution"}')
 
 
-    crawler.enrich_things(session=mockdb_session,
+    crawler.enrich_things(session=sqlite_session,
                           base_url=metasys_baseurl, metasys_bearer=logged_in_metasys_bearer,
                           entrasso_bearer=logged_in_entrasso_bearer,
-                          delay=0.0, refresh=True)
+                          limiter=None, refresh=True)
 
     # We expect one commit do be done.
 
-    assert mockdb_session.commit.call_count == 1
+    assert commit.call_count == 1
+    assert stored_objects(sqlite_session)[0].successes == 1
     # Inspect the request mocker. See that 4 calls have been made. These are:
     # 1. call to the metasys sso
     # 2. call to the entraos sso
@@ -110,6 +226,595 @@ def test_enrich_objects(requests_mock,
     assert requests_mock.call_count == 4
 
 
+@pytest.mark.parametrize('bas_responses, successes, errors', [
+    ([{'status_code': 503, 'headers': {'Retry-After': '0'}}, {'status_code': 200}], 1, 0),
+    ([{'status_code': 502}], 0, 1),
+])
+def test_enrich_retries_bas(requests_mock, metasys_baseurl, logged_in_metasys_bearer, mocker,
+                            logged_in_entrasso_bearer, bas_target_url, sqlite_session,
+                            bas_responses, successes, errors):
+    """A failing Bas is retried. If it keeps failing the object gets an error and the crawl
+    carries on."""
+    with open(get_path('data/object.0.json')) as fh:
+        json_text = fh.read()
+    object_id, = add_crawl_objects(sqlite_session, 1)
+    requests_mock.get(metasys_baseurl + f'/objects/{object_id}', complete_qs=True, text=json_text)
+    add_enumsets(sqlite_session, {129: 'Powerthingy'})
+    push = requests_mock.post(bas_target_url + '/kjorbo', bas_responses)
+
+    crawler.enrich_things(session=sqlite_session,
+                          base_url=metasys_baseurl, metasys_bearer=logged_in_metasys_bearer,
+                          entrasso_bearer=logged_in_entrasso_bearer,
+                          limiter=None, refresh=True)
+
+    stored, = stored_objects(sqlite_session)
+    assert (stored.successes, stored.errors) == (successes, errors)
+    assert push.call_count == (2 if successes else crawler.retry.DEFAULT_ATTEMPTS)
+
+
+@pytest.mark.parametrize('engine', ['sequential', 'async', 'pipeline'])
+def test_enrich_bas_rejects(requests_mock, metasys_baseurl, logged_in_metasys_bearer,
+                            logged_in_entrasso_bearer, bas_target_url, sqlite_session, engine,
+                            caplog):
+    """A DTO Bas refuses fails its object without a retry. The crawl carries on."""
+    with open(get_path('data/object.0.json')) as fh:
+        json_text = fh.read()
+    object_ids = add_crawl_objects(sqlite_session, 3)
+    for object_id in object_ids:
+        requests_mock.get(metasys_baseurl + f'/objects/{object_id}', complete_qs=True,
+                          text=json_text)
+    add_enumsets(sqlite_session, {129: 'Powerthingy'})
+    push = requests_mock.post(bas_target_url + '/kjorbo',
+                              [{'status_code': 400}, {'status_code': 200}, {'status_code': 200}])
+
+    crawl = dict(session=sqlite_session, base_url=metasys_baseurl,
+                 metasys_bearer=logged_in_metasys_bearer,
+                 entrasso_bearer=logged_in_entrasso_bearer, refresh=True)
+    if engine == 'async':
+        crawler.enrich_things_async(concurrency=2, **crawl)
+    elif engine == 'pipeline':
+        crawler.enrich_things_pipeline(**crawl)
+    else:
+        crawler.enrich_things(limiter=None, **crawl)
+
+    assert push.call_count == 3
+    stored = stored_objects(sqlite_session)
+    assert sorted((item_object.successes, item_object.errors) for item_object in stored) == \
+        [(0, 1), (1, 0), (1, 0)]
+    assert 'Bas refused the DTO' in caplog.text
+
+
+@pytest.mark.parametrize('engine', ['sequential', 'async', 'pipeline'])
+def test_enrich_into_outbox(requests_mock, metasys_baseurl, logged_in_metasys_bearer, mocker,
+                            logged_in_entrasso_bearer, bas_target_url, sqlite_session, engine):
+    """With outbox the crawl doesn't talk to Bas. crawler push does, later."""
+    with open(get_path('data/object.0.json')) as fh:
+        json_text = fh.read()
+    object_ids = add_crawl_objects(sqlite_session, 3)
+    for object_id in object_ids:
+        requests_mock.get(metasys_baseurl + f'/objects/{object_id}', complete_qs=True,
+                          text=json_text)
+    add_enumsets(sqlite_session, {129: 'Powerthingy'})
+    push = requests_mock.post(bas_target_url + '/kjorbo',
+                              text='{ "message": "Thank you for your contribution"}')
+
+    crawl = dict(session=sqlite_session, base_url=metasys_baseurl,
+                 metasys_bearer=logged_in_metasys_bearer, entrasso_bearer=None, refresh=True,
+                 outbox=True)
+    if engine == 'async':
+        crawler.enrich_things_async(concurrency=2, **crawl)
+    elif engine == 'pipeline':
+        crawler.enrich_things_pipeline(**crawl)
+    else:
+        crawler.enrich_things(limiter=None, **crawl)
+
+    assert push.call_count == 0
+    assert all(item_object.successes == 1 for item_object in stored_objects(sqlite_session))
+    entries = sqlite_session.query(crawler.BasOutbox).order_by(crawler.BasOutbox.objectId).all()
+    assert [entry.objectId for entry in entries] == object_ids
+    assert json.loads(entries[0].body)['id'] == object_ids[0]
+
+    with crawler.bas_sink(logged_in_entrasso_bearer, post_batch=100, concurrency=2) as sink:
+        counts = crawler.drain_outbox(sqlite_session, sink)
+    assert counts['pushed'] == 3
+    assert push.call_count == 1  # All in one batch.
+    assert sorted(dto['id'] for dto in posted(push)) == object_ids
+    assert sqlite_session.query(crawler.BasOutbox).count() == 0
+
+
+def test_archive_and_replay(requests_mock, metasys_baseurl, logged_in_metasys_bearer, mocker,
+                            logged_in_entrasso_bearer, bas_target_url, sqlite_session, tmp_path):
+    """The crawl archives the responses. Replay pushes them to Bas again without Metasys."""
+    with open(get_path('data/object.0.json')) as fh:
+        json_text = fh.read()
+    object_ids = add_crawl_objects(sqlite_session, 3)
+    for item_object in sqlite_session.query(crawler.MetasysObject):
+        item_object.etag = '"v1"'
+    sqlite_session.commit()
+    fetches = [requests_mock.get(metasys_baseurl + f'/objects/{object_id}', complete_qs=True,
+                                 text=json_text)
+               for object_id in object_ids]
+    add_enumsets(sqlite_session, {129: 'Powerthingy'})
+    push = requests_mock.post(bas_target_url + '/kjorbo',
+                              text='{ "message": "Thank you for your contribution"}')
+
+    with crawler.ResponseArchive(str(tmp_path / 'archive')) as archive:
+        crawler.enrich_things(session=sqlite_session, base_url=metasys_baseurl,
+                              metasys_bearer=logged_in_metasys_bearer,
+                              entrasso_bearer=logged_in_entrasso_bearer,
+                              limiter=None, refresh=True, force_push=True, archive=archive)
+    # Not in the archive yet, so fetched in full.
+    assert all('If-None-Match' not in fetch.last_request.headers for fetch in fetches)
+    assert push.call_count == 3
+
+    with crawler.ResponseArchive(str(tmp_path / 'archive')) as archive:
+        assert sorted(archive.ids()) == object_ids
+        with crawler.bas_sink(logged_in_entrasso_bearer, post_batch=1, concurrency=2) as sink:
+            counts = crawler.replay_archive(sqlite_session, archive, sink,
+                                            item_prefix='GP-SXD9E-113:SOKB16')
+        with crawler.NdjsonSink(str(tmp_path / 'dry-run.ndjson')) as sink:
+            crawler.replay_archive(sqlite_session, archive, sink)
+    assert counts == {'pushed': 3, 'skipped': 0}
+    assert all(fetch.call_count == 1 for fetch in fetches)
+    assert push.call_count == 6
+    assert push.last_request.json()['response'] == crawler.b64_encode_response(json_text)
+    with open(tmp_path / 'dry-run.ndjson') as fh:
+        lines = [json.loads(line) for line in fh]
+    assert sorted(line['dto']['id'] for line in lines) == object_ids
+    assert {line['realEstate'] for line in lines} == {'kjorbo'}
+
+    # An object that can't be mapped any more fails on its own.
+    sqlite_session.query(crawler.MetasysObject).filter_by(id=object_ids[0]) \
+        .update({'itemReference': 'no building here'})
+    with crawler.ResponseArchive(str(tmp_path / 'archive')) as archive, \
+            crawler.NdjsonSink(str(tmp_path / 'again.ndjson')) as sink:
+        counts = crawler.replay_archive(sqlite_session, archive, sink)
+    assert (counts['pushed'], counts['failed']) == (2, 1)
+
+
+@pytest.mark.parametrize('post_batch', [1, 100])
+def test_drain_outbox(requests_mock, logged_in_entrasso_bearer, bas_target_url, sqlite_session,
+                      post_batch):
+    """An object's entries go in order. One that Bas won't take is backed off and holds back
+    the rest."""
+    def entry(object_id, real_estate, version):
+        return dict(objectId=object_id, realEstate=real_estate,
+                    body=json.dumps({'id': object_id, 'v': version}),
+                    created=datetime.now(timezone.utc), attempts=0)
+    sqlite_session.execute(crawler.BasOutbox.__table__.insert(),
+                           [entry('A', 'kjorbo', 1), entry('B', 'kjorbo', 1), entry('C', 'down', 1),
+                            entry('A', 'kjorbo', 2), entry('C', 'down', 2)])
+    sqlite_session.commit()
+    push = requests_mock.post(bas_target_url + '/kjorbo', text='{}')
+    down = requests_mock.post(bas_target_url + '/down', status_code=502)
+
+    with crawler.bas_sink(logged_in_entrasso_bearer, post_batch=post_batch, concurrency=3) as sink:
+        counts = crawler.drain_outbox(sqlite_session, sink)
+
+    assert counts == {'pushed': 3, 'failed': 1}
+    assert [dto['v'] for dto in posted(push) if dto['id'] == 'A'] == [1, 2]
+    assert {dto['v'] for dto in posted(down)} == {1}
+    left = sqlite_session.query(crawler.BasOutbox).order_by(crawler.BasOutbox.id).all()
+    assert [(entry.objectId, entry.attempts) for entry in left] == [('C', 1), ('C', 0)]
+    assert '502' in left[0].lastError
+    assert left[0].nextAttempt > datetime.utcnow()
+    # Backing off. Nothing due.
+    assert crawler.due_outbox_entries(sqlite_session) == []
+
+
+def test_content_hash():
+    """Key order and whitespace don't change the hash, the values and the real estate do."""
+    digest = crawler.content_hash('{"item": {"a": 1, "b": "x"}, "self": "foo"}', 'kjorbo')
+    assert len(digest) == 32
+    assert crawler.content_hash('{"self": "bar", "item": {"b": "x",  "a": 1}}', 'kjorbo') == digest
+    assert crawler.content_hash('{"item": {"a": 2, "b": "x"}}', 'kjorbo') != digest
+    assert crawler.content_hash('{"item": {"a": 1, "b": "x"}}', 'moved') != digest
+
+
+def test_enrich_skips_unchanged(requests_mock,
+                                metasys_baseurl,
+                                logged_in_metasys_bearer,
+                                mocker,
+                                logged_in_entrasso_bearer,
+                                bas_target_url,
+                                sqlite_session):
+    """Objects aren't pushed to Bas again until they change or we're told to."""
+    with open(get_path('data/object.0.json')) as fh:
+        json_text = fh.read()
+    object_id, = add_crawl_objects(sqlite_session, 1)
+    requests_mock.get(metasys_baseurl + f'/objects/{object_id}', complete_qs=True, text=json_text)
+    push = requests_mock.post(bas_target_url + '/kjorbo', complete_qs=True,
+                              text='{ "message": "Thank you for your contribution"}')
+    add_enumsets(sqlite_session, {129: 'Powerthingy'})
+
+    def crawl(**kwargs):
+        crawler.enrich_things(session=sqlite_session, base_url=metasys_baseurl,
+                              metasys_bearer=logged_in_metasys_bearer,
+                              entrasso_bearer=logged_in_entrasso_bearer,
+                              limiter=None, refresh=True, **kwargs)
+        return stored_objects(sqlite_session)[0]
+
+    item_object = crawl()
+    assert push.call_count == 1
+    assert item_object.contentHash == crawler.content_hash(json_text, 'kjorbo')
+    assert item_object.realEstate == 'kjorbo'
+    first_sync = item_object.lastSync
+
+    item_object = crawl()
+    assert push.call_count == 1
+    assert item_object.successes == 1
+    assert item_object.lastSync > first_sync  # Bas is still in sync.
+
+    crawl(force_push=True)
+    assert push.call_count == 2
+
+    changed = json.loads(json_text)
+    changed['item']['description'] = 'Something else'
+    requests_mock.get(metasys_baseurl + f'/objects/{object_id}', complete_qs=True,
+                      text=json.dumps(changed))
+    item_object = crawl()
+    assert push.call_count == 3
+    assert item_object.successes == 3
+
+
+def test_fetch_metasys_object_conditional(metasys_standin):
+    """A fetch with the validators from the last one gets a 304 until the object changes."""
+    with open(get_path('data/object.0.json')) as fh:
+        json_text = fh.read()
+    metasys_standin.put('foo', json_text)
+    bearer = crawler.BearerToken(metasys_standin.base_url, 'testuser', 'verysecret')
+
+    fetched = crawler.fetch_metasys_object(metasys_standin.base_url, bearer, 'foo')
+    assert fetched.text == json_text
+    assert fetched.etag and fetched.lastModified
+    unchanged = crawler.fetch_metasys_object(metasys_standin.base_url, bearer, 'foo',
+                                             etag=fetched.etag, last_modified=fetched.lastModified)
+    assert unchanged == (None, fetched.etag, fetched.lastModified)
+    # Last-Modified alone will do.
+    assert crawler.fetch_metasys_object(metasys_standin.base_url, bearer, 'foo',
+                                        last_modified=fetched.lastModified).text is None
+
+    metasys_standin.put('foo', json_text.replace('Energy something.', 'Energy something else.'))
+    changed = crawler.fetch_metasys_object(metasys_standin.base_url, bearer, 'foo',
+                                           etag=fetched.etag)
+    assert 'Energy something else.' in changed.text
+    assert changed.etag != fetched.etag
+
+
+def test_enrich_conditional_refresh(metasys_standin, sqlite_session, entrasso_bearer, mocker,
+                                    monkeypatch):
+    """A refresh crawl of unchanged objects gets 304s, no bodies and no pushes.
+    Logs the bytes and time saved against the stand-in."""
+    with open(get_path('data/object.0.json')) as fh:
+        json_text = fh.read()
+    object_ids = add_crawl_objects(sqlite_session, 50)
+    for object_id in object_ids:
+        metasys_standin.put(object_id,
+                            json_text.replace('3C30ACE2-9AD2-4C14-BB3E-480B99A3E9EE', object_id))
+    monkeypatch.setenv('ENTRAOS_BAS_BASEURL', metasys_standin.base_url.replace('/api/v2', '/bas'))
+    add_enumsets(sqlite_session, {129: 'Powerthingy'})
+    entrasso_bearer.token, entrasso_bearer.expires = 'standin_token', int(time.time()) + 3600
+    bearer = crawler.BearerToken(metasys_standin.base_url, 'testuser', 'verysecret')
+
+    def crawl(**kwargs):
+        body_bytes, start = metasys_standin.body_bytes, time.perf_counter()
+        crawler.enrich_things(session=sqlite_session, base_url=metasys_standin.base_url,
+                              metasys_bearer=bearer, entrasso_bearer=entrasso_bearer,
+                              limiter=None, refresh=True, **kwargs)
+        return metasys_standin.body_bytes - body_bytes, time.perf_counter() - start
+
+    full_bytes, full_time = crawl()
+    assert metasys_standin.pushes == 50
+    assert all(item_object.etag for item_object in stored_objects(sqlite_session))
+
+    conditional_bytes, conditional_time = crawl()
+    assert metasys_standin.statuses[304] == 50
+    assert metasys_standin.pushes == 50
+    assert conditional_bytes == 0
+    logging.info(f"Conditional refresh of 50 objects: {full_bytes - conditional_bytes} body bytes "
+                 f"saved, {full_time:.3f}s -> {conditional_time:.3f}s")
+
+    crawl(force_push=True)  # Fetches the bodies again.
+    assert metasys_standin.statuses[304] == 50
+    assert metasys_standin.pushes == 100
+
+    # The building is mapped to another real estate. It gets everything again, once.
+    sqlite_session.add(crawler.BuildingMapping(building='SOKB16', realEstate='moved'))
+    sqlite_session.commit()
+    crawl()
+    assert metasys_standin.statuses[304] == 50
+    assert metasys_standin.pushes == 150
+    assert {item_object.realEstate for item_object in stored_objects(sqlite_session)} == {'moved'}
+    crawl()
+    assert metasys_standin.statuses[304] == 100
+    assert metasys_standin.pushes == 150
+
+
+def test_iter_crawl_candidates(sqlite_session):
+    """Candidates are streamed in id order, a batch at a time."""
+    object_ids = add_crawl_objects(sqlite_session, 7)
+    other = crawler.MetasysObject(id="0000", itemReference="GP-SXD9E-113:OSBG14-NAE1/Other",
+                                  type=129, discovered=datetime.now(timezone.utc), successes=0,
+                                  errors=0)
+    sqlite_session.add(other)
+    sqlite_session.commit()
+    stored_objects(sqlite_session)[-1].successes = 1
+    sqlite_session.commit()
+    sqlite_session.expunge_all()
+
+    streamed = [item_object.id for item_object in
+                crawler.iter_crawl_candidates(sqlite_session, refresh=False,
+                                              item_prefix="GP-SXD9E-113:SOKB16",
+                                              detach=True, batch_size=3)]
+    assert streamed == object_ids[:-1]
+    assert len(sqlite_session.identity_map) == 0
+
+
+def test_record_error_backs_off(sqlite_session):
+    """Failing objects wait twice as long for every failure in a row, until they succeed."""
+    add_crawl_objects(sqlite_session, 1)
+    item_object = stored_objects(sqlite_session)[0]
+    waits = []
+    for _ in range(3):
+        crawler.record_error(item_object, Exception("Nope"))
+        waits.append(item_object.nextAttempt - item_object.lastError)
+    assert waits == [crawler.BACKOFF_MIN, 2 * crawler.BACKOFF_MIN, 4 * crawler.BACKOFF_MIN]
+    item_object.nextAttempt = item_object.lastError + crawler.BACKOFF_MAX
+    crawler.record_error(item_object, Exception("Nope"))
+    assert item_object.nextAttempt - item_object.lastError == crawler.BACKOFF_MAX
+
+    crawler.record_success(item_object)
+    assert item_object.nextAttempt is None
+    crawler.record_error(item_object, Exception("Nope"))
+    assert item_object.nextAttempt - item_object.lastError == crawler.BACKOFF_MIN
+
+
+def test_iter_crawl_candidates_schedule(sqlite_session):
+    """Scheduled crawls take the never synced objects first, then the most stale,
+    and skip the ones backing off."""
+    object_ids = add_crawl_objects(sqlite_session, 6)
+    item_objects = stored_objects(sqlite_session)
+    now = datetime.now(timezone.utc)
+    item_objects[0].lastSync = now - timedelta(days=1)
+    item_objects[1].lastSync = now - timedelta(days=3)
+    item_objects[2].lastSync = now - timedelta(days=2)
+    item_objects[3].nextAttempt = now + timedelta(hours=1)   # Backing off.
+    item_objects[4].nextAttempt = now - timedelta(minutes=1)  # Due again.
+    sqlite_session.commit()
+    sqlite_session.expunge_all()
+
+    assert crawler.crawl_candidates(sqlite_session, False, schedule=True).count() == 5
+    streamed = [item_object.id for item_object in
+                crawler.iter_crawl_candidates(sqlite_session, refresh=False, detach=True,
+                                              batch_size=2, schedule=True)]
+    assert streamed == [object_ids[4], object_ids[5], object_ids[1], object_ids[2], object_ids[0]]
+
+    # Nothing more is handed out past the deadline.
+    assert list(crawler.iter_crawl_candidates(sqlite_session, refresh=False, schedule=True,
+                                              deadline=0)) == []
+
+
+@pytest.mark.parametrize('nae_cap', [None, 1])
+def test_enrich_things_async(requests_mock,
+                             metasys_baseurl,
+                             logged_in_metasys_bearer,
+                             mocker,
+                             logged_in_entrasso_bearer,
+                             bas_target_url,
+                             sqlite_session,
+                             nae_cap
+                             ):
+    """The async engine does the same requests and bookkeeping as the sequential one,
+    with or without a cap on the requests in flight per NAE."""
+    with open(get_path('data/object.0.json')) as fh:
+        json_text = fh.read()
+    object_ids = add_crawl_objects(sqlite_session, 5)
+    for object_id in object_ids:
+        requests_mock.get(metasys_baseurl + f'/objects/{object_id}', complete_qs=True,
+                          text=json_text)
+    # The last one fails in Metasys.
+    requests_mock.get(metasys_baseurl + f'/objects/{object_ids[-1]}', complete_qs=True,
+                      text='{"message": "Object not found"}')
+    add_enumsets(sqlite_session, {129: 'Powerthingy'})
+    requests_mock.post(bas_target_url + f'/kjorbo', complete_qs=True,
+                       text='{ "message": "Thank you for your contribution"}')
+
+    crawler.enrich_things_async(session=sqlite_session,
+                                base_url=metasys_baseurl, metasys_bearer=logged_in_metasys_bearer,
+                                entrasso_bearer=logged_in_entrasso_bearer,
+                                concurrency=3, refresh=True, nae_cap=nae_cap)
+
+    item_objects = stored_objects(sqlite_session)
+    assert [item_object.successes for item_object in item_objects] == [1, 1, 1, 1, 0]
+    assert item_objects[-1].errors == 1
+    assert item_objects[-1].lastError is not None
+    # Two logins, five objects from Metasys and four pushes to Bas.
+    assert requests_mock.call_count == 11
+
+
+def test_enrich_things_pipeline(requests_mock,
+                                metasys_baseurl,
+                                logged_in_metasys_bearer,
+                                mocker,
+                                logged_in_entrasso_bearer,
+                                bas_target_url,
+                                sqlite_session
+                                ):
+    """The pipeline does the same requests and bookkeeping and writes the results in batches."""
+    with open(get_path('data/object.0.json')) as fh:
+        json_text = fh.read()
+    object_ids = add_crawl_objects(sqlite_session, 5)
+    for object_id in object_ids:
+        requests_mock.get(metasys_baseurl + f'/objects/{object_id}', complete_qs=True,
+                          text=json_text)
+    requests_mock.get(metasys_baseurl + f'/objects/{object_ids[0]}', complete_qs=True,
+                      text='{"message": "Object not found"}')
+    add_enumsets(sqlite_session, {129: 'Powerthingy'})
+    requests_mock.post(bas_target_url + f'/kjorbo', complete_qs=True,
+                       text='{ "message": "Thank you for your contribution"}')
+    execute = mocker.spy(sqlite_session, 'execute')
+
+    crawler.enrich_things_pipeline(session=sqlite_session, base_url=metasys_baseurl,
+                                   metasys_bearer=logged_in_metasys_bearer,
+                                   entrasso_bearer=logged_in_entrasso_bearer,
+                                   refresh=True, fetch_workers=2, push_workers=2)
+
+    item_objects = stored_objects(sqlite_session)
+    assert item_objects[0].errors == 1
+    assert item_objects[0].successes == 0
+    assert all(item_object.successes == 1 for item_object in item_objects[1:])
+    assert all(item_object.lastSync is not None for item_object in item_objects[1:])
+    # All five results written in one batch.
+    assert execute.call_count == 1
+    # Two logins, five objects from Metasys and four pushes to Bas.
+    assert requests_mock.call_count == 11
+
+
+def test_shards(sqlite_session):
+    """Every candidate lands in exactly one shard, also with a prefix, and the shards are
+    about even."""
+    object_ids = add_crawl_objects(sqlite_session, 60)
+    other = crawler.MetasysObject(id="0000", itemReference="GP-SXD9E-113:OSBG14-NAE1/Other",
+                                  type=129, discovered=datetime.now(timezone.utc), successes=0,
+                                  errors=0)
+    sqlite_session.add(other)
+    sqlite_session.commit()
+    sqlite_session.expunge_all()
+
+    shards = [crawler.Shard(index, 3) for index in range(1, 4)]
+    crawled = [[item_object.id for item_object in
+                crawler.iter_crawl_candidates(sqlite_session, refresh=False,
+                                              item_prefix="GP-SXD9E-113:SOKB16",
+                                              detach=True, batch_size=7, shard=shard)]
+               for shard in shards]
+    assert sorted(sum(crawled, [])) == sorted(object_ids)
+    assert all(10 <= len(ids) <= 30 for ids in crawled)
+    assert [crawler.count_crawl_candidates(sqlite_session, False, "GP-SXD9E-113:SOKB16",
+                                           shard=shard)
+            for shard in shards] == [len(ids) for ids in crawled]
+    assert len(sqlite_session.identity_map) == 0
+
+
+def test_parse_shard():
+    assert crawler.parse_shard(None, None, '2/4') == (2, 4)
+    assert crawler.parse_shard(None, None, None) is None
+    for value in ('0/4', '5/4', '1', 'a/b'):
+        with pytest.raises(crawler.click.BadParameter):
+            crawler.parse_shard(None, None, value)
+
+
+def test_crawl_lease(sqlite_session):
+    """Workers get disjoint batches, expired leases go back in the pool and writing the results
+    releases them."""
+    object_ids = sorted(add_crawl_objects(sqlite_session, 5))
+    engine = sqlite_session.get_bind()
+    worker_a = crawler.CrawlLease(engine, owner='a')
+    worker_b = crawler.CrawlLease(engine, owner='b')
+    def candidates():
+        return crawler.crawl_candidates(sqlite_session, refresh=False)
+    order = (MetasysObject.id,)
+
+    batch_a = worker_a.claim(sqlite_session, candidates(), order, 3)
+    batch_b = worker_b.claim(sqlite_session, candidates(), order, 3)
+    assert [item_object.id for item_object in batch_a] == object_ids[:3]
+    assert [item_object.id for item_object in batch_b] == object_ids[3:]
+    assert worker_a.claim(sqlite_session, candidates(), order, 3) == []
+    assert worker_a.renew() == 3
+
+    # Worker b dies. Its leases run out and worker a picks up the objects.
+    table = MetasysObject.__table__
+    sqlite_session.execute(table.update().where(table.c.leaseOwner == 'b').values(
+        leaseExpires=datetime.now(timezone.utc) - timedelta(seconds=1)))
+    sqlite_session.commit()
+    batch_a += worker_a.claim(sqlite_session, candidates(), order, 3)
+    assert len(batch_a) == 5
+
+    for item_object in batch_a[:4]:
+        crawler.record_success(item_object)
+    crawler.write_crawl_results(sqlite_session, batch_a[:4], worker_a.owner)
+    assert [(item_object.successes, item_object.leaseOwner)
+            for item_object in stored_objects(sqlite_session)] == [(1, None)] * 4 + [(0, 'a')]
+    # Done with them, so they aren't leased again. The last one is still ours.
+    assert worker_b.claim(sqlite_session, candidates(), order, 3) == []
+    worker_a.release()
+    claimed = worker_b.claim(sqlite_session, candidates(), order, 3)
+    assert [item_object.id for item_object in claimed] == object_ids[4:]
+
+
+def test_enrich_things_leased(requests_mock,
+                              metasys_baseurl,
+                              logged_in_metasys_bearer,
+                              mocker,
+                              logged_in_entrasso_bearer,
+                              bas_target_url,
+                              sqlite_session):
+    """A leased crawl does everything and leaves no leases. A worker that started
+    along with it finds nothing left to do."""
+    with open(get_path('data/object.0.json')) as fh:
+        json_text = fh.read()
+    object_ids = add_crawl_objects(sqlite_session, 7)
+    for object_id in object_ids:
+        requests_mock.get(metasys_baseurl + f'/objects/{object_id}', complete_qs=True,
+                          text=json_text)
+    requests_mock.post(bas_target_url + '/kjorbo',
+                       text='{ "message": "Thank you for your contribution"}')
+    add_enumsets(sqlite_session, {129: 'Powerthingy'})
+    engine = sqlite_session.get_bind()
+
+    def crawl(lease):
+        crawler.enrich_things(session=sqlite_session, base_url=metasys_baseurl,
+                              metasys_bearer=logged_in_metasys_bearer,
+                              entrasso_bearer=logged_in_entrasso_bearer,
+                              limiter=None, refresh=True, lease=lease)
+        return lease.claimed
+
+    with crawler.CrawlLease(engine) as first, crawler.CrawlLease(engine) as late:
+        assert crawl(first) == 7
+        assert all(item_object.successes == 1 and item_object.leaseOwner is None
+                   for item_object in stored_objects(sqlite_session))
+        assert crawl(late) == 0
+
+
+def test_write_crawl_results(sqlite_session):
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    sqlite_session.add_all([crawler.MetasysObject(id=str(idx), type=129, discovered=now)
+                            for idx in range(3)])
+    sqlite_session.commit()
+    item_objects = sqlite_session.query(crawler.MetasysObject) \
+        .order_by(crawler.MetasysObject.id).all()
+    for item_object in item_objects:
+        sqlite_session.expunge(item_object)
+        item_object.successes = 2
+        item_object.lastSync = now
+    item_objects[2].errors = 3
+
+    crawler.write_crawl_results(sqlite_session, item_objects[1:])
+
+    stored = sqlite_session.query(crawler.MetasysObject).order_by(crawler.MetasysObject.id).all()
+    assert [item_object.successes for item_object in stored] == [0, 2, 2]
+    assert [item_object.errors for item_object in stored] == [0, 0, 3]
+    assert stored[1].lastSync == now
+
+
+def test_crawl_result_buffer(sqlite_session, mocker):
+    """Results are written every batch_size objects and whatever is left when the crawl stops."""
+    add_crawl_objects(sqlite_session, 5)
+    item_objects = stored_objects(sqlite_session)
+    sqlite_session.expunge_all()
+    execute = mocker.spy(sqlite_session, 'execute')
+
+    with pytest.raises(KeyboardInterrupt):
+        with crawler.CrawlResultBuffer(sqlite_session, batch_size=2, interval=3600.0) as results:
+            for item_object in item_objects:
+                item_object.successes = 1
+                results.add(item_object)
+            raise KeyboardInterrupt()
+
+    assert execute.call_count == 3
+    assert results.written == 5
+    assert [item_object.successes for item_object in stored_objects(sqlite_session)] == [1] * 5
+
+
 def test_get_uuid_from_url():
     uuid = "bdecf964-a50c-4a44-a586-7e8d95d3d246"
     url = f"http://fla-fla.com/{uuid}"
@@ -128,23 +833,106 @@ def test_validate_metasys_object():
         crawler.validate_metasys_object('{This is not valid JSON')
 
 
+def test_nae_of():
+    assert crawler.nae_of('GP-SXD9E-113:SOKP22-NAE4/FCB.434_121-1OU001.VAVmaks4') == \
+        'GP-SXD9E-113:SOKP22-NAE4'
+    assert crawler.nae_of('GP-SXD9E-113:SOKP22-NAE4') == 'GP-SXD9E-113:SOKP22-NAE4'
+    assert crawler.nae_of(None) == ''
+
+
 def test__metasysid_to_real_estate():
     itemref = "GP-SXD9E-113:SOKP16-NAE4/FCB.434_121-1OU001.VAVmaks4"
     assert crawler.metasysid_to_real_estate(itemref) == 'kjorbo'
 
 
+def test_building_map_overrides(sqlite_session):
+    """The buildingMap table overrides BUILDING_MAP once the crawl loads it."""
+    itemref = 'GP-SXD9E-113:SOKP16-NAE4/FCB.434_121-1OU001.VAVmaks4'
+    sqlite_session.add(crawler.BuildingMapping(building='SOKP16', realEstate='moved'))
+    sqlite_session.commit()
+    try:
+        assert crawler.real_estate_resolver(sqlite_session, reload=True).resolve(itemref) == 'moved'
+        assert crawler.metasysid_to_real_estate(itemref) == 'moved'
+    finally:
+        crawler.real_estate_resolver(reload=True)
+    assert crawler.metasysid_to_real_estate(itemref) == 'kjorbo'
+
+
 def test__json_converter():
     date = datetime.now(timezone.utc)
     datestr = crawler._json_converter(date)
     assert isinstance(datestr, str)
 
 
-def test_get_type_description():
-    mockdb_session = Mock()
+def add_enumsets(session, descriptions: dict) -> None:
+    session.add_all([crawler.EnumSet(id=object_type, description=description, enumset=508)
+                     for object_type, description in descriptions.items()])
+    session.commit()
+
+
+def test_get_type_description(sqlite_session):
+    add_enumsets(sqlite_session, {232: 'spork', 233: ''})
+    descriptions = crawler.type_descriptions(sqlite_session, reload=True)
+    assert crawler.get_type_description(None, 232) == 'spork'  # Loaded already. No session needed.
+    with pytest.raises(crawler.UnknownObjectType):
+        crawler.get_type_description(None, 233)
+    with pytest.raises(crawler.UnknownObjectType):
+        crawler.get_type_description(None, 234)
+    with pytest.raises(TypeError):
+        descriptions[234] = 'knife'  # pylint: disable=unsupported-assignment-operation
+
 
-    mockdb_session.query.return_value.filter_by.return_value.first.return_value.description = 'spork'
-    type_str = crawler.get_type_description(mockdb_session, 232)
-    assert type_str == 'spork'
+@pytest.mark.parametrize('engine', ['sequential', 'async', 'pipeline'])
+def test_enrich_without_enumsets(requests_mock, metasys_baseurl, logged_in_metasys_bearer,
+                                 sqlite_session, engine):
+    """Without any type descriptions the crawl stops before it starts rather than failing every
+    object."""
+    add_crawl_objects(sqlite_session, 2)
+    crawl = dict(session=sqlite_session, base_url=metasys_baseurl,
+                 metasys_bearer=logged_in_metasys_bearer, entrasso_bearer=None, refresh=True,
+                 outbox=True)
+    with pytest.raises(click.ClickException):
+        if engine == 'async':
+            crawler.enrich_things_async(concurrency=2, **crawl)
+        elif engine == 'pipeline':
+            crawler.enrich_things_pipeline(**crawl)
+        else:
+            crawler.enrich_things(limiter=None, **crawl)
+    assert all(item_object.errors == 0 for item_object in stored_objects(sqlite_session))
+
+
+@pytest.mark.parametrize('engine', ['sequential', 'async', 'pipeline'])
+def test_enrich_unknown_type(requests_mock, metasys_baseurl, logged_in_metasys_bearer,
+                             sqlite_session, engine):
+    """An object of a type without a description, or with an itemReference without a
+    building, fails on its own. The crawl goes on."""
+    with open(get_path('data/object.0.json')) as fh:
+        json_text = fh.read()
+    object_ids = add_crawl_objects(sqlite_session, 3)
+    for object_id in object_ids:
+        requests_mock.get(metasys_baseurl + f'/objects/{object_id}', complete_qs=True,
+                          text=json_text)
+    sqlite_session.query(crawler.MetasysObject).filter_by(id=object_ids[1]).update({'type': 130})
+    sqlite_session.query(crawler.MetasysObject).filter_by(id=object_ids[2]) \
+        .update({'itemReference': 'no building here'})
+    add_enumsets(sqlite_session, {129: 'Powerthingy'})
+
+    crawl = dict(session=sqlite_session, base_url=metasys_baseurl,
+                 metasys_bearer=logged_in_metasys_bearer, entrasso_bearer=None, refresh=True,
+                 outbox=True)
+    if engine == 'async':
+        crawler.enrich_things_async(concurrency=2, **crawl)
+    elif engine == 'pipeline':
+        crawler.enrich_things_pipeline(**crawl)
+    else:
+        crawler.enrich_things(limiter=None, **crawl)
+
+    known, unknown, unresolved = stored_objects(sqlite_session)
+    assert (known.successes, known.errors) == (1, 0)
+    assert (unknown.successes, unknown.errors) == (0, 1)
+    assert (unresolved.successes, unresolved.errors) == (0, 1)
+    entry, = sqlite_session.query(crawler.BasOutbox).all()
+    assert json.loads(entry.body)['type'] == 'Powerthingy'
 
 
 def test_b64_encode_response():
@@ -156,22 +944,93 @@ def test_b64_encode_response():
 
 
 
-def test_grab_enumsets(requests_mock, metasys_baseurl, logged_in_metasys_bearer):
-    enumset = 508
-
+def test_grab_enumsets(requests_mock, metasys_baseurl, logged_in_metasys_bearer, sqlite_session):
     with open(get_path('data/enumsets.0.json')) as fh:
         json_text = fh.read()
-    requests_mock.get(f'http://localhost/api/v2/enumSets/{enumset}/members?page=1&pageSize=1000',
-                      complete_qs=True, text=json_text)
-
-    mockdb_session = Mock()
+    for enumset in (507, 508):
+        requests_mock.get(f'{metasys_baseurl}/enumSets/{enumset}/members?page=1&pageSize=1000',
+                          complete_qs=True, text=json_text)
+    first_id = json.loads(json_text)['items'][0]['id']
+    add_enumsets(sqlite_session, {first_id: 'stale'})
 
-    # Mock up
-
-    crawler.grab_enumsets(metasys_baseurl, logged_in_metasys_bearer, mockdb_session, enumset, 0)
-    # We're doing 10 IDs, so 10 updates + 10 commits is 20 calls on the database.
-    assert len(mockdb_session.mock_calls) == 20
+    counts = crawler.grab_enumsets(metasys_baseurl, logged_in_metasys_bearer, sqlite_session, [508])
+    assert counts == {508: 10}
+    stored = sqlite_session.query(crawler.EnumSet).filter_by(enumset=508).all()
+    assert len(stored) == 10
+    assert sqlite_session.query(crawler.EnumSet).get(first_id).description != 'stale'
 
     # We're doing two http calls. One auth and one to get the enumset.
     assert len(requests_mock.request_history) == 2
 
+
+def test_grab_enumsets_in_order(requests_mock, metasys_baseurl, logged_in_metasys_bearer,
+                                sqlite_session):
+    """A member in both enumsets gets its description from the last one given, whichever is
+    fetched first."""
+    def members(description, delay):
+        def answer(request, context):
+            time.sleep(delay)
+            return {'total': 1, 'next': None, 'items': [{'id': 1, 'description': description}]}
+        return answer
+    requests_mock.get('http://localhost/api/v2/enumSets/507/members?page=1&pageSize=1000',
+                      complete_qs=True, json=members('from 507', 0.2))
+    requests_mock.get('http://localhost/api/v2/enumSets/508/members?page=1&pageSize=1000',
+                      complete_qs=True, json=members('from 508', 0.0))
+    crawler.grab_enumsets(metasys_baseurl, logged_in_metasys_bearer, sqlite_session, [508, 507])
+    assert sqlite_session.query(crawler.EnumSet).get(1).description == 'from 507'
+    crawler.grab_enumsets(metasys_baseurl, logged_in_metasys_bearer, sqlite_session, [507, 508])
+    sqlite_session.expire_all()
+    assert sqlite_session.query(crawler.EnumSet).get(1).description == 'from 508'
+
+
+def test_grab_enumsets_if_stale(requests_mock, metasys_baseurl, logged_in_metasys_bearer,
+                                sqlite_session):
+    """The enumsets are left alone while the server's totals are the ones we stored. When one
+    changes they are all fetched again, so the members they share keep the last one's
+    description."""
+    with open(get_path('data/enumsets.0.json')) as fh:
+        page = json.load(fh)
+    page['total'] = len(page['items'])
+    members = {enumset: dict(page, items=[dict(item, description=f"{item['description']} {enumset}")
+                                          for item in page['items']])
+               for enumset in (507, 508)}
+    full = {}
+
+    def serve(enumset):
+        requests_mock.get(f'{metasys_baseurl}/enumSets/{enumset}/members?page=1&pageSize=1',
+                          complete_qs=True, json=dict(members[enumset],
+                                                      items=members[enumset]['items'][:1]))
+        full[enumset] = requests_mock.get(
+            f'{metasys_baseurl}/enumSets/{enumset}/members?page=1&pageSize=1000',
+            complete_qs=True, json=members[enumset])
+
+    def descriptions():
+        sqlite_session.expire_all()
+        return {row.id: row.description for row in sqlite_session.query(crawler.EnumSet)}
+
+    for enumset in (507, 508):
+        serve(enumset)
+    crawler.grab_enumsets(metasys_baseurl, logged_in_metasys_bearer, sqlite_session, [507, 508])
+    from_508 = {item['id']: item['description'] for item in members[508]['items']}
+    assert descriptions() == from_508  # They share every member.
+
+    counts = crawler.grab_enumsets(metasys_baseurl, logged_in_metasys_bearer, sqlite_session,
+                                   [507, 508], if_stale=True)
+    assert counts == {}
+    assert (full[507].call_count, full[508].call_count) == (1, 1)
+
+    # A member is added to 507 only. Both are fetched again, in order.
+    members[507]['items'].append(dict(page['items'][0], id=1, description='New in 507'))
+    members[507]['total'] += 1
+    serve(507)
+    counts = crawler.grab_enumsets(metasys_baseurl, logged_in_metasys_bearer, sqlite_session,
+                                   [507, 508], if_stale=True)
+    assert counts == {507: 11, 508: 10}
+    assert (full[507].call_count, full[508].call_count) == (1, 2)
+    assert descriptions() == {**from_508, 1: 'New in 507'}
+
+    counts = crawler.grab_enumsets(metasys_baseurl, logged_in_metasys_bearer, sqlite_session,
+                                   [507, 508], if_stale=True)
+    assert counts == {}
+    assert (full[507].call_count, full[508].call_count) == (1, 2)
+
@@ -26,3 +26,12 @@ def test_login(logged_in_entrasso_bearer, generate_token):
     assert logged_in_entrasso_bearer.token == generate_token
 
 
+def test_login_again_before_expiry(requests_mock, logged_in_entrasso_bearer, entrasso_auth_url):
+    """ There's no refresh with EntraSSO. A token about to expire is replaced by a new login. """
+    logged_in_entrasso_bearer.expires = int(time.time()) + 60
+    resp_mock = requests_mock.get('http://localhost/bas', text='ok')
+    requests.get('http://localhost/bas', auth=logged_in_entrasso_bearer)
+    assert logged_in_entrasso_bearer.logins == 2
+    assert logged_in_entrasso_bearer.expires - time.time() > 3555
+    assert resp_mock.last_request.headers['authorization'] == \
+        'Bearer ' + logged_in_entrasso_bearer.token
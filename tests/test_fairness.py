@@ -0,0 +1,63 @@
+"""
+Tests for the NAE fairness helpers used by the deep crawl.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from crawler.engine.fairness import interleave, KeyedLimiter
+
+
+def test_interleave_round_robin():
+    items = ['a1', 'a2', 'a3', 'b1', 'c1', 'c2']
+    assert list(interleave(items, key=lambda item: item[0])) == ['a1', 'b1', 'c1', 'a2', 'c2', 'a3']
+
+
+def test_interleave_window():
+    """Only the items within the window are interleaved, and no more than that is read ahead."""
+    pulled = []
+
+    def source():
+        for item in ['a1', 'a2', 'a3', 'a4', 'b1', 'b2']:
+            pulled.append(item)
+            yield item
+
+    stream = interleave(source(), key=lambda item: item[0], window=3)
+    assert next(stream) == 'a1'
+    assert len(pulled) == 3
+    assert list(stream) == ['a2', 'a3', 'b1', 'a4', 'b2']
+
+
+def test_keyed_limiter_caps_each_key():
+    limiter = KeyedLimiter(2)
+    lock = threading.Lock()
+    in_flight = {}
+    peak = {}
+
+    def work(key):
+        with limiter.hold(key):
+            with lock:
+                in_flight[key] = in_flight.get(key, 0) + 1
+                peak[key] = max(peak.get(key, 0), in_flight[key])
+            time.sleep(0.01)
+            with lock:
+                in_flight[key] -= 1
+
+    with ThreadPoolExecutor(max_workers=12) as executor:
+        list(executor.map(work, ['hot'] * 10 + ['cold'] * 2))
+    assert peak == {'hot': 2, 'cold': 2}
+    assert limiter.waits > 0
+    assert 'Max 2 in flight per key: 0 busy' in limiter.summary()
+
+
+def test_keyed_limiter_releases_on_exception():
+    limiter = KeyedLimiter(1)
+    with pytest.raises(ValueError):
+        with limiter.hold('a'):
+            raise ValueError("Boom")
+    with limiter.hold('a'):
+        pass
+    with pytest.raises(ValueError):
+        KeyedLimiter(0)
@@ -0,0 +1,45 @@
+"""
+Tests for the shared HTTP client the crawler talks to its upstreams through.
+"""
+import pytest
+
+from crawler.net import client
+
+
+@pytest.fixture(autouse=True)
+def fresh_client():
+    yield
+    client.configure(pool_size=client.DEFAULT_POOL_SIZE, timeout=client.DEFAULT_TIMEOUT, gzip=True)
+
+
+def test_one_session_per_upstream():
+    assert client.upstream('metasys') is client.upstream('metasys')
+    assert client.upstream('metasys') is not client.upstream('bas')
+
+
+def test_configure(requests_mock):
+    client.configure(pool_size=3, timeout=5.0, gzip=False)
+    session = client.upstream('metasys')
+    adapter = session.get_adapter('https://metasys/api')
+    assert adapter._pool_maxsize == 3  # pylint: disable=protected-access
+    requests_mock.get('http://localhost/api/v2/objects', text='{}')
+    session.get('http://localhost/api/v2/objects')
+    session.get('http://localhost/api/v2/objects', timeout=1.0)
+    assert [request.timeout for request in requests_mock.request_history] == [5.0, 1.0]
+    assert requests_mock.last_request.headers['Accept-Encoding'] == 'identity'
+    assert session.requests == 2
+
+    client.reserve(2)
+    assert client.upstream('metasys') is session
+    client.reserve(8)
+    assert client.upstream('metasys') is not session
+    adapter = client.upstream('metasys').get_adapter('https://metasys/api')
+    assert adapter._pool_maxsize == 8  # pylint: disable=protected-access
+
+
+def test_connections_are_reused(metasys_standin):
+    """The stand-in sees a single connection for a run of requests."""
+    session = client.upstream('metasys')
+    for _ in range(5):
+        assert session.get(metasys_standin.base_url + '/objects/nope').status_code == 404
+    assert metasys_standin.connections == 1
@@ -4,8 +4,13 @@ Note that fixtures from conftest.py are automagically available here.
 """
 
 import datetime
+import threading
+import time
+
 import requests
 
+from crawler.auth.metasysbearer import BearerToken
+
 
 def test_login(logged_in_metasys_bearer, generate_token):
     assert logged_in_metasys_bearer.token == generate_token
@@ -73,3 +78,81 @@ def test_bearer_token_dunder_call(requests_mock, metasys_baseurl, generate_token
     resp = requests.post(metasys_baseurl + '/make_unicorn', auth=metasys_bearer)
     assert resp.json()["name"] == unicorn_name
     assert resp.json()["no_of_horns"] == no_of_horns
+
+
+def test_login_through_session(requests_mock, metasys_baseurl, username, password, generate_token):
+    """ Logins go through the session given, ie the shared one for Metasys. """
+    session = requests.Session()
+    requests_mock.post(metasys_baseurl + '/login',
+                       json={'accessToken': generate_token,
+                             'expires': datetime.datetime.now(datetime.timezone.utc).isoformat()})
+    calls = []
+    session.hooks['response'].append(lambda response, *args, **kwargs: calls.append(response.url))
+    BearerToken(metasys_baseurl, username, password, session).login()
+    assert calls == [metasys_baseurl + '/login']
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _mock_refresh(requests_mock, metasys_baseurl, token='snafu'):
+    now_plus_one_hour = _now() + datetime.timedelta(hours=1)
+    return requests_mock.get(metasys_baseurl + '/refreshToken',
+                             json={'accessToken': token, 'expires': now_plus_one_hour.isoformat()})
+
+
+def test_validate_long_lived_token(requests_mock, metasys_baseurl, logged_in_metasys_bearer):
+    """ A token good for a day and five minutes doesn't need a refresh. Only
+    the seconds part of the remaining time used to be looked at. """
+    refresh = _mock_refresh(requests_mock, metasys_baseurl)
+    logged_in_metasys_bearer.expires = _now() + datetime.timedelta(days=1, minutes=5)
+    logged_in_metasys_bearer.validate()
+    assert refresh.call_count == 0
+
+
+def test_validate_expired_token(requests_mock, metasys_baseurl, logged_in_metasys_bearer):
+    """ An expired token can't be refreshed. We log in again. """
+    refresh = _mock_refresh(requests_mock, metasys_baseurl)
+    logged_in_metasys_bearer.expires = _now() - datetime.timedelta(minutes=5)
+    logged_in_metasys_bearer.validate()
+    assert refresh.call_count == 0
+    assert logged_in_metasys_bearer.logins == 2
+    assert logged_in_metasys_bearer.remaining() > 3000
+
+
+def test_validate_single_flight(requests_mock, metasys_baseurl, logged_in_metasys_bearer):
+    """ Threads finding the token about to expire at the same time refresh it once. """
+    refresh = _mock_refresh(requests_mock, metasys_baseurl)
+    logged_in_metasys_bearer.expires = _now() + datetime.timedelta(minutes=5)
+    start = threading.Barrier(8)
+
+    def validate():
+        start.wait()
+        logged_in_metasys_bearer.validate()
+    threads = [threading.Thread(target=validate) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert refresh.call_count == 1
+    assert (logged_in_metasys_bearer.logins, logged_in_metasys_bearer.refreshes) == (1, 1)
+    assert logged_in_metasys_bearer.token == 'snafu'
+
+
+def test_renewer(requests_mock, metasys_baseurl, logged_in_metasys_bearer):
+    """ The background renewal refreshes the token before the requests would have to. """
+    refresh = _mock_refresh(requests_mock, metasys_baseurl)
+    logged_in_metasys_bearer.expires = _now() + datetime.timedelta(minutes=12)
+    logged_in_metasys_bearer.validate()
+    assert refresh.call_count == 0  # Still good enough for the requests.
+    logged_in_metasys_bearer.start_renewer()
+    try:
+        deadline = time.monotonic() + 5
+        while logged_in_metasys_bearer.refreshes == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        logged_in_metasys_bearer.stop_renewer()
+    assert refresh.call_count == 1
+    assert logged_in_metasys_bearer.remaining() > 3000
+    assert logged_in_metasys_bearer.summary() == 'BearerToken: 1 logins, 1 refreshes'
@@ -0,0 +1,81 @@
+"""
+Tests for the staged pipeline used by the deep crawl.
+"""
+import threading
+import time
+
+import pytest
+
+from crawler.engine.pipeline import Pipeline, Stage, BatchStage
+
+
+def test_items_flow_through_all_stages():
+    batches = []
+    lock = threading.Lock()
+
+    def double(item):
+        return item * 2
+
+    def drop_odd_thirds(item):
+        return None if item % 3 == 0 else item
+
+    def persist(batch):
+        with lock:
+            batches.append(list(batch))
+
+    stages = [Stage('double', double, workers=3, queue_size=2),
+              Stage('filter', drop_odd_thirds, workers=2, queue_size=2),
+              BatchStage('persist', persist, batch_size=4, max_wait=10.0, queue_size=2)]
+    Pipeline(stages).run(range(20))
+
+    written = sorted(item for batch in batches for item in batch)
+    assert written == [item * 2 for item in range(20) if (item * 2) % 3 != 0]
+    assert all(len(batch) <= 4 for batch in batches)
+    assert [stage.processed for stage in stages] == [20, 20, len(written)]
+
+
+def test_batch_stage_flushes_on_time():
+    flushed = []
+
+    def slow_source():
+        yield 1
+        time.sleep(0.3)
+        yield 2
+
+    stage = BatchStage('persist', lambda batch: flushed.append((time.monotonic(), list(batch))),
+                       batch_size=100, max_wait=0.1)
+    Pipeline([stage]).run(slow_source())
+    assert [batch for _, batch in flushed] == [[1], [2]]
+
+
+@pytest.mark.parametrize('exception', [ValueError('Boom'), SystemExit(1)])
+def test_failure_stops_the_pipeline(exception):
+    def fail_on_five(item):
+        if item == 5:
+            raise exception
+        return item
+
+    with pytest.raises(type(exception)):
+        Pipeline([Stage('fail', fail_on_five, workers=2, queue_size=1),
+                  Stage('sink', lambda item: None, workers=1, queue_size=1)]).run(range(1000))
+
+
+@pytest.mark.parametrize('exception', [ValueError('Boom'), SystemExit(1)])
+def test_batch_stage_flushes_on_abort(exception):
+    """ What has made it to the batch stage is handled even when another stage fails. """
+    persisted = []
+    handled = []
+
+    def fail_on_five(item):
+        if item == 5:
+            time.sleep(0.2)  # Let the ones before it through.
+            raise exception
+        handled.append(item)
+        return item
+
+    with pytest.raises(type(exception)):
+        Pipeline([Stage('push', fail_on_five, workers=1, queue_size=1),
+                  BatchStage('persist', persisted.extend, batch_size=100, max_wait=60.0)]) \
+            .run(range(10))
+    assert handled == [0, 1, 2, 3, 4]
+    assert sorted(persisted) == handled
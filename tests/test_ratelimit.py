@@ -0,0 +1,82 @@
+"""
+Tests for the shared rate limiter.
+"""
+import threading
+import time
+
+import pytest
+
+import requests
+
+from crawler.net.ratelimit import RateLimiter, AdaptiveRateLimiter
+
+
+def test_rate_is_enforced():
+    limiter = RateLimiter(rate=50.0)
+    start = time.monotonic()
+    for _ in range(11):
+        limiter.acquire()
+    # The first token is free, the next ten cost 1/50s each.
+    assert time.monotonic() - start >= 0.18
+
+
+def test_rate_is_shared_between_threads():
+    limiter = RateLimiter(rate=50.0)
+    start = time.monotonic()
+    threads = [threading.Thread(target=lambda: [limiter.acquire() for _ in range(5)])
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert time.monotonic() - start >= 0.36
+
+
+def test_invalid_rate():
+    with pytest.raises(ValueError):
+        RateLimiter(rate=0)
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def test_adaptive_rate_increases_while_healthy():
+    limiter = AdaptiveRateLimiter(rate=100.0, max_rate=150.0, increase=20.0, window=5)
+    for _ in range(10):
+        limiter.call(lambda: FakeResponse(200))
+    assert limiter.rate == 140.0
+    for _ in range(10):
+        limiter.call(lambda: FakeResponse(200))
+    assert limiter.rate == 150.0  # Capped at max_rate.
+
+
+def test_adaptive_rate_backs_off_on_overload():
+    limiter = AdaptiveRateLimiter(rate=100.0, min_rate=20.0, window=5, cooldown=60.0)
+    limiter.call(lambda: FakeResponse(429))
+    assert limiter.rate == 50.0
+    # Rejections of requests already in flight don't count again within the cooldown.
+    limiter.call(lambda: FakeResponse(503))
+    assert limiter.rate == 50.0
+    assert limiter.overloads == 2
+
+
+def test_adaptive_rate_backs_off_on_timeout():
+    limiter = AdaptiveRateLimiter(rate=100.0, window=5)
+
+    def timeout():
+        raise requests.exceptions.Timeout()
+
+    with pytest.raises(requests.exceptions.Timeout):
+        limiter.call(timeout)
+    assert limiter.rate == 50.0
+
+
+def test_adaptive_rate_backs_off_on_slow_responses():
+    limiter = AdaptiveRateLimiter(rate=100.0, window=5, latency_target=1.0)
+    for _ in range(5):
+        limiter.record(latency=1.5)
+    assert limiter.rate == 50.0
+    assert limiter.p95() == 1.5
+    assert 'Rate limiter' in limiter.summary()
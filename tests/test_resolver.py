@@ -0,0 +1,54 @@
+"""
+Tests for resolving itemReferences to the Bas real estates.
+"""
+
+import json
+
+import pytest
+
+from crawler.metadata import resolver
+from crawler.metadata.resolver import InvalidItemReference, RealEstateResolver, UNKNOWN_REAL_ESTATE
+
+BUILDINGS = {'SOKP16': 'kjorbo', 'OSBG14': 'postgirobygget'}
+
+
+def test_resolve():
+    real_estates = RealEstateResolver(BUILDINGS)
+    assert real_estates.resolve('GP-SXD9E-113:SOKP16-NAE4/FCB.434_121-1OU001.VAVmaks4') == 'kjorbo'
+    assert real_estates.resolve_many(['GP-SXD9E-113:OSBG14-NAE1/FCB',
+                                      'GP-SXD9E-113:SOKP16-NAE4/FCB']) == \
+        ['postgirobygget', 'kjorbo']
+    with pytest.raises(InvalidItemReference):
+        real_estates.resolve('no building here')
+
+
+def test_overrides():
+    """ The later maps win. """
+    real_estates = RealEstateResolver(BUILDINGS, {'SOKP16': 'moved'}, {'SOKB11': 'kjorbo'})
+    assert real_estates.resolve_many(['GP:SOKP16-NAE4/FCB', 'GP:SOKB11-NAE4/FCB',
+                                      'GP:OSBG14-NAE1/FCB']) == \
+        ['moved', 'kjorbo', 'postgirobygget']
+
+
+def test_unmapped_reported_together(caplog):
+    real_estates = RealEstateResolver(BUILDINGS)
+    item_references = [f'GP:SOXX{building}-NAE1/FCB.{idx}'
+                       for building in (1, 2) for idx in range(3)]
+    item_references.append('GP:SOXX1-NAE2/FCB')  # Same building, another NAE.
+    assert set(real_estates.resolve_many(item_references)) == {UNKNOWN_REAL_ESTATE}
+    assert real_estates.unmapped == {'SOXX1': 4, 'SOXX2': 3}
+    assert len([record for record in caplog.records if 'SOXX1' in record.getMessage()]) == 1
+    assert real_estates.summary() == \
+        'Real estates: 2 buildings mapped, 2 sites/buildings seen, ' \
+        'not mapped: SOXX1 (4 objects), SOXX2 (3 objects)'
+
+
+def test_file_overrides(tmp_path):
+    path = tmp_path / 'buildings.json'
+    path.write_text(json.dumps({'SOKB11': 'kjorbo'}))
+    resolver.configure(str(path))
+    try:
+        assert resolver.file_overrides() == {'SOKB11': 'kjorbo'}
+    finally:
+        resolver.configure(None)
+    assert resolver.file_overrides() == {}
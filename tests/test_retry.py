@@ -0,0 +1,130 @@
+"""
+Tests for the retry policy and the circuit breakers.
+"""
+import threading
+import time
+
+import pytest
+
+import requests
+
+from crawler.net.retry import CircuitBreaker, RetryPolicy, retry_after
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.reason = 'Fake'
+        self.headers = headers or {}
+
+
+def responses(*status_codes):
+    """ send() callable answering with the status codes in turn. Exceptions are raised. """
+    outcomes = iter(status_codes)
+
+    def send():
+        outcome = next(outcomes)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return FakeResponse(outcome)
+    return send
+
+
+def test_retry_after():
+    assert retry_after(FakeResponse(503, {'Retry-After': '7'})) == 7.0
+    assert 0 < retry_after(FakeResponse(503, {'Retry-After': 'Wed, 21 Oct 2099 07:28:00 GMT'}))
+    assert retry_after(FakeResponse(503, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})) == 0.0
+    assert retry_after(FakeResponse(503, {'Retry-After': 'soon'})) is None
+    assert retry_after(FakeResponse(503)) is None
+
+
+def test_delay_is_jittered_and_capped():
+    policy = RetryPolicy(base=1.0, cap=5.0)
+    delays = [policy.delay(3) for _ in range(200)]
+    assert all(0 <= delay <= 5.0 for delay in delays)
+    assert len(set(delays)) > 1
+    assert all(0 <= policy.delay(0) <= 1.0 for _ in range(200))
+    assert policy.delay(0, FakeResponse(429, {'Retry-After': '2'})) == 2.0
+    assert policy.delay(0, FakeResponse(429, {'Retry-After': '3600'})) == policy.max_retry_after
+
+
+def test_retries_until_it_works():
+    policy = RetryPolicy(attempts=4, base=0.0)
+    send = responses(503, requests.exceptions.ConnectionError(), 429, 200)
+    assert policy.call(send).status_code == 200
+    assert policy.retries == 3
+
+
+def test_gives_up_after_the_attempts():
+    policy = RetryPolicy(attempts=2, base=0.0)
+    assert policy.call(responses(500, 502)).status_code == 502
+    with pytest.raises(requests.exceptions.Timeout):
+        policy.call(responses(500, requests.exceptions.Timeout()))
+
+
+def test_other_failures_are_not_retried():
+    policy = RetryPolicy(attempts=3, base=0.0)
+    assert policy.call(responses(404)).status_code == 404
+    with pytest.raises(ValueError):
+        policy.call(responses(ValueError('Boom')))
+    assert policy.retries == 0
+
+
+def test_breaker_opens_after_threshold_failures():
+    circuit = CircuitBreaker('metasys', threshold=3, cooldown=0.2)
+    policy = RetryPolicy(attempts=3, base=0.0)
+    assert policy.call(responses(503, 503, 200), circuit).status_code == 200
+    assert not circuit.is_open  # The success reset the count.
+    policy.call(responses(429, 429, 429), circuit)
+    assert not circuit.is_open  # Too many requests isn't down.
+    policy.call(responses(503, 503, 503), circuit)
+    assert circuit.is_open
+    assert circuit.trips == 1
+
+
+def test_open_breaker_pauses_until_a_probe_works():
+    circuit = CircuitBreaker('bas', threshold=1, cooldown=0.2, max_cooldown=1.0)
+    circuit.record(failed=True)
+    start = time.monotonic()
+    circuit.wait()  # Our turn to probe once the cooldown is over...
+    assert time.monotonic() - start >= 0.15
+    circuit.record(failed=True)  # ...but it's still down. The cooldown doubles.
+    assert circuit.is_open
+
+    probes = []
+
+    def waiter():
+        circuit.wait()
+        probes.append(time.monotonic() - start)
+        circuit.record(failed=False)
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=waiter) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not circuit.is_open
+    assert len(probes) == 3
+    assert min(probes) >= 0.35
+    assert circuit.paused > 0.5
+
+
+def test_probe_raising_something_else_reopens_the_breaker():
+    """ A probe failing on anything but a retried exception, ie the login on
+    the way, must not leave the other callers waiting for it forever. """
+    circuit = CircuitBreaker('entrasso', threshold=1, cooldown=0.1)
+    policy = RetryPolicy(attempts=1, base=0.0)
+    circuit.record(failed=True)
+    with pytest.raises(requests.exceptions.HTTPError):
+        policy.call(responses(requests.exceptions.HTTPError('Login failed')), circuit)
+    assert circuit.is_open
+
+    done = threading.Event()
+
+    def next_caller():
+        policy.call(responses(200), circuit)
+        done.set()
+    threading.Thread(target=next_caller, daemon=True).start()
+    assert done.wait(2.0)
+    assert not circuit.is_open
@@ -0,0 +1,135 @@
+"""
+Tests for the sinks the DTOs are pushed through.
+"""
+import gzip
+import json
+import threading
+import time
+
+import requests
+
+from crawler.sink.bas import BasSink
+from crawler.sink.ndjson import NdjsonSink
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.reason = 'Fake'
+
+
+class FakeBas:
+    """ Records the POSTs. Batches get batch_status, single DTOs 200. """
+
+    def __init__(self, batch_status: int = 200):
+        self.batch_status = batch_status
+        self.posts = []
+        self._lock = threading.Lock()
+
+    def __call__(self, real_estate: str, data: bytes, headers: dict):
+        if headers.get('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+        dtos = json.loads(data)
+        with self._lock:
+            self.posts.append((real_estate, dtos))
+        return FakeResponse(self.batch_status if isinstance(dtos, list) else 200)
+
+
+def dto(idx: int) -> str:
+    return json.dumps({'id': f'obj{idx}'})
+
+
+def test_batches_per_real_estate():
+    bas = FakeBas()
+    outcomes = []
+    with BasSink(bas, batch_size=3, concurrency=2) as sink:
+        for idx in range(7):
+            sink.put('kjorbo' if idx % 2 else 'dyrvik', dto(idx), outcomes.append)
+        assert len(bas.posts) == 2  # The two full batches, sent together. obj6 is waiting.
+    assert outcomes == [None] * 7
+    assert sorted((real_estate, len(dtos)) for real_estate, dtos in bas.posts) == \
+        [('dyrvik', 1), ('dyrvik', 3), ('kjorbo', 3)]
+    assert sink.requests == 3
+    assert sink.delivered == 7
+
+
+def test_flushes_on_size_and_time():
+    bas = FakeBas()
+    sink = BasSink(bas, batch_size=100, max_bytes=len(dto(1)) * 2, interval=0.1, concurrency=1)
+    sink.put('kjorbo', dto(1))
+    sink.put('kjorbo', dto(2))
+    assert len(bas.posts) == 1  # Big enough.
+    sink.put('dyrvik', dto(3))
+    time.sleep(0.15)
+    sink.put('kjorbo', dto(4))
+    # The dyrvik one has waited long enough. The new one has only just come.
+    assert len(bas.posts) == 2
+    sink.close()
+
+
+def test_falls_back_to_single_posts():
+    bas = FakeBas(batch_status=415)
+    with BasSink(bas, batch_size=2, concurrency=1) as sink:
+        for idx in range(4):
+            sink.put('kjorbo', dto(idx))
+    assert not sink.batching
+    # The rejected batch, its two DTOs one by one, then the next two one by one.
+    assert [type(dtos).__name__ for _, dtos in bas.posts] == \
+        ['list', 'dict', 'dict', 'dict', 'dict']
+    assert sink.delivered == 4
+
+
+def test_too_large_batch_keeps_batching():
+    bas = FakeBas(batch_status=413)
+    with BasSink(bas, batch_size=2, concurrency=1) as sink:
+        sink.put('kjorbo', dto(1))
+        sink.put('kjorbo', dto(2))
+    assert sink.batching
+    assert sink.delivered == 2
+
+
+def test_failed_first_batch_falls_back():
+    """ Bas failing on the first batch is taken as it not taking arrays. """
+    bas = FakeBas(batch_status=500)
+    with BasSink(bas, batch_size=2, concurrency=1) as sink:
+        sink.put('kjorbo', dto(1))
+        sink.put('kjorbo', dto(2))
+    assert not sink.batching
+    assert sink.delivered == 2
+
+
+def test_failed_batch_fails_every_dto():
+    """ Once Bas has taken a batch, failing on one is Bas failing. """
+    bas = FakeBas()
+    outcomes = []
+    with BasSink(bas, batch_size=2, concurrency=1) as sink:
+        sink.put('kjorbo', dto(1), outcomes.append)
+        sink.put('kjorbo', dto(2), outcomes.append)
+        bas.batch_status = 503
+        sink.put('kjorbo', dto(3), outcomes.append)
+        sink.put('kjorbo', dto(4), outcomes.append)
+    assert outcomes[:2] == [None, None]
+    assert all(isinstance(outcome, requests.exceptions.HTTPError) for outcome in outcomes[2:])
+    assert sink.batching
+    assert sink.failed == 2
+
+
+def test_single_posts_by_default():
+    bas = FakeBas()
+    with BasSink(bas) as sink:
+        sink.put('kjorbo', dto(1))
+        sink.put('kjorbo', dto(2))
+    assert [type(dtos).__name__ for _, dtos in bas.posts] == ['dict', 'dict']
+
+
+def test_ndjson(tmp_path):
+    path = str(tmp_path / 'dtos.ndjson')
+    outcomes = []
+    with NdjsonSink(path) as sink:
+        sink.put('kjorbo', dto(1), outcomes.append)
+        sink.put('dyrvik', dto(2), outcomes.append)
+    assert outcomes == [None, None]
+    with open(path) as fh:
+        assert [json.loads(line) for line in fh] == \
+            [{'realEstate': 'kjorbo', 'dto': {'id': 'obj1'}},
+             {'realEstate': 'dyrvik', 'dto': {'id': 'obj2'}}]
@@ -0,0 +1,74 @@
+"""
+Tests for the on-disk token cache shared by the auth drivers between runs.
+Note that fixtures from conftest.py are automagically available here.
+"""
+
+import datetime
+import os
+import stat
+
+from crawler.auth.cache import TokenCache
+from crawler.auth.entrasso import EntraSSOToken
+from crawler.auth.metasysbearer import BearerToken
+
+
+def _bearer(metasys_baseurl, username, password, cache):
+    return BearerToken(metasys_baseurl, username, password, cache=cache)
+
+
+def test_next_run_uses_cached_token(requests_mock, tmp_path, metasys_baseurl, username, password,
+                                    generate_token):
+    now_plus_one_hour = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+    login = requests_mock.post(metasys_baseurl + '/login',
+                               json={'accessToken': generate_token,
+                                     'expires': now_plus_one_hour.isoformat()})
+    cache = TokenCache(str(tmp_path / 'cache' / 'tokens.json'))
+    _bearer(metasys_baseurl, username, password, cache).validate()
+    assert stat.S_IMODE(os.stat(cache.path).st_mode) == 0o600
+
+    # The next run, with a cache of its own on the same file.
+    bearer = _bearer(metasys_baseurl, username, password, TokenCache(cache.path))
+    bearer.validate()
+    assert login.call_count == 1
+    assert bearer.token == generate_token
+    assert abs((bearer.expires - now_plus_one_hour).total_seconds()) < 1
+    assert bearer.summary() == 'BearerToken: 0 logins, 0 refreshes, 1 from the cache'
+
+    # Another user logs in for themselves.
+    _bearer(metasys_baseurl, 'someone else', password, cache).validate()
+    assert login.call_count == 2
+
+
+def test_stale_cached_token(requests_mock, tmp_path, metasys_baseurl, username, password,
+                            generate_token):
+    """ A cached token about to expire isn't used. The new one replaces it in the cache. """
+    cache = TokenCache(str(tmp_path / 'tokens.json'))
+    bearer = _bearer(metasys_baseurl, username, password, cache)
+    cache.put(bearer.cache_key(), 'stale', datetime.datetime.now().timestamp() + 60)
+    now_plus_one_hour = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+    requests_mock.post(metasys_baseurl + '/login',
+                       json={'accessToken': generate_token,
+                             'expires': now_plus_one_hour.isoformat()})
+    bearer.validate()
+    assert bearer.token == generate_token
+    assert cache.get(bearer.cache_key())[0] == generate_token
+
+
+def test_cached_entrasso_token(tmp_path, entrasso_auth_url, entrasso_secret,
+                               logged_in_entrasso_bearer):
+    cache = TokenCache(str(tmp_path / 'tokens.json'))
+    logged_in_entrasso_bearer.cache = cache
+    logged_in_entrasso_bearer.login()
+    bearer = EntraSSOToken(entrasso_auth_url, appid=666, appname='test', secret=entrasso_secret,
+                           cache=cache)
+    bearer.validate()
+    assert (bearer.token, bearer.expires) == \
+        (logged_in_entrasso_bearer.token, logged_in_entrasso_bearer.expires)
+    assert bearer.logins == 0
+
+
+def test_cache_readable_by_others_is_ignored(tmp_path):
+    cache = TokenCache(str(tmp_path / 'tokens.json'))
+    cache.put('key', 'token', 1e10)
+    os.chmod(cache.path, 0o644)
+    assert cache.get('key') is None